@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class AppConfig(AppConfig):
     name = 'app'
+
+    def ready(self):
+        # connect the signal handlers and register the job queue's tasks
+        from . import signals, tasks
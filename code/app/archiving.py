@@ -0,0 +1,110 @@
+"""
+Cold storage for archived and old mail.
+Mailbox entries move out of the MailboxEntry table that the folder pages read and into the
+ArchivedEntry table as soon as their owner archives them, and once they're older than
+ARCHIVE_AFTER_DAYS (archive_old_mail() runs daily). When no entry on a shard shows an email
+anymore, its text body is compressed into the ArchivedBody table and only decompressed when
+the email is viewed (see bodies.py), so the hot tables hold mostly recent mail.
+"""
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .bodies import compress_body
+from .counters import count_entries, touch
+from .models import ArchivedBody, ArchivedEntry, Email, MailboxEntry
+from .shards import current_alias
+
+# mailbox entry fields kept in the archive
+ENTRY_FIELDS = (
+    'uid', 'user_id', 'email_id', 'folder', 'sent_at', 'subject', 'snippet', 'thread', 'sender_address',
+    'recipient_addresses', 'is_read', 'is_forward', 'version'
+)
+
+# folders whose old mail is archived (drafts are kept until they're sent)
+AGING_FOLDERS = (MailboxEntry.INBOX, MailboxEntry.OUTBOX)
+
+# archived bodies are written once and rarely read, so they're compressed as much as possible
+COMPRESSION_LEVEL = 9
+
+# number of entries archived per transaction
+BATCH_SIZE = 500
+
+
+def freeze_bodies(email_ids):
+    """
+    Moves the bodies of the given emails into the archive, compressed, unless a mailbox entry
+    on the current shard still shows them. Returns the number of bodies moved.
+    """
+
+    email_ids = set(email_ids)
+    shown = set(MailboxEntry.objects.filter(email__in=email_ids).values_list('email', flat=True))
+    bodies = list(Email.objects.filter(uid__in=email_ids - shown, body__isnull=False).values_list('uid', 'body'))
+    if not bodies:
+        return 0
+
+    ArchivedBody.objects.bulk_create([
+        ArchivedBody(email_id=uid, body=compress_body(body, COMPRESSION_LEVEL)) for uid, body in bodies
+    ], batch_size=BATCH_SIZE, ignore_conflicts=True)
+    Email.objects.filter(uid__in=[uid for uid, _ in bodies]).update(body=None)
+    return len(bodies)
+
+
+def move_to_archive(entries):
+    """
+    Moves mailbox entries, locked by the current transaction, into the archive.
+    Their owners' counters are updated, and bodies no other entry shows are moved too.
+    """
+
+    if not entries:
+        return
+
+    archived_at = timezone.now()
+    ArchivedEntry.objects.bulk_create([
+        ArchivedEntry(archived_at=archived_at, **{field: getattr(entry, field) for field in ENTRY_FIELDS})
+        for entry in entries
+    ], batch_size=BATCH_SIZE)
+    MailboxEntry.objects.filter(uid__in=[entry.uid for entry in entries]).delete()
+
+    # archived entries leave their folders' counts, and every owner's pages change
+    adjusted = count_entries(entries, sign=-1)
+    touch({entry.user_id for entry in entries} - adjusted)
+    freeze_bodies({entry.email_id for entry in entries})
+
+
+def due_entries(cutoff):
+    """
+    Returns the querysets of mailbox entries due to move into the archive: those archived in place,
+    and those in the AGING_FOLDERS sent before cutoff, oldest first.
+    """
+
+    return [
+        MailboxEntry.objects.filter(is_archived=True),
+        MailboxEntry.objects.filter(sent_at__lt=cutoff, folder__in=AGING_FOLDERS).order_by('sent_at'),
+    ]
+
+
+def archive_old_mail(days=None, batch_size=BATCH_SIZE):
+    """
+    Moves every mailbox entry on the current shard that was archived in place, or is older than
+    ARCHIVE_AFTER_DAYS (or the given number of days), into the archive, a batch at a time.
+    Returns the number of entries moved.
+    """
+
+    days = getattr(settings, 'ARCHIVE_AFTER_DAYS', 365) if days is None else days
+    cutoff = timezone.now() - timedelta(days=days)
+
+    moved = 0
+    for entries in due_entries(cutoff):
+        while True:
+            # moved entries leave the table, so each batch starts from the top again
+            with transaction.atomic(using=current_alias()):
+                batch = list(entries.select_for_update()[:batch_size])
+                move_to_archive(batch)
+            if not batch:
+                break
+            moved += len(batch)
+    return moved
@@ -0,0 +1,290 @@
+"""
+Async versions of the mailbox read views, served instead of the sync ones when running
+under ASGI (see project/asgi.py). Reads go through the async ORM, so one ASGI worker can
+keep many slow clients waiting on I/O at once. Work that still needs the sync ORM (loading
+the session and user, transactions, raw search queries, and template context processors)
+is run with sync_to_async.
+"""
+
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.contrib import messages
+from django.contrib.auth.views import redirect_to_login
+from django.http import Http404, HttpResponseNotAllowed
+from django.shortcuts import redirect, render
+
+from .bodies import get_body
+from .conditional import check_not_modified, mailbox_validators, set_validators
+from .folders import aload_archive, aload_folder
+from .mailbox import mark_read
+from .models import CustomUser, Email, MailboxEntry, MailboxThread, Note
+from .pagination import get_page_params
+from .search import search_mailbox
+from .threads import aload_conversation, aload_threads
+
+# templates are rendered in a thread, since context processors may query the DB
+arender = sync_to_async(render)
+
+
+def async_login_required(view):
+    """
+    Async version of Django's login_required decorator.
+    """
+
+    @wraps(view)
+    async def checker(request, *args, **kwargs):
+        # loading the user reads the session and DB, so do it in a thread
+        is_authenticated = await sync_to_async(lambda: request.user.is_authenticated)()
+        if is_authenticated:
+            return await view(request, *args, **kwargs)
+
+        return redirect_to_login(request.get_full_path())
+
+    return checker
+
+
+def async_verify_email_auth(view):
+    """
+    Async version of the verify_email_auth decorator, which checks if a user is logged in
+    to the Email client before granting access to a page.
+    """
+
+    @wraps(view)
+    async def checker(request, *args, **kwargs):
+        email_session = await sync_to_async(request.session.get)('email_session', None)
+        if email_session:
+            # user is logged in, continue to view
+            return await view(request, *args, **kwargs)
+
+        # user is not logged in, warn them
+        messages.warning(request, "Please sign-in to continue.")
+        return redirect('/email_login')
+
+    return checker
+
+
+def async_require_http_methods(methods):
+    """
+    Async version of Django's require_http_methods decorator.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        async def checker(request, *args, **kwargs):
+            if request.method not in methods:
+                return HttpResponseNotAllowed(methods)
+            return await view(request, *args, **kwargs)
+
+        return checker
+
+    return decorator
+
+
+def async_conditional_page(validators):
+    """
+    Async version of the conditional_page decorator.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        async def checker(request, *args, **kwargs):
+            # validators read the session and the counters cache, so check them in a thread
+            not_modified = await sync_to_async(check_not_modified)(request, validators, *args, **kwargs)
+            if not_modified is not None:
+                return not_modified
+
+            response = await view(request, *args, **kwargs)
+            return await sync_to_async(set_validators)(response, request, validators, *args, **kwargs)
+
+        return checker
+
+    return decorator
+
+
+@async_login_required
+@async_verify_email_auth
+@async_require_http_methods(['GET'])
+@async_conditional_page(mailbox_validators)
+async def view_email(request, email_uid):
+    """
+    Handles serving individual email pages.
+    """
+
+    # fetch the requested email, its sender, and its recipients from the DB
+    email = await Email.objects.aget(uid=email_uid)
+    sender = await email.sender_email.aget()
+    sender.user = await CustomUser.objects.aget(pk=sender.user_id)
+
+    # users may be on another database than their mail, so they're looked up separately
+    user_ids = [user_id async for user_id in email.recipient_set.values_list('user', flat=True)]
+    addresses = dict([pair async for pair in CustomUser.objects.filter(pk__in=user_ids).values_list('pk', 'email')])
+    recipients = ', '.join(addresses[user_id] for user_id in user_ids if user_id in addresses)
+    attachments = [attach async for attach in email.attachment_set.all()]
+    body = await sync_to_async(get_body)(email)
+
+    # the user has now read this email
+    await sync_to_async(mark_read)(request.user, email)
+
+    return await arender(request, 'view_email.html', {
+        'user': request.user,
+        'email': email,
+        'body': body,
+        'sender': sender,
+        'to': recipients,
+        'attachments': attachments
+    })
+
+
+@async_login_required
+@async_verify_email_auth
+@async_require_http_methods(['GET', 'POST'])
+@async_conditional_page(mailbox_validators)
+async def outbox(request):
+    """
+    Serves the user's outbox, or sent messages.
+    """
+
+    # load the requested page of the folder
+    before, limit = get_page_params(request)
+    emails, next_cursor = await aload_folder(request.user, MailboxEntry.OUTBOX, before, limit)
+
+    return await arender(request, 'inbox.html', {
+        'user': request.user,
+        'folder': 'outbox',
+        'emails': emails,
+        'next_cursor': next_cursor,
+        'limit': limit
+    })
+
+
+@async_login_required
+@async_verify_email_auth
+@async_require_http_methods(['GET', 'POST'])
+@async_conditional_page(mailbox_validators)
+async def inbox(request):
+    """
+    Home page of Simple Email. Serves the user's inbox.
+    """
+
+    # load the requested page of the folder
+    before, limit = get_page_params(request)
+    emails, next_cursor = await aload_folder(request.user, MailboxEntry.INBOX, before, limit)
+
+    return await arender(request, 'inbox.html', {
+        'user': request.user,
+        'folder': 'inbox',
+        'emails': emails,
+        'next_cursor': next_cursor,
+        'limit': limit
+    })
+
+
+@async_login_required
+@async_verify_email_auth
+@async_require_http_methods(['GET', 'POST'])
+@async_conditional_page(mailbox_validators)
+async def archive_folder(request):
+    """
+    Serves the user's archive, of emails they archived or that were archived for being old.
+    """
+
+    # load the requested page of the folder
+    before, limit = get_page_params(request)
+    emails, next_cursor = await aload_archive(request.user, before, limit)
+
+    return await arender(request, 'inbox.html', {
+        'user': request.user,
+        'folder': 'archive',
+        'emails': emails,
+        'next_cursor': next_cursor,
+        'limit': limit
+    })
+
+
+@async_login_required
+@async_verify_email_auth
+@async_require_http_methods(['GET'])
+@async_conditional_page(mailbox_validators)
+async def threads(request):
+    """
+    Serves the user's conversations, most recently active first.
+    """
+
+    # load the requested page of the user's thread summaries
+    before, limit = get_page_params(request)
+    rows, next_cursor = await aload_threads(request.user, before, limit)
+
+    return await arender(request, 'threads.html', {
+        'user': request.user,
+        'folder': 'threads',
+        'threads': rows,
+        'next_cursor': next_cursor,
+        'limit': limit
+    })
+
+
+@async_login_required
+@async_verify_email_auth
+@async_require_http_methods(['GET'])
+@async_conditional_page(mailbox_validators)
+async def view_thread(request, thread):
+    """
+    Serves every message of one of the user's conversations, oldest first.
+    """
+
+    summary = await MailboxThread.objects.filter(user=request.user, thread=thread).values('subject').afirst()
+    if summary is None:
+        raise Http404("Conversation not found")
+
+    return await arender(request, 'inbox.html', {
+        'user': request.user,
+        'folder': 'thread',
+        'subject': summary['subject'],
+        'emails': await aload_conversation(request.user, thread)
+    })
+
+
+@async_login_required
+@async_verify_email_auth
+@async_require_http_methods(['GET'])
+async def search(request):
+    """
+    Handles searching for emails.
+    """
+
+    # get query from GET data
+    query = request.GET['query']
+
+    # check if the user has given a valid query
+    if not query:
+        messages.error(request, "Invalid search query!")
+        return redirect('/')
+
+    # load the requested page of the user's best matching emails, which uses raw SQL
+    before, limit = get_page_params(request)
+    rows, next_cursor = await sync_to_async(search_mailbox)(request.user, query, before, limit)
+
+    # render and return any results
+    return await arender(request, 'search.html', {
+        'user': request.user,
+        'query': query,
+        'emails': {row['uid']: row for row in rows},
+        'next_cursor': next_cursor,
+        'limit': limit
+    })
+
+
+@async_login_required
+@async_conditional_page(mailbox_validators)
+async def note_box(request):
+    """
+    Home page of Simple Note. Serves the user's Notes.
+    """
+
+    notes = [note async for note in Note.objects.filter(user=request.user)]
+
+    return await arender(request, 'notes_inbox.html', {
+        'user': request.user,
+        'notes': notes
+    })
@@ -0,0 +1,284 @@
+"""
+Performance benchmarks. These are not run with the regular test suite.
+Run them with: python manage.py test app.benchmarks
+"""
+
+import asyncio
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth.hashers import check_password, make_password
+from django.contrib.messages.storage.fallback import FallbackStorage
+from django.core.cache import caches
+from django.contrib.sessions.backends.db import SessionStore
+from django.db import connection, connections
+from django.test import AsyncRequestFactory, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from . import async_views, views
+from .bodies import BODY_FIELDS
+from .directory import directory
+from .folders import load_inbox
+from .forms import ComposeForm
+from .hashing import HashingPool, PoolFull
+from .mailbox import deliver
+from .models import CustomUser, Email, MailboxEntry, Recipient, Sender
+
+
+@override_settings(DEFERRED_FANOUT_THRESHOLD=10 ** 9)
+class BenchmarkSend(TestCase):
+    """
+    Measures how the time to send an email scales with its number of recipients.
+    Large sends are delivered inline here, to measure the work a deferred send leaves to its job.
+    """
+
+    RECIPIENT_COUNTS = [1, 10, 100, 1000, 5000]
+
+    def setUp(self):
+        self.sender = CustomUser.objects.create_user(
+            username='bench_sender',
+            password='bench_sender',
+            email='bench_sender@simpleemail.com'
+        )
+
+        # create enough recipients for the largest send, sharing one password hash
+        self.recipients = CustomUser.objects.bulk_create([
+            CustomUser(username=f"bench_{i}", email=f"bench_{i}@simpleemail.com", password=self.sender.password)
+            for i in range(max(self.RECIPIENT_COUNTS))
+        ], batch_size=500)
+
+        # bulk creates don't send signals, so rebuild the address directory
+        directory.clear()
+
+    def test_send_scaling(self):
+        print(f"\n{'recipients':>10} {'queries':>8} {'seconds':>9} {'ms/recipient':>13}")
+
+        for count in self.RECIPIENT_COUNTS:
+            form = ComposeForm({
+                'subject': f'Benchmark {count}',
+                'sender': self.sender.email,
+                'recipients': ','.join(user.email for user in self.recipients[:count]),
+                'body': 'Benchmark body',
+            })
+
+            # time validating the form and writing the email
+            with CaptureQueriesContext(connection) as queries:
+                start = time.perf_counter()
+                self.assertTrue(form.is_valid())
+                email = form.create_email_and_relations()
+                elapsed = time.perf_counter() - start
+
+            self.assertEqual(Recipient.objects.filter(email=email).count(), count)
+            print(f"{count:>10} {len(queries):>8} {elapsed:>9.3f} {elapsed * 1000 / count:>13.3f}")
+
+
+class BenchmarkAsyncViews(TransactionTestCase):
+    """
+    Compares inbox throughput of the sync views on a pool of WSGI threads against the
+    async views on a single ASGI event loop, when every client is slow to read its response.
+    A slow client is modelled as a delay after each response: it ties up a WSGI thread,
+    but only a pending task on the event loop.
+    """
+
+    CLIENTS = [10, 50, 200]
+    WSGI_THREADS = 8
+    CLIENT_DELAY = 0.5
+
+    def setUp(self):
+        self.sender = CustomUser.objects.create_user(username='bench_sender', email='bench_sender@simpleemail.com')
+        self.user = CustomUser.objects.create_user(username='bench_user', email='bench_user@simpleemail.com')
+        for i in range(50):
+            email = Email.objects.create(subject=f'Benchmark {i}', body='Benchmark body')
+            sender = Sender.objects.create(user=self.sender, email=email)
+            recipient = Recipient.objects.create(user=self.user, email=email, is_sent=True)
+            deliver(email, sender, [recipient])
+
+        self.session = SessionStore()
+        self.session['email_session'] = True
+        self.session.save()
+
+    def prepare(self, request):
+        request.user = self.user
+        request.session = SessionStore(self.session.session_key)
+        request._messages = FallbackStorage(request)
+        return request
+
+    def run_wsgi(self, clients):
+        factory = RequestFactory()
+
+        def handle(_):
+            try:
+                response = views.inbox(self.prepare(factory.get('/inbox')))
+                time.sleep(self.CLIENT_DELAY)
+                return response.status_code
+            finally:
+                connections.close_all()
+
+        with ThreadPoolExecutor(self.WSGI_THREADS) as pool:
+            return list(pool.map(handle, range(clients)))
+
+    async def run_asgi(self, clients):
+        factory = AsyncRequestFactory()
+
+        async def handle():
+            response = await async_views.inbox(self.prepare(factory.get('/inbox')))
+            await asyncio.sleep(self.CLIENT_DELAY)
+            return response.status_code
+
+        return await asyncio.gather(*[handle() for _ in range(clients)])
+
+    def test_throughput(self):
+        print(f"\n{'clients':>8} {'wsgi req/s':>11} {'asgi req/s':>11}")
+
+        for clients in self.CLIENTS:
+            start = time.perf_counter()
+            self.assertEqual(self.run_wsgi(clients), [200] * clients)
+            wsgi = clients / (time.perf_counter() - start)
+
+            start = time.perf_counter()
+            self.assertEqual(asyncio.run(self.run_asgi(clients)), [200] * clients)
+            asgi = clients / (time.perf_counter() - start)
+
+            print(f"{clients:>8} {wsgi:>11.1f} {asgi:>11.1f}")
+
+
+class BenchmarkFragmentCache(TestCase):
+    """
+    Measures how long a full inbox page takes to render with its row fragments
+    cached and uncached.
+    """
+
+    ROWS = 50
+    RENDERS = 20
+
+    def setUp(self):
+        self.sender = CustomUser.objects.create_user(username='bench_sender', email='bench_sender@simpleemail.com')
+        self.user = CustomUser.objects.create_user(username='bench_user', email='bench_user@simpleemail.com')
+        for i in range(self.ROWS):
+            email = Email.objects.create(subject=f'Benchmark {i}', body='Benchmark body')
+            sender = Sender.objects.create(user=self.sender, email=email)
+            recipient = Recipient.objects.create(user=self.user, email=email, is_sent=True)
+            deliver(email, sender, [recipient])
+
+        self.session = SessionStore()
+        self.session['email_session'] = True
+        self.session.save()
+
+    def render_inbox(self):
+        request = RequestFactory().get('/inbox', {'limit': self.ROWS})
+        request.user = self.user
+        request.session = SessionStore(self.session.session_key)
+        request._messages = FallbackStorage(request)
+        return views.inbox(request)
+
+    def test_render(self):
+        fragments = caches['fragments']
+        print(f"\n{'cache':>6} {'ms/page':>8} {'hits':>6} {'misses':>7}")
+
+        for label, warm in [('cold', False), ('warm', True)]:
+            fragments.clear()
+            fragments.reset_stats()
+            if warm:
+                self.render_inbox()
+                fragments.reset_stats()
+
+            start = time.perf_counter()
+            for _ in range(self.RENDERS):
+                if not warm:
+                    fragments.clear()
+                self.assertEqual(self.render_inbox().status_code, 200)
+            elapsed = (time.perf_counter() - start) / self.RENDERS
+
+            stats = fragments.stats()
+            print(f"{label:>6} {elapsed * 1000:>8.2f} {stats['hits']:>6} {stats['misses']:>7}")
+
+
+class BenchmarkPasswordHashing(TestCase):
+    """
+    Measures login throughput against the size of the password hashing pool, with more
+    clients logging in at once than the pool has room for. Clients turned away get a 503
+    straight away instead of waiting on a busy request thread.
+    """
+
+    POOL_SIZES = [1, 2, 4, 8]
+    CLIENTS = 16
+    DURATION = 2.0
+
+    def test_logins_per_second(self):
+        encoded = make_password('benchmark password')
+        print(f"\n{'workers':>8} {'logins/s':>9} {'503s/s':>8}")
+
+        for workers in self.POOL_SIZES:
+            pool = HashingPool(workers, queue=workers)
+            deadline = time.perf_counter() + self.DURATION
+
+            def client():
+                logins = rejected = 0
+                while time.perf_counter() < deadline:
+                    try:
+                        self.assertTrue(pool.run(check_password, 'benchmark password', encoded))
+                        logins += 1
+                    except PoolFull:
+                        rejected += 1
+                        time.sleep(0.01)    # the client waits a moment before trying again
+                return logins, rejected
+
+            with ThreadPoolExecutor(self.CLIENTS) as clients:
+                results = list(clients.map(lambda _: client(), range(self.CLIENTS)))
+            pool.shutdown()
+
+            logins = sum(result[0] for result in results) / self.DURATION
+            rejected = sum(result[1] for result in results) / self.DURATION
+            print(f"{workers:>8} {logins:>9.1f} {rejected:>8.1f}")
+
+
+class BenchmarkListingMemory(TestCase):
+    """
+    Measures the peak memory of loading a page of a mailbox full of large messages, as full email
+    rows (as the folders once did), as email rows with their bodies deferred, and as the mailbox
+    entries the folders read now, with their snippets.
+    """
+
+    ROWS = 50
+    BODY_SIZES = [1024, 64 * 1024, 512 * 1024]
+
+    def setUp(self):
+        self.sender = CustomUser.objects.create_user(username='bench_sender', email='bench_sender@simpleemail.com')
+        self.user = CustomUser.objects.create_user(username='bench_user', email='bench_user@simpleemail.com')
+
+    def fill(self, body_size):
+        Email.objects.all().delete()
+        for i in range(self.ROWS):
+            # bodies stored as text, as before they were compressed (see bodies.py)
+            body = f'Benchmark {i} ' + 'x' * body_size
+            email = Email.objects.create(subject=f'Benchmark {i}', body=body, snippet=body[:120])
+            sender = Sender.objects.create(user=self.sender, email=email)
+            recipient = Recipient.objects.create(user=self.user, email=email, is_sent=True)
+            deliver(email, sender, [recipient])
+
+    def measure(self, load):
+        tracemalloc.start()
+        try:
+            rows = load()
+            return len(rows), tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    def test_peak_memory(self):
+        page = MailboxEntry.objects.filter(user=self.user).values('email')
+        loaders = [
+            ('full rows', lambda: list(Email.objects.filter(uid__in=page))),
+            ('deferred', lambda: list(Email.objects.filter(uid__in=page).defer(*BODY_FIELDS))),
+            ('entries', lambda: load_inbox(self.user, limit=self.ROWS)[0]),
+        ]
+        print(f"\n{'body bytes':>10} " + ' '.join(f"{label + ' KiB':>14}" for label, _ in loaders))
+
+        for body_size in self.BODY_SIZES:
+            self.fill(body_size)
+            peaks = []
+            for _, load in loaders:
+                count, peak = self.measure(load)
+                self.assertEqual(count, self.ROWS)
+                peaks.append(peak)
+            print(f"{body_size:>10} " + ' '.join(f"{peak / 1024:>14.1f}" for peak in peaks))
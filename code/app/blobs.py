@@ -0,0 +1,160 @@
+"""
+Reference counting and garbage collection for attachment blobs.
+Attachments retain their blob when they're created and release it when they're
+deleted (see signals.py), and collect_garbage() removes blobs nothing refers to.
+"""
+
+import os
+import time
+
+from django.db.models import F
+
+from .models import Attachment, Blob
+from .storage import BLOB_DIR, TEMP_DIR, BLOB_HASH, blob_hash, blob_name
+
+# blobs must go unused for this many seconds before they're removed
+GRACE_PERIOD = 60 * 60
+
+# attachment fields whose files are stored as blobs
+BLOB_FIELDS = ('file', 'image', 'thumbnail')
+
+
+def get_storage():
+    """
+    Returns the storage attachment blobs are kept in.
+    """
+
+    return Attachment._meta.get_field('file').storage
+
+
+def blob_names(attachment):
+    """
+    Returns the names of every file stored for an attachment, in BLOB_FIELDS order.
+    """
+
+    return [getattr(attachment, field).name for field in BLOB_FIELDS]
+
+
+def adjust(file_names, delta):
+    """
+    Adds delta to the reference count of the blob behind each of the given file names.
+    Files that aren't blobs are ignored.
+    """
+
+    names = {}
+    counts = {}
+    for name in file_names:
+        sha256 = blob_hash(name)
+        if sha256 is not None:
+            names[sha256] = name
+            counts[sha256] = counts.get(sha256, 0) + delta
+    if not counts:
+        return
+
+    # make sure every blob has a row to update
+    if delta > 0:
+        storage = get_storage()
+        Blob.objects.bulk_create([
+            Blob(sha256=sha256, size=storage.size(name)) for sha256, name in names.items()
+        ], ignore_conflicts=True)
+
+    # update blobs referenced the same number of times together
+    groups = {}
+    for sha256, count in counts.items():
+        groups.setdefault(count, []).append(sha256)
+    for count, hashes in groups.items():
+        Blob.objects.filter(sha256__in=hashes).update(refcount=F('refcount') + count)
+
+
+def retain(names):
+    """
+    Records that new attachments refer to the given files.
+    """
+
+    adjust(names, 1)
+
+
+def release(names):
+    """
+    Records that attachments referring to the given files are gone.
+    """
+
+    adjust(names, -1)
+
+
+def remove_file(path, cutoff):
+    """
+    Removes a blob's file unless it was used since the cutoff time. Returns whether it was removed.
+    The file is moved aside before it's checked, so a concurrent upload of the same content
+    either finds it missing and writes it again, or has already touched it and gets it back.
+    """
+
+    tombstone = f"{path}.deleting"
+    try:
+        os.rename(path, tombstone)
+    except FileNotFoundError:
+        return False
+
+    if os.stat(tombstone).st_mtime >= cutoff:
+        os.replace(tombstone, path)
+        return False
+
+    os.remove(tombstone)
+    return True
+
+
+def collect_garbage(batch_size=500, grace_period=GRACE_PERIOD):
+    """
+    Removes every blob that no attachment refers to, along with any stray files left in
+    blob storage by interrupted uploads. Blobs and files are processed in batches so memory
+    use stays bounded. Returns the number of files removed.
+    """
+
+    storage = get_storage()
+    cutoff = time.time() - grace_period
+    removed = 0
+
+    # drop unreferenced blobs
+    last_hash = ''
+    while True:
+        hashes = list(Blob.objects.filter(refcount__lte=0, sha256__gt=last_hash).order_by('sha256').values_list(
+            'sha256', flat=True)[:batch_size])
+        if not hashes:
+            break
+        last_hash = hashes[-1]
+
+        # only remove the files of blobs that are still unreferenced once their rows are gone
+        Blob.objects.filter(sha256__in=hashes, refcount__lte=0).delete()
+        alive = set(Blob.objects.filter(sha256__in=hashes).values_list('sha256', flat=True))
+        for sha256 in hashes:
+            if sha256 not in alive:
+                removed += remove_file(storage.path(blob_name(sha256)), cutoff)
+
+    # sweep the blob directories for files without a row
+    def sweep(paths):
+        known = set(Blob.objects.filter(sha256__in=list(paths)).values_list('sha256', flat=True))
+        return sum(remove_file(path, cutoff) for sha256, path in paths.items() if sha256 not in known)
+
+    root = storage.path(BLOB_DIR)
+    temp_dir = storage.path(TEMP_DIR)
+    unknown = {}
+    for directory, _, files in os.walk(root):
+        for file in files:
+            path = os.path.join(directory, file)
+            if directory == temp_dir or not BLOB_HASH.match(file):
+                # leftovers of interrupted uploads and removals
+                if os.stat(path).st_mtime < cutoff:
+                    os.remove(path)
+                    removed += 1
+                continue
+
+            if os.stat(path).st_mtime < cutoff:
+                unknown[file] = path
+            if len(unknown) >= batch_size:
+                removed += sweep(unknown)
+                unknown = {}
+
+    if unknown:
+        removed += sweep(unknown)
+
+    return removed
@@ -0,0 +1,167 @@
+"""
+Tiered storage for email bodies.
+Short bodies are kept as text in the email table. Bodies over EMAIL_BODY_COMPRESS_THRESHOLD
+bytes are kept zlib-compressed instead, and bodies over EMAIL_BODY_BLOB_THRESHOLD bytes are
+compressed into a blob file (see storage.py), so forwarding one again reuses the same file.
+Bodies stay compressed until get_body() is called to show them, and blob files are read
+through mmap rather than copied into memory first.
+"""
+
+import mmap
+import zlib
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.utils.html import strip_tags
+
+from .blobs import retain
+from .models import ArchivedBody, Email
+from .shards import current_alias
+
+# email fields holding the body, in whichever form it's stored
+BODY_FIELDS = ('body', 'body_data', 'body_file')
+
+COMPRESSION_LEVEL = 6
+
+# number of characters of the body shown in listings
+SNIPPET_LENGTH = 120
+
+# number of emails converted per transaction
+BATCH_SIZE = 500
+
+
+def compress_body(body, level=COMPRESSION_LEVEL):
+    return zlib.compress(body.encode(), level)
+
+
+def decompress_body(data):
+    return zlib.decompress(data).decode()
+
+
+def make_snippet(body):
+    """
+    Returns the start of a body as a single line of plain text, for listings.
+    """
+
+    text = ' '.join(strip_tags(body or '').split())
+    if len(text) <= SNIPPET_LENGTH:
+        return text
+    return text[:SNIPPET_LENGTH - 3].rstrip() + '...'
+
+
+def get_body_storage():
+    """
+    Returns the storage body blobs are kept in.
+    """
+
+    return Email._meta.get_field('body_file').storage
+
+
+def pack_body(body):
+    """
+    Stores a body in the form its size calls for, returning the email fields to save as a dict.
+    Blob files are written right away, and only count as used once the email is saved.
+    """
+
+    fields = dict.fromkeys(BODY_FIELDS)
+    fields['body'] = body
+    raw = body.encode() if body is not None else b''
+    if len(raw) <= getattr(settings, 'EMAIL_BODY_COMPRESS_THRESHOLD', 4 * 1024):
+        return fields
+
+    data = zlib.compress(raw, COMPRESSION_LEVEL)
+    if len(data) >= len(raw):
+        return fields    # the body doesn't compress, so keep it readable
+
+    fields['body'] = None
+    if len(raw) > getattr(settings, 'EMAIL_BODY_BLOB_THRESHOLD', 256 * 1024):
+        fields['body_file'] = get_body_storage().save('body', ContentFile(data))
+    else:
+        fields['body_data'] = data
+    return fields
+
+
+def read_body_file(name):
+    """
+    Decompresses a body blob, reading it through a memory map.
+    """
+
+    with open(get_body_storage().path(name), 'rb') as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return decompress_body(data)
+
+
+def unpack_body(email):
+    """
+    Returns the body stored on an email row, or None if it was moved to the archive.
+    """
+
+    if email.body is not None:
+        return email.body
+    if email.body_data is not None:
+        return decompress_body(email.body_data)
+    if email.body_file:
+        return read_body_file(email.body_file.name)
+    return None
+
+
+def get_body(email):
+    """
+    Returns an email's body, wherever it's stored.
+    """
+
+    body = unpack_body(email)
+    if body is not None:
+        return body
+
+    # the body may have been moved to the archive (see archiving.py)
+    data = ArchivedBody.objects.filter(email=email).values_list('body', flat=True).first()
+    return decompress_body(data) if data is not None else None
+
+
+def get_bodies(emails):
+    """
+    Returns the bodies of a batch of emails as {uid: body}, looking up archived ones in a single query.
+    """
+
+    bodies = {email.uid: unpack_body(email) for email in emails}
+    archived = [uid for uid, body in bodies.items() if body is None]
+    if archived:
+        for uid, data in ArchivedBody.objects.filter(email__in=archived).values_list('email', 'body'):
+            bodies[uid] = decompress_body(data)
+    return bodies
+
+
+def pack_bodies(batch_size=BATCH_SIZE):
+    """
+    Moves the text bodies of the emails on the current shard that are over the compression threshold
+    into compressed or blob storage, a batch at a time. Returns the number of bodies moved.
+    """
+
+    packed = 0
+    last_uid = None
+    while True:
+        # fetch the next batch of emails with text bodies
+        emails = Email.objects.filter(body__isnull=False).order_by('uid').only('uid', *BODY_FIELDS)
+        if last_uid is not None:
+            emails = emails.filter(uid__gt=last_uid)
+        emails = list(emails[:batch_size])
+        if not emails:
+            return packed
+        last_uid = emails[-1].uid
+
+        changed = []
+        for email in emails:
+            fields = pack_body(email.body)
+            if fields['body'] is None:
+                for field, value in fields.items():
+                    setattr(email, field, value)
+                changed.append(email)
+        if not changed:
+            continue
+
+        with transaction.atomic(using=current_alias()):
+            Email.objects.bulk_update(changed, BODY_FIELDS)
+            retain([email.body_file.name for email in changed if email.body_file])
+        packed += len(changed)
@@ -0,0 +1,152 @@
+"""
+Cache backend that wraps another backend and counts its hits and misses.
+The template fragment cache (the 'fragments' alias in settings.CACHES) uses it, so the
+backend underneath can be swapped (locmem, file, Redis) while its hit rate stays visible.
+Counts are kept for the process and for the current request, which the middleware here
+reports in the X-Fragment-Cache response header.
+"""
+
+import threading
+from asyncio import iscoroutinefunction
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+from django.utils.decorators import sync_and_async_middleware
+from django.utils.module_loading import import_string
+
+# hits and misses of the current request, when it's being counted
+request_stats = ContextVar('request_stats', default=None)
+
+# marks a missing key, so cached None values still count as hits
+MISSING = object()
+
+
+class StatsCache(BaseCache):
+    """
+    Counts the hits and misses of the backend given by OPTIONS['CACHE'], a cache config
+    of its own, and passes everything else through to it.
+    """
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        config = params.get('OPTIONS', {})['CACHE']
+        self.cache = import_string(config['BACKEND'])(config.get('LOCATION', location), config)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def record(self, hits, misses):
+        with self.lock:
+            self.hits += hits
+            self.misses += misses
+
+        stats = request_stats.get()
+        if stats is not None:
+            stats['hits'] += hits
+            stats['misses'] += misses
+
+    def stats(self):
+        """
+        Returns the hits and misses counted by this process, and the hit rate.
+        """
+
+        with self.lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / total if total else 0.0}
+
+    def reset_stats(self):
+        with self.lock:
+            self.hits = 0
+            self.misses = 0
+
+    def get(self, key, default=None, version=None):
+        value = self.cache.get(key, MISSING, version=version)
+        if value is MISSING:
+            self.record(0, 1)
+            return default
+
+        self.record(1, 0)
+        return value
+
+    def get_many(self, keys, version=None):
+        keys = list(keys)
+        values = self.cache.get_many(keys, version=version)
+        self.record(len(values), len(keys) - len(values))
+        return values
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        return self.cache.add(key, value, self.pass_timeout(timeout), version=version)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self.cache.set(key, value, self.pass_timeout(timeout), version=version)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        return self.cache.set_many(data, self.pass_timeout(timeout), version=version)
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        return self.cache.touch(key, self.pass_timeout(timeout), version=version)
+
+    def pass_timeout(self, timeout):
+        # fall back to this cache's default timeout, not the wrapped backend's
+        return self.default_timeout if timeout is DEFAULT_TIMEOUT else timeout
+
+    def delete(self, key, version=None):
+        return self.cache.delete(key, version=version)
+
+    def delete_many(self, keys, version=None):
+        return self.cache.delete_many(keys, version=version)
+
+    def has_key(self, key, version=None):
+        return self.cache.has_key(key, version=version)
+
+    def incr(self, key, delta=1, version=None):
+        return self.cache.incr(key, delta, version=version)
+
+    def clear(self):
+        return self.cache.clear()
+
+    def close(self, **kwargs):
+        return self.cache.close(**kwargs)
+
+
+def stats_header(stats):
+    return f"hits={stats['hits']}, misses={stats['misses']}"
+
+
+@sync_and_async_middleware
+def cache_stats_middleware(get_response):
+    """
+    Reports each request's fragment cache hits and misses in the X-Fragment-Cache
+    response header, when FRAGMENT_CACHE_STATS is set.
+    """
+
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            if not getattr(settings, 'FRAGMENT_CACHE_STATS', False):
+                return await get_response(request)
+
+            stats = {'hits': 0, 'misses': 0}
+            token = request_stats.set(stats)
+            try:
+                response = await get_response(request)
+            finally:
+                request_stats.reset(token)
+            response['X-Fragment-Cache'] = stats_header(stats)
+            return response
+
+    else:
+        def middleware(request):
+            if not getattr(settings, 'FRAGMENT_CACHE_STATS', False):
+                return get_response(request)
+
+            stats = {'hits': 0, 'misses': 0}
+            token = request_stats.set(stats)
+            try:
+                response = get_response(request)
+            finally:
+                request_stats.reset(token)
+            response['X-Fragment-Cache'] = stats_header(stats)
+            return response
+
+    return middleware
@@ -0,0 +1,102 @@
+"""
+Conditional GET support (ETag, Last-Modified, 304 Not Modified) for the mailbox and note pages.
+Folder pages are validated by the user's mailbox version, which is bumped whenever anything
+they show changes and is read from their counter row (loaded once per request), so a repeat view of an unchanged page
+is answered without querying the email or note tables. They have no Last-Modified date, since
+two changes within the same second would share one. Sent emails and notes never
+change once written, so their pages only depend on the version of the mailbox around them.
+"""
+
+import hashlib
+from functools import wraps
+
+from django.contrib.messages import get_messages
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
+
+from .counters import request_counter
+
+
+def page_etag(request, *parts):
+    """
+    Returns an ETag for the requested page as seen by the logged in user, varying with the given parts.
+    The session key is included, since logging in again also changes the CSRF tokens in the page's forms.
+    """
+
+    key = '\n'.join([
+        str(request.user.pk),
+        request.session.session_key or '',
+        request.get_full_path(),
+        *[str(part) for part in parts],
+    ])
+    return f'"{hashlib.sha256(key.encode()).hexdigest()[:32]}"'
+
+
+def mailbox_validators(request, *args, **kwargs):
+    """
+    Returns the (ETag, last modified timestamp) of a page showing the user's mailbox.
+    """
+
+    return page_etag(request, request_counter(request)['version']), None
+
+
+def immutable_validators(request, *args, **kwargs):
+    """
+    Returns the (ETag, last modified timestamp) of a page that never changes, such as a note.
+    """
+
+    return page_etag(request), None
+
+
+def check_not_modified(request, validators, *args, **kwargs):
+    """
+    Returns a 304 Not Modified response if the client's copy of the page is still current, or None.
+    Pages are always rendered while there are messages waiting to be shown on them.
+    """
+
+    if request.method not in ('GET', 'HEAD') or len(get_messages(request)):
+        return None
+
+    etag, last_modified = validators(request, *args, **kwargs)
+    return get_conditional_response(request, etag=etag, last_modified=last_modified)
+
+
+def set_validators(response, request, validators, *args, **kwargs):
+    """
+    Adds the page's current validators to a rendered response, so the client can revalidate it.
+    They're computed after the view runs, since viewing a page can change it (e.g. marking an email read).
+    """
+
+    if request.method not in ('GET', 'HEAD') or response.status_code != 200:
+        return response
+
+    etag, last_modified = validators(request, *args, **kwargs)
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+
+    # the browser must check back with us before reusing its copy
+    patch_cache_control(response, private=True, no_cache=True)
+    patch_vary_headers(response, ('Cookie',))
+    return response
+
+
+def conditional_page(validators):
+    """
+    Decorator answering GETs of a page with 304 Not Modified while the client's copy is current.
+    validators is called with the view's arguments and returns the page's (ETag, last modified timestamp).
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def checker(request, *args, **kwargs):
+            not_modified = check_not_modified(request, validators, *args, **kwargs)
+            if not_modified is not None:
+                return not_modified
+
+            response = view(request, *args, **kwargs)
+            return set_validators(response, request, validators, *args, **kwargs)
+
+        return checker
+
+    return decorator
@@ -0,0 +1,16 @@
+from django.utils.functional import SimpleLazyObject
+
+from .counters import COUNTER_FIELDS, request_counter
+
+
+def mailbox_counters(request):
+    """
+    Adds the logged in user's folder counters to every template context.
+    The counters are only fetched if a template actually uses them, and share the request's counter row.
+    """
+
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_authenticated:
+        return {}
+
+    return {'counters': SimpleLazyObject(lambda: {field: request_counter(request)[field] for field in COUNTER_FIELDS})}
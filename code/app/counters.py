@@ -0,0 +1,216 @@
+"""
+Per-user unread and folder counters.
+Counters are stored in the MailboxCounter table and adjusted atomically with F()
+expressions whenever mail is sent, read, or archived. Each adjustment also bumps the
+user's mailbox version, which validates their cached pages. Counters are read in O(1)
+from the shared 'counters' cache, or from the row itself (a primary key lookup) when it
+isn't configured, and at most once per request.
+"""
+
+from contextvars import ContextVar
+
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import Count, F, Q
+from django.utils import timezone
+
+from .events import publish_on_commit
+from .models import CustomUser, MailboxCounter, MailboxEntry
+from .shards import current_alias, local_users, shard_for
+
+COUNTER_FIELDS = ('unread', 'inbox', 'outbox', 'drafts')
+VERSION_FIELDS = ('version', 'changed_at')
+
+# number of users whose counters are updated per query
+BATCH_SIZE = 500
+
+# bumped by every adjustment, so counters loaded earlier in the same request are reloaded
+adjustments = ContextVar('counter_adjustments', default=0)
+
+
+def cache_key(user_id):
+    """
+    Returns the cache key holding a user's counters.
+    """
+
+    return f"mailbox_counters:{user_id}"
+
+
+def invalidate(user_ids):
+    """
+    Drops the cached counters of the given users, both now and once the current transaction commits.
+    """
+
+    keys = [cache_key(user_id) for user_id in user_ids]
+    caches['counters'].delete_many(keys)
+    transaction.on_commit(lambda: caches['counters'].delete_many(keys), using=current_alias())
+
+
+def adjust(user_ids, **deltas):
+    """
+    Atomically adds the given deltas (e.g. inbox=1, unread=1) to each user's counters,
+    and pushes the changes to their open pages once the transaction commits.
+    Every user's mailbox version is bumped, even without deltas.
+    """
+
+    user_ids = list(user_ids)
+    changed_at = timezone.now()
+    for start in range(0, len(user_ids), BATCH_SIZE):
+        batch = user_ids[start:start + BATCH_SIZE]
+
+        # make sure every user has a counter row to update
+        MailboxCounter.objects.bulk_create(
+            [MailboxCounter(user_id=user_id) for user_id in batch],
+            ignore_conflicts=True
+        )
+
+        MailboxCounter.objects.filter(user__in=batch).update(
+            version=F('version') + 1,
+            changed_at=changed_at,
+            **{field: F(field) + delta for field, delta in deltas.items()}
+        )
+        invalidate(batch)
+        if deltas:
+            publish_on_commit([(user_id, 'counters', deltas) for user_id in batch])
+    adjustments.set(adjustments.get() + 1)
+
+
+def touch(user_ids):
+    """
+    Bumps the mailbox version of each user whose pages changed without changing their counters.
+    """
+
+    adjust(user_ids)
+
+
+def count_entries(entries, sign=1):
+    """
+    Adjusts counters for a batch of newly delivered mailbox entries, or for entries leaving
+    the mailbox with a sign of -1. Users with the same changes are updated together in a single query.
+    Returns the ids of the users whose counters changed.
+    """
+
+    # total up the changes to each user's counters
+    deltas = {}
+    for entry in entries:
+        user_deltas = deltas.setdefault(entry.user_id, dict.fromkeys(COUNTER_FIELDS, 0))
+        if entry.folder == MailboxEntry.INBOX and not entry.is_archived:
+            user_deltas['inbox'] += sign
+            user_deltas['unread'] += sign * (not entry.is_read)
+        elif entry.folder == MailboxEntry.OUTBOX:
+            user_deltas['outbox'] += sign
+        elif entry.folder == MailboxEntry.DRAFTS:
+            user_deltas['drafts'] += sign
+
+    # group users whose counters change in the same way
+    groups = {}
+    for user_id, user_deltas in deltas.items():
+        changes = tuple((field, delta) for field, delta in user_deltas.items() if delta)
+        if changes:
+            groups.setdefault(changes, []).append(user_id)
+
+    for changes, user_ids in groups.items():
+        adjust(user_ids, **dict(changes))
+    return {user_id for user_ids in groups.values() for user_id in user_ids}
+
+
+def load_counter(user):
+    """
+    Returns a dict of the user's counter row, from the cache when possible.
+    """
+
+    key = cache_key(user.pk)
+    counter = caches['counters'].get(key)
+    if counter is None:
+        # counters validate pages for everyone, so they're read from the user's shard rather than a lagging replica
+        counter = MailboxCounter.objects.using(shard_for(user)).filter(user=user).values(
+            *COUNTER_FIELDS, *VERSION_FIELDS
+        ).first()
+        counter = counter or {**dict.fromkeys(COUNTER_FIELDS, 0), 'version': 0, 'changed_at': None}
+        caches['counters'].set(key, counter)
+
+    return counter
+
+
+def request_counter(request):
+    """
+    Returns the logged in user's counter row, loaded once per request and shared by the page's
+    validators, its nav bar, and the replica router. It's reloaded if the request changed any counters.
+    """
+
+    loaded = getattr(request, '_mailbox_counter', None)
+    if loaded is None or loaded[0] != adjustments.get():
+        loaded = request._mailbox_counter = (adjustments.get(), load_counter(request.user))
+    return loaded[1]
+
+
+def get_counts(user):
+    """
+    Returns a dict of the user's counters, from the cache when possible.
+    """
+
+    counter = load_counter(user)
+    return {field: counter[field] for field in COUNTER_FIELDS}
+
+
+def compute_counts(entries):
+    """
+    Annotates a queryset of mailbox entries grouped by user with that user's true counters.
+    """
+
+    inbox = Q(folder=MailboxEntry.INBOX, is_archived=False)
+    return entries.values('user').annotate(
+        unread=Count('uid', filter=inbox & Q(is_read=False)),
+        inbox=Count('uid', filter=inbox),
+        outbox=Count('uid', filter=Q(folder=MailboxEntry.OUTBOX)),
+        drafts=Count('uid', filter=Q(folder=MailboxEntry.DRAFTS)),
+    ).order_by('user')
+
+
+def recount(user_ids):
+    """
+    Stores the true counters of the given users on the current shard, computed from their mailbox entries.
+    """
+
+    actual = {row.pop('user'): row for row in compute_counts(MailboxEntry.objects.filter(user__in=user_ids))}
+    for user_id in user_ids:
+        MailboxCounter.objects.update_or_create(user_id=user_id, defaults=actual.get(
+            user_id, dict.fromkeys(COUNTER_FIELDS, 0)))
+    touch(user_ids)
+
+
+def reconcile(batch_size=500):
+    """
+    Recomputes the counters of every user on the current shard from their mailbox entries and repairs any that drifted.
+    Users are processed in batches. Returns the number of counters repaired.
+    """
+
+    repaired = 0
+    last_id = 0
+    while True:
+        # fetch the next batch of users
+        user_ids = list(
+            CustomUser.objects.filter(pk__gt=last_id).order_by('pk').values_list('pk', flat=True)[:batch_size]
+        )
+        if not user_ids:
+            return repaired
+        last_id = user_ids[-1]
+
+        # only users whose mail is on the current shard have counters here
+        local = local_users(user_ids)
+        if local is not None:
+            user_ids = [user_id for user_id in user_ids if user_id in local]
+
+        # compare the stored counters against the true ones
+        actual = {row.pop('user'): row for row in compute_counts(MailboxEntry.objects.filter(user__in=user_ids))}
+        stored = {row.pop('user'): row for row in MailboxCounter.objects.filter(user__in=user_ids).values(
+            'user', *COUNTER_FIELDS)}
+
+        for user_id in user_ids:
+            counts = actual.get(user_id, dict.fromkeys(COUNTER_FIELDS, 0))
+            if stored.get(user_id, dict.fromkeys(COUNTER_FIELDS, 0)) == counts:
+                continue    # this user's counters are correct
+
+            MailboxCounter.objects.update_or_create(user_id=user_id, defaults=counts)
+            touch([user_id])
+            repaired += 1
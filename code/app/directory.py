@@ -0,0 +1,230 @@
+"""
+In-memory directory of user email addresses, used to validate recipients.
+A Bloom filter of every address rejects unknown recipients without touching the
+database, and an LRU cache maps known addresses to user ids. Both are kept up to
+date by CustomUser signals (see signals.py), and a generation number stored in the
+database tells other processes when their copy is stale and must be rebuilt. It's
+checked before an address is rejected, so a user added by another process is never
+turned away.
+"""
+
+import math
+import threading
+from collections import OrderedDict
+from hashlib import blake2b
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from .models import CustomUser, Generation
+
+GENERATION_NAME = 'address_directory'
+
+# number of addresses looked up per query on a cache miss
+BATCH_SIZE = 500
+
+
+class BloomFilter:
+    """
+    Probabilistic set of strings with no false negatives.
+    Sized for the given capacity and false positive rate.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = max(capacity, 1)
+        self.size = math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hash_count = max(1, round(self.size / self.capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        # derive every position from two halves of one digest (double hashing)
+        digest = blake2b(key.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * second) % self.size for i in range(self.hash_count)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class LRUCache:
+    """
+    Bounded mapping that evicts its least recently used key when full.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.data = OrderedDict()
+
+    def get(self, key):
+        value = self.data.get(key)
+        if value is not None:
+            self.data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        if len(self.data) > self.max_size:
+            self.data.popitem(last=False)
+
+    def pop(self, key):
+        return self.data.pop(key, None)
+
+    def __len__(self):
+        return len(self.data)
+
+
+def bump_generation():
+    """
+    Marks every process's directory as stale. Returns the new generation.
+    """
+
+    generations = Generation.objects.filter(name=GENERATION_NAME)
+    with transaction.atomic():
+        if not generations.update(value=F('value') + 1):
+            try:
+                with transaction.atomic():
+                    Generation.objects.create(name=GENERATION_NAME, value=1)
+            except IntegrityError:
+                generations.update(value=F('value') + 1)    # another process created it first
+        return generations.values_list('value', flat=True).get()
+
+
+def current_generation():
+    """
+    Returns the current directory generation shared by every process.
+    """
+
+    return Generation.objects.filter(name=GENERATION_NAME).values_list('value', flat=True).first() or 0
+
+
+class AddressDirectory:
+    """
+    Resolves email addresses to user ids, avoiding the database wherever possible.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.cache = LRUCache(getattr(settings, 'ADDRESS_DIRECTORY_CACHE_SIZE', 10000))
+        self.bloom = None
+        self.generation = None
+
+    def clear(self):
+        """
+        Drops everything in the directory so that it is rebuilt on next use.
+        """
+
+        with self.lock:
+            self.cache = LRUCache(self.cache.max_size)
+            self.bloom = None
+            self.generation = None
+
+    def _refresh(self, generation=None):
+        """
+        Rebuilds the Bloom filter if it's missing or over capacity, or older than the given generation.
+        Returns whether it was rebuilt.
+        """
+
+        if self.bloom is not None and self.bloom.count <= self.bloom.capacity:
+            if generation is None or generation == self.generation:
+                return False
+
+        if generation is None:
+            generation = current_generation()
+        addresses = list(CustomUser.objects.exclude(email='').values_list('email', flat=True).iterator())
+        bloom = BloomFilter(max(2 * len(addresses), 1024))
+        for address in addresses:
+            bloom.add(address)
+
+        if self.generation != generation:
+            # other processes may have changed addresses we have cached
+            self.cache = LRUCache(self.cache.max_size)
+        self.bloom = bloom
+        self.generation = generation
+        return True
+
+    def _lookup(self, addresses):
+        """
+        Sorts addresses into those the Bloom filter rules out, those cached with their user ids, and the rest.
+        """
+
+        unknown, found, missing = [], {}, []
+        for address in addresses:
+            if address not in self.bloom:
+                unknown.append(address)
+                continue
+            user_id = self.cache.get(address)
+            if user_id is None:
+                missing.append(address)
+            else:
+                found[address] = user_id
+        return unknown, found, missing
+
+    def resolve(self, addresses):
+        """
+        Returns a dict mapping each of the given addresses that belongs to a user to that user's id.
+        Addresses missing from the result don't belong to anybody.
+        """
+
+        with self.lock:
+            self._refresh()
+            unknown, found, missing = self._lookup(addresses)
+
+            # before rejecting addresses or going to the DB anyway, make sure no other process has added them
+            if (unknown or missing) and self._refresh(current_generation()):
+                unknown, found, missing = self._lookup(addresses)
+
+        # look up any remaining addresses in the DB, lowest id first for repeated addresses
+        for start in range(0, len(missing), BATCH_SIZE):
+            batch = missing[start:start + BATCH_SIZE]
+            for address, user_id in CustomUser.objects.filter(email__in=batch).order_by('pk').values_list('email', 'pk'):
+                if address not in found:
+                    found[address] = user_id
+                    with self.lock:
+                        self.cache.set(address, user_id)
+
+        return found
+
+    def _bumped(self, generation):
+        """
+        Keeps this process's directory current after it bumped the generation, if it was current before.
+        """
+
+        if self.bloom is not None and self.generation == generation - 1:
+            self.generation = generation
+
+    def user_saved(self, user, old_address):
+        """
+        Records that a user was created or changed their address.
+        """
+
+        with self.lock:
+            if old_address and old_address != user.email:
+                self.cache.pop(old_address)
+            if user.email:
+                self.cache.set(user.email, user.pk)
+                if self.bloom is not None:
+                    self.bloom.add(user.email)
+
+            # let other processes know, without making this one rebuild unless it missed another change
+            self._bumped(bump_generation())
+
+    def user_deleted(self, user):
+        """
+        Records that a user was deleted.
+        """
+
+        with self.lock:
+            self.cache.pop(user.email)
+            self._bumped(bump_generation())
+
+
+directory = AddressDirectory()
@@ -0,0 +1,159 @@
+"""
+Serves stored files to the browser with support for conditional and Range requests.
+Files are streamed from disk a chunk at a time, or handed off to the front proxy with
+X-Accel-Redirect (nginx) or X-Sendfile (Apache, lighttpd) when ATTACHMENT_SENDFILE is set,
+so Python workers never hold a large file in memory.
+"""
+
+import hashlib
+import mimetypes
+import os
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.http import http_date, parse_etags
+
+from .storage import blob_hash
+
+# size of each chunk read from disk when streaming part of a file
+CHUNK_SIZE = 64 * 1024
+
+RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+X_ACCEL_REDIRECT = 'x-accel-redirect'
+X_SENDFILE = 'x-sendfile'
+
+
+def file_etag(name, stat):
+    """
+    Returns a strong ETag for a stored file.
+    Blobs are named after the hash of their content, so their hash is used directly.
+    """
+
+    sha256 = blob_hash(name)
+    if sha256 is None:
+        sha256 = hashlib.sha256(f"{name}:{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()
+    return f'"{sha256}"'
+
+
+def content_disposition(filename, as_attachment=True):
+    """
+    Returns the Content-Disposition header for a file with the given name, which makes
+    the browser download it, or show it in the page if as_attachment is False.
+    """
+
+    disposition = 'attachment' if as_attachment else 'inline'
+    try:
+        filename.encode('ascii')
+        return '{}; filename="{}"'.format(disposition, filename.replace('\\', '\\\\').replace('"', r'\"'))
+    except UnicodeEncodeError:
+        return f"{disposition}; filename*=utf-8''{quote(filename)}"
+
+
+def parse_range(header, size):
+    """
+    Parses a Range header into the (start, end) of the requested bytes, inclusive.
+    Returns None to serve the whole file, for missing or multi-part ranges,
+    or raises ValueError if the range can't be satisfied.
+    """
+
+    match = RANGE.match(header.strip()) if header else None
+    if match is None:
+        return None
+
+    start, end = match.groups()
+    if not start and not end:
+        return None
+    if not start:
+        # suffix range: the last N bytes
+        length = int(end)
+        if length == 0:
+            raise ValueError(header)
+        return max(size - length, 0), size - 1
+
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        raise ValueError(header)
+    return start, end
+
+
+def read_range(path, start, length):
+    """
+    Yields the given byte range of a file, a chunk at a time.
+    """
+
+    with open(path, 'rb') as file:
+        file.seek(start)
+        while length > 0:
+            chunk = file.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def serve_file(request, storage, name, filename, as_attachment=True):
+    """
+    Returns a response serving a stored file named filename, as a download unless as_attachment is False.
+    Handles If-None-Match, If-Range, and single-part Range requests. Raises Http404 if the file is missing.
+    """
+
+    path = storage.path(name)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        raise Http404("File not found")
+    etag = file_etag(name, stat)
+    size = stat.st_size
+
+    # the browser already has this file
+    if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
+
+    # hand the file off to the front proxy, which handles ranges itself
+    sendfile = getattr(settings, 'ATTACHMENT_SENDFILE', None)
+    if sendfile is not None:
+        response = HttpResponse(content_type=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        if sendfile == X_ACCEL_REDIRECT:
+            response['X-Accel-Redirect'] = quote(getattr(settings, 'ATTACHMENT_ACCEL_PREFIX', '/protected/') + name)
+        elif sendfile == X_SENDFILE:
+            response['X-Sendfile'] = path
+        else:
+            raise ValueError(f"Unknown ATTACHMENT_SENDFILE: {sendfile}")
+
+    else:
+        # only honour ranges of the current version of the file
+        byte_range = None
+        if_range = request.META.get('HTTP_IF_RANGE')
+        if if_range is None or if_range == etag:
+            try:
+                byte_range = parse_range(request.META.get('HTTP_RANGE'), size)
+            except ValueError:
+                response = HttpResponse(status=416)
+                response['Content-Range'] = f"bytes */{size}"
+                return response
+
+        if byte_range is None:
+            # FileResponse lets the server send the file with zero-copy sendfile when it can
+            response = FileResponse(open(path, 'rb'), as_attachment=as_attachment, filename=filename)
+        else:
+            start, end = byte_range
+            response = StreamingHttpResponse(
+                read_range(path, start, end - start + 1),
+                status=206,
+                content_type=mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            )
+            response['Content-Length'] = end - start + 1
+            response['Content-Range'] = f"bytes {start}-{end}/{size}"
+
+    response['Content-Disposition'] = content_disposition(filename, as_attachment)
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(stat.st_mtime)
+    response['Cache-Control'] = 'private, max-age=3600'
+    return response
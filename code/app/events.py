@@ -0,0 +1,296 @@
+"""
+Pushes new mail and counter changes to browsers with Server-Sent Events.
+Events are published once the transaction that caused them commits. An in-process
+broker hands them to the event streams open in this process, and a relay passes them
+on to the other worker processes on this machine over Unix datagram sockets, a local
+stand-in for a shared pub/sub service. The stream itself is a plain ASGI application
+mounted next to Django in project/asgi.py, since it holds its connection open.
+"""
+
+import asyncio
+import json
+import os
+import socket
+import threading
+from importlib import import_module
+from types import SimpleNamespace
+from uuid import uuid4
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.db import transaction
+from django.utils import dateformat, timezone
+
+from .shards import current_alias
+
+# path the event stream is served at
+EVENTS_PATH = '/events'
+
+# events kept for each stream before a slow client starts missing them
+QUEUE_SIZE = 100
+
+# seconds between keepalive comments on an idle stream
+HEARTBEAT = 15
+
+# events sent per datagram to other workers
+DATAGRAM_BATCH = 100
+MAX_DATAGRAM = 256 * 1024
+
+# longest subject sent in a new message event
+SUBJECT_LENGTH = 200
+
+
+def offer(queue, message):
+    """
+    Adds a message to a stream's queue. Slow streams miss events rather than holding up the rest.
+    """
+
+    try:
+        queue.put_nowait(message)
+    except asyncio.QueueFull:
+        pass
+
+
+class Broker:
+    """
+    In-process pub/sub of events by user id.
+    Subscribers are asyncio queues, and events may be dispatched from any thread.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = {}
+
+    def subscribe(self, user_id):
+        queue = asyncio.Queue(QUEUE_SIZE)
+        with self.lock:
+            self.subscribers.setdefault(user_id, set()).add((asyncio.get_running_loop(), queue))
+        return queue
+
+    def unsubscribe(self, user_id, queue):
+        with self.lock:
+            subscribers = self.subscribers.get(user_id, set())
+            subscribers.difference_update({(loop, q) for loop, q in subscribers if q is queue})
+            if not subscribers:
+                self.subscribers.pop(user_id, None)
+
+    def dispatch(self, messages):
+        """
+        Delivers (user id, event, data) messages to this process's subscribers.
+        """
+
+        with self.lock:
+            targets = [
+                (loop, queue, (event, data))
+                for user_id, event, data in messages
+                for loop, queue in self.subscribers.get(user_id, ())
+            ]
+
+        for loop, queue, message in targets:
+            try:
+                loop.call_soon_threadsafe(offer, queue, message)
+            except RuntimeError:
+                pass    # the stream's event loop has closed
+
+
+class Relay:
+    """
+    Passes events between the worker processes on this machine through Unix datagram sockets,
+    one per listening process, in the EVENTS_SOCKET_DIR directory.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.path = None
+
+    def get_directory(self):
+        return getattr(settings, 'EVENTS_SOCKET_DIR', None)
+
+    def listen(self, broker):
+        """
+        Starts receiving other processes' events into the broker, if not already.
+        """
+
+        directory = self.get_directory()
+        with self.lock:
+            if self.path is not None or not directory:
+                return
+
+            os.makedirs(directory, exist_ok=True)
+            self.path = os.path.join(directory, f"{os.getpid()}-{uuid4().hex[:8]}.sock")
+            receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            receiver.bind(self.path)
+
+        def receive():
+            while True:
+                messages = json.loads(receiver.recv(MAX_DATAGRAM))
+                broker.dispatch([tuple(message) for message in messages])
+
+        threading.Thread(target=receive, name='events-relay', daemon=True).start()
+
+    def send(self, messages):
+        """
+        Sends messages to every other listening process.
+        """
+
+        directory = self.get_directory()
+        try:
+            names = os.listdir(directory) if directory else []
+        except FileNotFoundError:
+            return
+
+        paths = [os.path.join(directory, name) for name in names if name.endswith('.sock')]
+        paths = [path for path in paths if path != self.path]
+        if not paths:
+            return
+
+        payloads = [
+            json.dumps(messages[start:start + DATAGRAM_BATCH]).encode()
+            for start in range(0, len(messages), DATAGRAM_BATCH)
+        ]
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sender:
+            sender.setblocking(False)
+            for path in paths:
+                for payload in payloads:
+                    try:
+                        sender.sendto(payload, path)
+                    except (ConnectionRefusedError, FileNotFoundError):
+                        # the process is gone, so clean up its socket
+                        try:
+                            os.remove(path)
+                        except FileNotFoundError:
+                            pass
+                        break
+                    except OSError:
+                        break    # the process is too far behind, so it misses these events
+
+
+broker = Broker()
+relay = Relay()
+
+
+def publish(messages):
+    """
+    Publishes (user id, event, data) messages to every worker process.
+    """
+
+    if messages:
+        broker.dispatch(messages)
+        relay.send(messages)
+
+
+def publish_on_commit(messages):
+    """
+    Publishes messages once the current transaction commits.
+    """
+
+    if messages:
+        transaction.on_commit(lambda: publish(messages), using=current_alias())
+
+
+def message_event(entry):
+    """
+    Returns the 'message' event for a newly delivered inbox entry.
+    """
+
+    return entry.user_id, 'message', {
+        'uid': str(entry.email_id),
+        'subject': entry.subject[:SUBJECT_LENGTH],
+        'snippet': entry.snippet,
+        'from': entry.sender_address,
+        'to': entry.recipient_addresses,
+        'sent_at': dateformat.format(timezone.localtime(entry.sent_at), 'M j, Y H:i'),
+    }
+
+
+def format_event(event, data):
+    """
+    Encodes an event in the text/event-stream format.
+    """
+
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n".encode()
+
+
+def load_user_id(headers):
+    """
+    Returns the id of the user logged in to the email client with the session in the
+    request's cookies, or None.
+    """
+
+    cookies = {}
+    for name, value in headers:
+        if name == b'cookie':
+            for cookie in value.decode('latin-1').split(';'):
+                key, _, morsel = cookie.strip().partition('=')
+                cookies[key] = morsel
+
+    session_key = cookies.get(settings.SESSION_COOKIE_NAME)
+    if not session_key:
+        return None
+
+    session = import_module(settings.SESSION_ENGINE).SessionStore(session_key)
+    if not session.get('email_session'):
+        return None
+
+    user = get_user(SimpleNamespace(session=session))
+    return user.pk if user.is_authenticated else None
+
+
+async def event_stream(scope, receive, send):
+    """
+    ASGI application streaming the logged in user's events until they disconnect.
+    """
+
+    user_id = await sync_to_async(load_user_id)(scope.get('headers', []))
+    if user_id is None:
+        await send({'type': 'http.response.start', 'status': 403, 'headers': [(b'content-type', b'text/plain')]})
+        await send({'type': 'http.response.body', 'body': b'Please sign-in to continue.'})
+        return
+
+    relay.listen(broker)
+    queue = broker.subscribe(user_id)
+
+    async def wait_for_disconnect():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    disconnected = asyncio.ensure_future(wait_for_disconnect())
+    try:
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),
+        ]})
+        await send({'type': 'http.response.body', 'body': b'retry: 5000\n\n', 'more_body': True})
+
+        while True:
+            message = asyncio.ensure_future(queue.get())
+            done, _ = await asyncio.wait({message, disconnected}, timeout=HEARTBEAT,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if disconnected in done:
+                message.cancel()
+                break
+
+            if message in done:
+                body = format_event(*message.result())
+            else:
+                message.cancel()
+                body = b': keepalive\n\n'
+            await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+    finally:
+        disconnected.cancel()
+        broker.unsubscribe(user_id, queue)
+
+
+def route_events(django_application):
+    """
+    Returns an ASGI application serving the event stream itself and everything else with Django.
+    """
+
+    async def application(scope, receive, send):
+        if scope['type'] == 'http' and scope['path'] == EVENTS_PATH:
+            return await event_stream(scope, receive, send)
+        return await django_application(scope, receive, send)
+
+    return application
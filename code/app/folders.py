@@ -0,0 +1,100 @@
+"""
+Loads the rows displayed in the mailbox folders (inbox, outbox, archive).
+Every page is read from the user's mailbox entries in a single query,
+no matter how many emails or recipients it contains, using keyset pagination.
+"""
+
+from .models import ArchivedEntry, MailboxEntry
+from .pagination import DEFAULT_LIMIT, akeyset_page, keyset_page
+
+# entry fields shown in the folder rows
+ROW_FIELDS = (
+    'uid', 'sent_at', 'email', 'subject', 'snippet', 'sender_address', 'recipient_addresses', 'is_read', 'version'
+)
+
+
+def folder_entries(user, folder):
+    """
+    Returns a values() queryset of the mailbox entries in one of the user's folders.
+    """
+
+    return MailboxEntry.objects.filter(user=user, folder=folder, is_archived=False).values(*ROW_FIELDS)
+
+
+def archived_entries(user):
+    """
+    Returns a values() queryset of the user's archived entries (see archiving.py).
+    """
+
+    return ArchivedEntry.objects.filter(user=user).values(*ROW_FIELDS)
+
+
+def format_rows(page):
+    """
+    Turns a page of mailbox entries into the rows shown in the folder templates.
+    """
+
+    return [{
+        'uid': entry['email'],
+        'subject': entry['subject'],
+        'snippet': entry['snippet'],
+        'from': entry['sender_address'],
+        'to': entry['recipient_addresses'],
+        'sent_at': entry['sent_at'],
+        'is_read': entry['is_read'],
+        'version': entry['version']
+    } for entry in page]
+
+
+def load_folder(user, folder, before=None, limit=DEFAULT_LIMIT):
+    """
+    Returns a page of one of the user's mailbox folders, along with the cursor for the next page.
+    The page is read from the user's mailbox entries in a single query.
+    """
+
+    page, next_cursor = keyset_page(folder_entries(user, folder), before, limit)
+    return format_rows(page), next_cursor
+
+
+async def aload_folder(user, folder, before=None, limit=DEFAULT_LIMIT):
+    """
+    Async version of load_folder(), for the async views.
+    """
+
+    page, next_cursor = await akeyset_page(folder_entries(user, folder), before, limit)
+    return format_rows(page), next_cursor
+
+
+def load_inbox(user, before=None, limit=DEFAULT_LIMIT):
+    """
+    Returns a page of the emails the user has received (drafts excluded).
+    """
+
+    return load_folder(user, MailboxEntry.INBOX, before, limit)
+
+
+def load_outbox(user, before=None, limit=DEFAULT_LIMIT):
+    """
+    Returns a page of the emails the user has sent (drafts excluded).
+    """
+
+    return load_folder(user, MailboxEntry.OUTBOX, before, limit)
+
+
+
+def load_archive(user, before=None, limit=DEFAULT_LIMIT):
+    """
+    Returns a page of the emails the user has archived, or that were archived for being old.
+    """
+
+    page, next_cursor = keyset_page(archived_entries(user), before, limit)
+    return format_rows(page), next_cursor
+
+
+async def aload_archive(user, before=None, limit=DEFAULT_LIMIT):
+    """
+    Async version of load_archive(), for the async views.
+    """
+
+    page, next_cursor = await akeyset_page(archived_entries(user), before, limit)
+    return format_rows(page), next_cursor
@@ -1,9 +1,21 @@
-from django.contrib.auth.hashers import get_hasher, make_password
-
-from .models import CustomUser, Email, Sender, Recipient, Attachment, Note
+from .bodies import make_snippet, pack_body
+from .counters import touch
+from .directory import directory
+from .hashing import hash_password, verify_password
+from .images import schedule as schedule_image
+from .jobs import enqueue
+from .mailbox import fan_out
+from .models import CustomUser, Email, Sender, Attachment, Note
+from .shards import current_alias
+from .threads import find_thread
+
+from uuid import uuid4
 
 from django import forms
+from django.conf import settings
 from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.utils import timezone
 
 
 class UserRegistrationForm(forms.ModelForm):
@@ -35,8 +47,8 @@ class UserRegistrationForm(forms.ModelForm):
     def save(self, commit=True):
         user = super().save(commit=False)
 
-        # hash user password
-        user.set_password(self.cleaned_data["password"])
+        # hash user password, on the hashing pool
+        user.password = hash_password(self.cleaned_data["password"])
         user.email_password = user.password
 
         # create email for user
@@ -68,8 +80,7 @@ class UserResetForm(forms.Form):
         re_password = cleaned_data.get("re_password")
         try:
             user = CustomUser.objects.get(username=cleaned_data.get("username"))
-            hasher = get_hasher('default')
-            is_correct = hasher.verify(old_password, user.email_password)
+            is_correct, _ = verify_password(old_password, user.email_password)
 
             if not is_correct:
                 raise ValidationError(
@@ -99,7 +110,7 @@ class UserResetForm(forms.Form):
         user = CustomUser.objects.get(username=self.cleaned_data.get("username"))
         if user is not None:
             # change the user's password to be the new password
-            user.email_password = make_password(self.cleaned_data.get("email_password"))
+            user.email_password = hash_password(self.cleaned_data.get("email_password"))
             user.save()
 
 
@@ -114,6 +125,8 @@ class ComposeForm(forms.Form):
     body = forms.CharField(required=True, label='Body:')
     is_draft = forms.BooleanField(required=False, label='Draft:')
     is_forward = forms.BooleanField(required=False, label='Forward:')
+    # the email being replied to or forwarded, whose thread the new email joins
+    parent = forms.UUIDField(required=False, widget=forms.HiddenInput)
     file_field = forms.FileField(widget=forms.ClearableFileInput(attrs={'multiple': True}), required=False)
 
     def __init__(self, *args, **kwargs):
@@ -122,6 +135,7 @@ class ComposeForm(forms.Form):
         # setup some state vars
         self.sender_user = None
         self.recipient_users = []
+        self.thread = None
         self.fields['sender'].widget.attrs['readonly'] = True
 
     def clean(self):
@@ -140,17 +154,25 @@ class ComposeForm(forms.Form):
         else:
             self.sender_user = sender_query[0]
 
-        # validate recipients emails
-        emails = self.cleaned_data['recipients'].split(',')
+        # validate recipients emails, skipping empty and repeated ones
+        emails = [email.strip() for email in self.cleaned_data['recipients'].split(',')]
+        emails = list(dict.fromkeys(email for email in emails if email))
+
+        # resolve recipients through the address directory, which only queries the DB for uncached addresses
+        user_ids = directory.resolve(emails)
         for email in emails:
-            email = email.strip()
-            if not email:
-                continue    # skip this email if it's empty
-            recipient_query = CustomUser.objects.filter(email=email)
-            if not recipient_query:
+            if email not in user_ids:
                 raise ValidationError(f"Invalid recipient email: \"{email}\"")
-            else:
-                self.recipient_users.append(recipient_query[0])
+
+        # recipients only need their id and address, so don't load the full users
+        self.recipient_users = [CustomUser(pk=user_ids[email], email=email) for email in emails]
+
+        # replies and forwards join the thread of an email in the sender's mailbox
+        parent = self.cleaned_data.get('parent')
+        if parent is not None:
+            self.thread = find_thread(self.sender_user, parent)
+            if self.thread is None:
+                raise ValidationError(f"Invalid parent email: \"{parent}\"")
 
         # everything checks out
         return
@@ -165,10 +187,25 @@ class ComposeForm(forms.Form):
         if not self.is_valid():
             return None
 
+        # the email is written on the sender's shard, and copied to the recipients' shards as it's delivered
+        with transaction.atomic(using=current_alias()):
+            return self._create_email_and_relations(file_data)
+
+    def _create_email_and_relations(self, file_data):
+        """
+        Does the work of create_email_and_relations inside of its transaction.
+        """
+
         # create email object
+        # large bodies are stored compressed (see bodies.py), and listings show the snippet instead
         email = Email.objects.create(
-            body=self.cleaned_data['body'],
-            subject=self.cleaned_data['subject']
+            subject=self.cleaned_data['subject'],
+            snippet=make_snippet(self.cleaned_data['body']),
+            sent_at=timezone.now(),
+            # other emails start a thread of their own
+            thread=self.thread or uuid4(),
+            parent=self.cleaned_data.get('parent'),
+            **pack_body(self.cleaned_data['body'])
         )
 
         # create sender object
@@ -176,32 +213,42 @@ class ComposeForm(forms.Form):
             user=self.sender_user,
             email=email,
             is_draft=self.cleaned_data['is_draft'],
-            is_forward=self.cleaned_data['is_forward']
+            is_forward=self.cleaned_data['is_forward'],
+            sent_at=email.sent_at
         )
 
-        # create recipients objects
-        recipients = []
-        for recipient_user in self.recipient_users:
-            recipients.append(
-                Recipient.objects.create(
-                    user=recipient_user,
-                    email=email,
-                    is_sent=not self.cleaned_data['is_draft'],
-                    is_forward=self.cleaned_data['is_forward']
-                )
+        # create recipients objects in bulk and deliver the email,
+        # leaving large sends to a background job so the sender doesn't have to wait
+        if len(self.recipient_users) > getattr(settings, 'DEFERRED_FANOUT_THRESHOLD', 1000):
+            # the job is on 'default' and the email may be on a shard, so only queue it once the email exists
+            args = (str(email.uid), [[user.pk, user.email] for user in self.recipient_users])
+            shard = current_alias()
+            transaction.on_commit(lambda: enqueue('fan_out_email', *args, shard=shard), using=shard)
+        else:
+            fan_out(
+                email,
+                sender,
+                self.recipient_users,
+                is_sent=not self.cleaned_data['is_draft'],
+                is_forward=self.cleaned_data['is_forward']
             )
 
         # create and save attachments
         if file_data is not None:
             for _, file in file_data.items():
                 # create new attachment
+                is_image = (getattr(file, 'content_type', None) or '').startswith('image/')
                 attach = Attachment.objects.create(
                     email=email,
-                    type=Attachment.FILE,
+                    type=Attachment.IMAGE if is_image else Attachment.FILE,
                     file=file,
                     name=file.name
                 )
 
+                # make smaller versions of images in the background
+                if is_image:
+                    schedule_image(attach)
+
         # everything was created successfully
         return email
 
@@ -232,5 +279,8 @@ class NoteForm(forms.Form):
             )
             note.save()
 
+            # the user's note box has changed
+            touch([user.pk])
+
         except CustomUser.DoesNotExist:
             return False
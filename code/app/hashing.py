@@ -0,0 +1,151 @@
+"""
+Password hashing and verification on a dedicated, bounded pool of threads.
+PBKDF2 is slow on purpose, so a burst of logins hashing on the request threads would hold up
+every other page. Instead, hashes are computed on PASSWORD_HASHING_WORKERS threads (hashlib
+releases the GIL while hashing, so they run in parallel), with at most PASSWORD_HASHING_QUEUE
+more waiting. Anything past that is turned away straight away with 503 Service Unavailable.
+Passwords hashed with outdated parameters are rehashed when their owner next logs in.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.hashers import check_password, get_hasher, identify_hasher, make_password
+from django.http import HttpResponse
+from django.utils.deprecation import MiddlewareMixin
+
+from .models import CustomUser
+
+# seconds a client turned away is asked to wait before trying again
+RETRY_AFTER = 1
+
+
+class PoolFull(Exception):
+    """
+    Raised when the hashing pool has no room for more work.
+    """
+
+
+class HashingPool:
+    """
+    Runs functions on a fixed number of threads, with a limited number waiting.
+    """
+
+    def __init__(self, workers, queue):
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='hashing')
+        self.capacity = threading.BoundedSemaphore(workers + queue)
+
+    def run(self, func, *args):
+        """
+        Runs func(*args) on the pool and returns its result, or raises PoolFull if the pool is full.
+        """
+
+        if not self.capacity.acquire(blocking=False):
+            raise PoolFull()
+        try:
+            return self.executor.submit(func, *args).result()
+        finally:
+            self.capacity.release()
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+pool = None
+pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Returns the process's hashing pool, sized by the PASSWORD_HASHING_* settings.
+    """
+
+    global pool
+    with pool_lock:
+        if pool is None:
+            pool = HashingPool(
+                getattr(settings, 'PASSWORD_HASHING_WORKERS', 4),
+                getattr(settings, 'PASSWORD_HASHING_QUEUE', 8)
+            )
+        return pool
+
+
+def hash_password(password):
+    """
+    Hashes a password with the current hasher and parameters, on the pool.
+    """
+
+    return get_pool().run(make_password, password)
+
+
+def verify_password(password, encoded):
+    """
+    Checks a password against its hash on the pool.
+    Returns whether it's correct, and whether the hash should be replaced with a hash_password() of it.
+    """
+
+    is_correct = get_pool().run(check_password, password, encoded)
+    if not is_correct:
+        return False, False
+
+    # as in Django's check_password(), hashes from other hashers or with old parameters are replaced
+    preferred = get_hasher('default')
+    try:
+        hasher = identify_hasher(encoded)
+    except ValueError:
+        return True, True
+    return True, hasher.algorithm != preferred.algorithm or preferred.must_update(encoded)
+
+
+class PooledModelBackend(ModelBackend):
+    """
+    Authentication backend checking passwords on the hashing pool, and rehashing
+    passwords with outdated parameters when their owners log in.
+    """
+
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        UserModel = get_user_model()
+        if username is None:
+            username = kwargs.get(UserModel.USERNAME_FIELD)
+        if username is None or password is None:
+            return None
+
+        try:
+            user = UserModel._default_manager.get_by_natural_key(username)
+        except UserModel.DoesNotExist:
+            # hash anyway, so missing users take as long as wrong passwords
+            hash_password(password)
+            return None
+
+        is_correct, needs_update = verify_password(password, user.password)
+        if not is_correct or not self.user_can_authenticate(user):
+            return None
+
+        if needs_update:
+            user.password = hash_password(password)
+            UserModel._default_manager.filter(pk=user.pk).update(password=user.password)
+        return user
+
+
+def rehash_email_password(user_id, password):
+    """
+    Replaces a user's email password hash with one using the current parameters.
+    """
+
+    CustomUser.objects.filter(pk=user_id).update(email_password=hash_password(password))
+
+
+class HashingPoolMiddleware(MiddlewareMixin):
+    """
+    Answers requests whose password hashing was turned away by a full pool with 503 Service Unavailable.
+    """
+
+    def process_exception(self, request, exception):
+        if isinstance(exception, PoolFull):
+            response = HttpResponse("Too many logins at once. Please try again in a moment.", status=503)
+            response['Retry-After'] = RETRY_AFTER
+            return response
+        return None
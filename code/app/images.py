@@ -0,0 +1,114 @@
+"""
+Background processing for image attachments.
+Once an email with an image is saved, a job queue worker process (see jobs.py) decodes
+the image with Pillow and produces a thumbnail and a recompressed display variant, both
+without the original's EXIF metadata, and their dimensions and sizes are recorded on the attachment.
+"""
+
+import io
+
+from django.core.files.base import ContentFile
+from django.db import transaction
+from PIL import Image, ImageOps, features
+
+from .jobs import enqueue
+from .models import Attachment
+from .shards import current_alias
+
+THUMBNAIL_SIZE = (256, 256)
+DISPLAY_SIZE = (1600, 1600)
+QUALITY = 80
+
+
+def get_format():
+    """
+    Returns the (Pillow format, file extension) variants are saved in, WebP when it's available.
+    """
+
+    return ('WEBP', 'webp') if features.check('webp') else ('JPEG', 'jpg')
+
+
+def variant_filename(attachment, variant):
+    """
+    Returns the file name of one of an image attachment's variants ('image' or 'thumbnail').
+    """
+
+    stem = attachment.name.rsplit('.', 1)[0] or 'image'
+    suffix = '_thumbnail' if variant == 'thumbnail' else ''
+    return f"{stem}{suffix}.{get_format()[1]}"
+
+
+def encode(image, size):
+    """
+    Shrinks an image to fit within size and returns it encoded in the variant format.
+    Metadata isn't copied over, so EXIF data (including any location) is stripped.
+    """
+
+    variant = image.copy()
+    variant.thumbnail(size)
+    buffer = io.BytesIO()
+    variant.save(buffer, format=get_format()[0], quality=QUALITY)
+    return buffer.getvalue()
+
+
+def process_image(path):
+    """
+    Decodes the image at path and returns its (width, height, display variant, thumbnail).
+    """
+
+    with Image.open(path) as image:
+        # apply the camera's orientation before the EXIF data holding it is dropped
+        image = ImageOps.exif_transpose(image)
+
+        has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+        image = image.convert('RGBA' if has_alpha and get_format()[0] == 'WEBP' else 'RGB')
+        return image.width, image.height, encode(image, DISPLAY_SIZE), encode(image, THUMBNAIL_SIZE)
+
+
+def save_variants(uid, result):
+    """
+    Stores the variants produced by process_image() on their attachment.
+    """
+
+    width, height, display, thumbnail = result
+    with transaction.atomic():
+        attachment = Attachment.objects.select_for_update().filter(uid=uid).first()
+        if attachment is None:
+            return    # the attachment was deleted while it was processed
+
+        attachment.image.save(variant_filename(attachment, 'image'), ContentFile(display), save=False)
+        attachment.thumbnail.save(variant_filename(attachment, 'thumbnail'), ContentFile(thumbnail), save=False)
+        attachment.width = width
+        attachment.height = height
+        attachment.size = attachment.file.size
+        attachment.image_size = len(display)
+        attachment.thumbnail_size = len(thumbnail)
+        attachment.save()
+
+
+def process_attachment(uid):
+    """
+    Processes an image attachment. Runs in a job queue worker.
+    Attachments that turn out not to be images are served as plain files.
+    """
+
+    attachment = Attachment.objects.filter(uid=uid).first()
+    if attachment is None:
+        return    # the attachment was deleted before it was processed
+
+    try:
+        result = process_image(attachment.file.path)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        Attachment.objects.filter(uid=uid).update(type=Attachment.FILE)
+        return
+
+    save_variants(uid, result)
+
+
+def schedule(attachment):
+    """
+    Queues an image attachment to be processed by a worker once the current transaction commits.
+    That's the send's transaction, on the sender's shard, which the attachment's email is written in.
+    """
+
+    transaction.on_commit(lambda: enqueue('process_image_attachment', str(attachment.uid)), using=current_alias())
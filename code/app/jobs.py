@@ -0,0 +1,233 @@
+"""
+A job queue kept in the database, so deferred work needs no outside broker.
+Jobs are rows in the Job table, written in the same transaction as the work that
+queues them, and run by `manage.py runworker`. Workers claim jobs with
+SELECT ... FOR UPDATE SKIP LOCKED where the database supports it (PostgreSQL) and
+with a conditional UPDATE elsewhere (SQLite). Failed jobs are retried with
+exponential backoff, and periodic jobs are queued by whichever worker sees they're due.
+"""
+
+import os
+import signal
+import socket
+import time
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Job, Schedule
+
+# registered tasks, by name: (function, max attempts)
+TASKS = {}
+
+# registered periodic tasks, by name: seconds between runs
+PERIODIC = {}
+
+# seconds before the first retry of a failed job, doubled for each later attempt
+RETRY_DELAY = 10
+
+# seconds between a worker's checks for due periodic tasks
+PERIODIC_CHECK = 30
+
+# number of due jobs a worker tries to claim at once without row locks
+CLAIM_CANDIDATES = 10
+
+# seconds after which a running job is assumed to have lost its worker
+STALE_AFTER = 15 * 60
+
+# seconds finished jobs are kept for before they're purged
+KEEP_FINISHED = 7 * 24 * 60 * 60
+
+
+def task(name=None, max_attempts=3, every=None):
+    """
+    Decorator registering a function as a task that can be queued by name.
+    Tasks given 'every' (in seconds) are also queued periodically by the workers.
+    Task arguments must be JSON serializable.
+    """
+
+    def decorator(func):
+        task_name = name or func.__name__
+        TASKS[task_name] = (func, max_attempts)
+        if every is not None:
+            PERIODIC[task_name] = every
+        return func
+
+    return decorator
+
+
+def enqueue(name, *args, delay=0, **kwargs):
+    """
+    Queues a task to run in a worker, after delay seconds.
+    The job is only visible to workers once the current transaction commits.
+    When JOBS_SYNC is set, the task runs right away instead.
+    """
+
+    func, max_attempts = TASKS[name]
+    if getattr(settings, 'JOBS_SYNC', False):
+        func(*args, **kwargs)
+        return None
+
+    return Job.objects.create(
+        name=name,
+        args=list(args),
+        kwargs=kwargs,
+        max_attempts=max_attempts,
+        run_at=timezone.now() + timedelta(seconds=delay)
+    )
+
+
+def claim(worker):
+    """
+    Claims the oldest due job for a worker, marking it as running.
+    Returns the job, or None if there are no due jobs.
+    """
+
+    now = timezone.now()
+    due = Job.objects.filter(status=Job.QUEUED, run_at__lte=now).order_by('run_at', 'id')
+    changes = {'status': Job.RUNNING, 'locked_by': worker, 'locked_at': now}
+
+    if connection.features.has_select_for_update_skip_locked:
+        # lock the first job no other worker has locked
+        with transaction.atomic():
+            job = due.select_for_update(skip_locked=True).first()
+            if job is None:
+                return None
+            due.filter(pk=job.pk).update(attempts=F('attempts') + 1, **changes)
+    else:
+        # without row locks, take the first job that's still queued when it's updated
+        for job in due[:CLAIM_CANDIDATES]:
+            if due.filter(pk=job.pk).update(attempts=F('attempts') + 1, **changes):
+                break
+        else:
+            return None
+
+    job.attempts += 1
+    for field, value in changes.items():
+        setattr(job, field, value)
+    return job
+
+
+def run_job(job):
+    """
+    Runs a claimed job in a transaction on 'default' and records how it went. Tasks writing
+    sharded rows run their own transaction on the shard, and may be run again after it commits
+    if the job isn't marked done, so they should only add what's missing.
+    Failed jobs are queued again until they run out of attempts.
+    Returns whether the job succeeded.
+    """
+
+    jobs = Job.objects.filter(pk=job.pk)
+    try:
+        func, _ = TASKS[job.name]
+        with transaction.atomic():
+            func(*job.args, **job.kwargs)
+    except Exception:
+        error = traceback.format_exc()
+        if job.attempts < job.max_attempts:
+            retry_at = timezone.now() + timedelta(seconds=RETRY_DELAY * 2 ** (job.attempts - 1))
+            jobs.update(status=Job.QUEUED, run_at=retry_at, locked_by='', locked_at=None, last_error=error)
+        else:
+            jobs.update(status=Job.FAILED, locked_by='', locked_at=None, last_error=error)
+        return False
+
+    jobs.update(status=Job.DONE, locked_by='', locked_at=None)
+    return True
+
+
+def requeue_stale(stale_after=STALE_AFTER):
+    """
+    Queues jobs again whose worker died while running them. Returns the number requeued.
+    """
+
+    cutoff = timezone.now() - timedelta(seconds=stale_after)
+    return Job.objects.filter(status=Job.RUNNING, locked_at__lt=cutoff).update(
+        status=Job.QUEUED, locked_by='', locked_at=None
+    )
+
+
+def purge_finished(keep=KEEP_FINISHED):
+    """
+    Deletes jobs that finished more than keep seconds ago. Returns the number deleted.
+    """
+
+    cutoff = timezone.now() - timedelta(seconds=keep)
+    return Job.objects.filter(status__in=[Job.DONE, Job.FAILED], run_at__lt=cutoff).delete()[0]
+
+
+def queue_periodic():
+    """
+    Queues every periodic task that is due. Each is only queued once per period,
+    however many workers check at the same time. Returns the number of tasks queued.
+    """
+
+    now = timezone.now()
+    Schedule.objects.bulk_create([
+        Schedule(name=name, next_run_at=now + timedelta(seconds=every)) for name, every in PERIODIC.items()
+    ], ignore_conflicts=True)
+
+    queued = 0
+    for name, every in PERIODIC.items():
+        # only the worker that moves the schedule forward queues the task
+        due = Schedule.objects.filter(name=name, next_run_at__lte=now)
+        if due.update(next_run_at=now + timedelta(seconds=every)):
+            enqueue(name)
+            queued += 1
+
+    return queued
+
+
+def work(worker, stop, poll_interval=1.0, burst=False):
+    """
+    Claims and runs jobs until the stop event is set.
+    In burst mode, returns as soon as there are no due jobs instead of waiting for more.
+    Returns the number of jobs run.
+    """
+
+    ran = 0
+    next_periodic = 0
+    while not stop.is_set():
+        # drop connections that have gone bad or outlived CONN_MAX_AGE (unless in a test's transaction)
+        if not connection.in_atomic_block:
+            close_old_connections()
+
+        if time.monotonic() >= next_periodic:
+            queue_periodic()
+            next_periodic = time.monotonic() + PERIODIC_CHECK
+
+        job = claim(worker)
+        if job is None:
+            if burst:
+                break
+            stop.wait(poll_interval)
+            continue
+
+        run_job(job)
+        ran += 1
+
+    return ran
+
+
+def worker_name(index=0):
+    """
+    Returns a name identifying a worker process in the jobs it claims.
+    """
+
+    return f"{socket.gethostname()}:{os.getpid()}:{index}"
+
+
+def run_worker(index, stop, poll_interval=1.0, burst=False):
+    """
+    Entry point of a worker process. Stops after its current job on SIGTERM or SIGINT.
+    """
+
+    def shutdown(signum, frame):
+        stop.set()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    work(worker_name(index), stop, poll_interval, burst)
@@ -0,0 +1,263 @@
+"""
+Maintains the denormalized MailboxEntry table that the folder views read from.
+Entries are written in the same transaction as the send, and can be rebuilt
+from the Email, Sender, and Recipient tables at any time.
+Each user's entries are on their shard, which also gets a copy of the email (see shards.py).
+"""
+
+from django.db import connections, transaction
+from django.db.models import F
+
+from .archiving import move_to_archive
+from .counters import adjust, count_entries, touch
+from .events import message_event, publish_on_commit
+from .models import ArchivedEntry, CustomUser, Email, Sender, Recipient, MailboxEntry
+from .search import index_email
+from .shards import copy_email, current_alias, local_users, place, using_shard
+from .threads import count_threads, read_thread
+
+# number of mailbox entries written per query
+BATCH_SIZE = 500
+
+# number of recipient addresses shown in each mailbox entry
+DISPLAY_RECIPIENTS = 10
+
+
+def display_recipients(addresses):
+    """
+    Joins recipient addresses into the display string stored on mailbox entries.
+    Long lists are cut short so each entry stays small, no matter how many recipients there are.
+    """
+
+    if len(addresses) <= DISPLAY_RECIPIENTS:
+        return ', '.join(addresses)
+
+    shown = ', '.join(addresses[:DISPLAY_RECIPIENTS])
+    return f"{shown} and {len(addresses) - DISPLAY_RECIPIENTS} more"
+
+
+def build_entries(email, sender, recipients, user_ids=None):
+    """
+    Builds the (unsaved) mailbox entries for the sender and each recipient of an email,
+    or only for those in user_ids if given.
+    The sender and recipients must be Sender and Recipient instances with their users loaded.
+    """
+
+    # every entry shares the same display data
+    shared = {
+        'email': email,
+        'sent_at': email.sent_at,
+        'subject': email.subject,
+        'snippet': email.snippet,
+        'thread': email.thread,
+        'sender_address': sender.user.email,
+        'recipient_addresses': display_recipients([recipient.user.email for recipient in recipients]),
+        'is_forward': sender.is_forward,
+        'version': email.version,
+    }
+
+    # the sender sees the email in their outbox, or drafts if it hasn't been sent
+    entries = []
+    if user_ids is None or sender.user_id in user_ids:
+        entries.append(MailboxEntry(
+            user=sender.user,
+            folder=MailboxEntry.DRAFTS if sender.is_draft else MailboxEntry.OUTBOX,
+            is_read=True,
+            **shared
+        ))
+
+    # each recipient sees the email in their inbox once it has been sent
+    for recipient in recipients:
+        if not recipient.is_sent:
+            continue    # skip this recipient since the email is still a draft
+        if user_ids is not None and recipient.user_id not in user_ids:
+            continue    # this recipient's mailbox is on another shard
+        entries.append(MailboxEntry(
+            user=recipient.user,
+            folder=MailboxEntry.INBOX,
+            is_read=recipient.is_read,
+            is_archived=recipient.is_archived,
+            **shared
+        ))
+
+    return entries
+
+
+def deliver(email, sender, recipients):
+    """
+    Adds a newly created email to its sender's and recipients' mailboxes and to the search index.
+    Should be called in the same transaction that created the email. Participants on other
+    shards get a copy of the email, written in a transaction on their shard. Mailboxes that
+    already have the email are left alone, so a delivery that failed part way can be run again.
+    """
+
+    home = email._state.db
+    user_ids = [sender.user_id, *(recipient.user_id for recipient in recipients)]
+    entries = []
+    for alias, shard_users in place(user_ids, home).items():
+        with using_shard(alias):
+            if alias == home:
+                entries += deliver_locally(email, sender, recipients, shard_users)
+                continue
+
+            with transaction.atomic(using=alias):
+                # an earlier attempt may have copied some of the recipients already
+                copied = set(Recipient.objects.filter(email=email.uid).values_list('user', flat=True))
+                copy = copy_email(email, [sender], [
+                    recipient for recipient in recipients if recipient.user_id not in copied
+                ], alias)
+                entries += deliver_locally(copy, sender, recipients, shard_users)
+    return entries
+
+
+def deliver_locally(email, sender, recipients, user_ids=None):
+    """
+    Delivers an email to the mailboxes on the current shard, of everyone or only the given users,
+    leaving alone those that already have it.
+    """
+
+    delivered = set()
+    for model in (MailboxEntry, ArchivedEntry):
+        delivered.update(model.objects.filter(email=email).values_list('user', 'folder'))
+    entries = [
+        entry for entry in build_entries(email, sender, recipients, user_ids)
+        if (entry.user_id, entry.folder) not in delivered
+    ]
+    entries = MailboxEntry.objects.bulk_create(entries, batch_size=BATCH_SIZE)
+    count_entries(entries)
+    count_threads(entries)
+    index_email(
+        email,
+        sender.user.email,
+        ' '.join(recipient.user.email for recipient in recipients),
+        connection=connections[current_alias()]
+    )
+
+    # tell the recipients' open inboxes about the new message once it's committed
+    publish_on_commit([
+        message_event(entry) for entry in entries if entry.folder == MailboxEntry.INBOX and not entry.is_archived
+    ])
+    return entries
+
+
+def fan_out(email, sender, recipient_users, is_sent, is_forward):
+    """
+    Creates the Recipient rows of a newly created email and delivers it to everyone.
+    Should be called in the same transaction that created the email, or by a job retrying the
+    delivery, which only adds the recipients and mailboxes that don't have the email yet.
+    """
+
+    # recipients from an earlier attempt keep their rows
+    users = {recipient_user.pk: recipient_user for recipient_user in recipient_users}
+    recipients = [recipient for recipient in Recipient.objects.filter(email=email) if recipient.user_id in users]
+    for recipient in recipients:
+        recipient.user = users[recipient.user_id]
+    present = {recipient.user_id for recipient in recipients}
+
+    recipients += Recipient.objects.bulk_create([
+        Recipient(
+            user=recipient_user,
+            email=email,
+            is_sent=is_sent,
+            is_forward=is_forward,
+            sent_at=email.sent_at
+        )
+        for recipient_user in recipient_users if recipient_user.pk not in present
+    ], batch_size=BATCH_SIZE)
+
+    # add the email to each user's mailbox and the search index
+    deliver(email, sender, recipients)
+    return recipients
+
+
+def mark_read(user, email):
+    """
+    Marks an email in the user's inbox or archive as read and updates their unread counter.
+    """
+
+    with transaction.atomic(using=current_alias()):
+        entries = MailboxEntry.objects.filter(user=user, email=email, folder=MailboxEntry.INBOX, is_read=False)
+        unread = entries.filter(is_archived=False).update(is_read=True)
+        archived = entries.update(is_read=True)
+        archived += ArchivedEntry.objects.filter(
+            user=user, email=email, folder=MailboxEntry.INBOX, is_read=False
+        ).update(is_read=True)
+        if not unread and not archived:
+            return    # the email was already read
+
+        Recipient.objects.filter(user=user, email=email).update(is_read=True)
+        read_thread(user, email, unread + archived)
+        if unread:
+            adjust([user.pk], unread=-unread)
+        else:
+            touch([user.pk])    # the archive page changed
+
+
+def archive(user, email):
+    """
+    Moves an email out of the user's inbox and into their archive, updating their counters.
+    Returns the number of inbox entries that were archived.
+    """
+
+    with transaction.atomic(using=current_alias()):
+        entries = list(MailboxEntry.objects.select_for_update().filter(
+            user=user, email=email, folder=MailboxEntry.INBOX, is_archived=False
+        ))
+        if not entries:
+            return 0    # the email isn't in the user's inbox
+
+        # the flag survives rebuilds, and the entries move to the archive tables right away
+        Recipient.objects.filter(user=user, email=email).update(is_archived=True)
+        move_to_archive(entries)
+        return len(entries)
+
+
+def rebuild_entries(batch_size=500):
+    """
+    Rebuilds every mailbox entry on the current shard from its Email, Sender, and Recipient tables.
+    Emails are processed in batches so memory use stays bounded.
+    Returns the number of entries written.
+    """
+
+    written = 0
+    last_uid = None
+    while True:
+        # fetch the next batch of emails, without their bodies
+        emails = Email.objects.order_by('uid').only('uid', 'subject', 'snippet', 'thread', 'sent_at', 'version')
+        if last_uid is not None:
+            emails = emails.filter(uid__gt=last_uid)
+        emails = list(emails[:batch_size])
+        if not emails:
+            return written
+        last_uid = emails[-1].uid
+
+        # group the batch's senders and recipients by email, with their users (which may be on another database)
+        senders = list(Sender.objects.filter(email__in=emails))
+        recipients = list(Recipient.objects.filter(email__in=emails))
+        users = CustomUser.objects.in_bulk({relation.user_id for relation in senders + recipients})
+        email_senders = {}
+        for sender in senders:
+            sender.user = users[sender.user_id]
+            email_senders.setdefault(sender.email_id, []).append(sender)
+        email_recipients = {}
+        for recipient in recipients:
+            recipient.user = users[recipient.user_id]
+            email_recipients.setdefault(recipient.email_id, []).append(recipient)
+
+        # replace the batch's entries, with new versions so their cached rows are rendered again
+        user_ids = local_users(users)
+        entries = []
+        for email in emails:
+            email.version += 1
+            for sender in email_senders.get(email.uid, []):
+                entries += build_entries(email, sender, email_recipients.get(email.uid, []), user_ids)
+
+        # entries that were moved to the archive stay there
+        archived = set(ArchivedEntry.objects.filter(email__in=emails).values_list('user', 'email'))
+        entries = [entry for entry in entries if (entry.user_id, entry.email_id) not in archived]
+        with transaction.atomic(using=current_alias()):
+            Email.objects.filter(uid__in=[email.uid for email in emails]).update(version=F('version') + 1)
+            MailboxEntry.objects.filter(email__in=emails).delete()
+            MailboxEntry.objects.bulk_create(entries)
+            touch({entry.user_id for entry in entries})
+        written += len(entries)
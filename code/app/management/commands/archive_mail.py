@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from app.archiving import BATCH_SIZE, archive_old_mail
+from app.shards import each_shard
+
+
+class Command(BaseCommand):
+    """
+    Moves old and archived mailbox entries into the archive tables.
+    """
+
+    help = "Moves archived mail, and mail older than ARCHIVE_AFTER_DAYS, out of the mailbox tables."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None,
+                            help="Archive mail older than this many days instead of ARCHIVE_AFTER_DAYS.")
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                            help="Number of entries to archive per transaction.")
+
+    def handle(self, *args, **options):
+        moved = sum(archive_old_mail(options['days'], options['batch_size']) for _ in each_shard())
+        self.stdout.write(self.style.SUCCESS(f"Archived {moved} mailbox entries."))
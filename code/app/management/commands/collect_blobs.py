@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from app.blobs import GRACE_PERIOD, collect_garbage
+
+
+class Command(BaseCommand):
+    """
+    Removes attachment blobs that no attachment refers to anymore.
+    """
+
+    help = "Deletes unreferenced attachment blobs and stray files from blob storage."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="Number of blobs to check per batch.")
+        parser.add_argument('--grace-period', type=int, default=GRACE_PERIOD,
+                            help="Seconds a blob must go unused before it's removed.")
+
+    def handle(self, *args, **options):
+        removed = collect_garbage(batch_size=options['batch_size'], grace_period=options['grace_period'])
+        self.stdout.write(self.style.SUCCESS(f"Removed {removed} files."))
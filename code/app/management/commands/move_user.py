@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from app.models import CustomUser
+from app.rebalance import GRACE_PERIOD, move_user
+from app.shards import all_databases, is_sharded
+
+
+class Command(BaseCommand):
+    """
+    Moves a user's mail to another shard while they keep using the site.
+    """
+
+    help = "Moves a user's emails, mailbox, and counters to another shard."
+
+    def add_arguments(self, parser):
+        parser.add_argument('username', help="Username of the user to move.")
+        parser.add_argument('shard', help="Alias of the database to move them to.")
+        parser.add_argument('--grace-period', type=float, default=GRACE_PERIOD,
+                            help="Seconds to let requests on the old shard finish before cleaning it up.")
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="Number of mailbox entries to copy per transaction.")
+
+    def handle(self, *args, **options):
+        if not is_sharded():
+            raise CommandError("The mail tables aren't sharded (SHARD_DATABASES is empty).")
+        if options['shard'] not in all_databases():
+            raise CommandError(f"Unknown shard \"{options['shard']}\". Choose from: {', '.join(all_databases())}.")
+
+        try:
+            user = CustomUser.objects.get(username=options['username'])
+        except CustomUser.DoesNotExist:
+            raise CommandError(f"No user named \"{options['username']}\".")
+
+        moved = move_user(user, options['shard'], options['grace_period'], options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Moved {moved} mailbox entries to {options['shard']}."))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from app.bodies import BATCH_SIZE, pack_bodies
+from app.shards import each_shard
+
+
+class Command(BaseCommand):
+    """
+    Moves large email bodies stored as text into compressed or blob storage.
+    """
+
+    help = "Compresses every email body over EMAIL_BODY_COMPRESS_THRESHOLD that's still stored as text."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                            help="Number of emails to convert per transaction.")
+
+    def handle(self, *args, **options):
+        packed = sum(pack_bodies(batch_size=options['batch_size']) for _ in each_shard())
+        self.stdout.write(self.style.SUCCESS(f"Compressed {packed} email bodies."))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from app.mailbox import rebuild_entries
+from app.shards import each_shard
+
+
+class Command(BaseCommand):
+    """
+    Rebuilds the denormalized mailbox table from the Email, Sender, and Recipient tables.
+    """
+
+    help = "Rebuilds every user's mailbox entries from the normalized email tables."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="Number of emails to rebuild per transaction.")
+
+    def handle(self, *args, **options):
+        written = sum(rebuild_entries(batch_size=options['batch_size']) for _ in each_shard())
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {written} mailbox entries."))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from app.search import rebuild_index
+from app.shards import each_shard
+
+
+class Command(BaseCommand):
+    """
+    Rebuilds the full-text search index from the email and mailbox tables, dropping what is left of removed emails.
+    """
+
+    help = "Re-indexes every email for full-text search."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="Number of emails to index per batch.")
+
+    def handle(self, *args, **options):
+        indexed = sum(
+            rebuild_index(batch_size=options['batch_size'], connection=connections[alias]) for alias in each_shard()
+        )
+        self.stdout.write(self.style.SUCCESS(f"Indexed {indexed} emails."))
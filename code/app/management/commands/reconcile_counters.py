@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from app.counters import reconcile
+from app.shards import each_shard
+
+
+class Command(BaseCommand):
+    """
+    Repairs any per-user folder counters that drifted from the mailbox table.
+    """
+
+    help = "Recomputes every user's unread and folder counters and repairs any that drifted."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="Number of users to reconcile per batch.")
+
+    def handle(self, *args, **options):
+        repaired = sum(reconcile(batch_size=options['batch_size']) for _ in each_shard())
+        self.stdout.write(self.style.SUCCESS(f"Repaired {repaired} counters."))
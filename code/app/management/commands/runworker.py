@@ -0,0 +1,48 @@
+import multiprocessing
+import signal
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from app.jobs import run_worker
+
+
+class Command(BaseCommand):
+    """
+    Runs job queue workers until they're told to stop.
+    """
+
+    help = "Runs background jobs from the job queue in one or more worker processes."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=1,
+                            help="Number of worker processes to run.")
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help="Seconds to wait between checks when there are no jobs.")
+        parser.add_argument('--burst', action='store_true',
+                            help="Exit once there are no more due jobs.")
+
+    def handle(self, *args, **options):
+        # workers are forked, so they mustn't share this process's DB connections
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        stop = context.Event()
+
+        workers = [
+            context.Process(target=run_worker, args=(index, stop, options['poll_interval'], options['burst']))
+            for index in range(options['processes'])
+        ]
+        for worker in workers:
+            worker.start()
+        self.stdout.write(self.style.SUCCESS(f"Started {len(workers)} workers."))
+
+        # let the workers finish their current jobs before stopping
+        def shutdown(signum, frame):
+            stop.set()
+
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+        for worker in workers:
+            worker.join()
+
+        self.stdout.write(self.style.SUCCESS("Workers stopped."))
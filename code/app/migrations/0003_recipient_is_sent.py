@@ -2,17 +2,14 @@
 
 from django.db import migrations, models
 
-from app.models import Recipient
-
 
 def update_is_sent(apps, schema_editor):
     """
     Updates the 'is_sent' column on all existing recipients to be True.
     """
 
-    for recipient in Recipient.objects.all():
-        recipient.is_sent = True
-        recipient.save()
+    Recipient = apps.get_model('app', 'Recipient')
+    Recipient.objects.using(schema_editor.connection.alias).update(is_sent=True)
 
 
 class Migration(migrations.Migration):
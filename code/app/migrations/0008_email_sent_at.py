@@ -0,0 +1,55 @@
+# Generated by Django 4.1.8 on 2026-10-17 00:15
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+import django.utils.timezone
+
+
+def backfill_sent_at(apps, schema_editor):
+    """
+    Copies each existing email's 'sent_at' onto its Sender and Recipient relations.
+    Existing emails have no recorded send time, so they all receive the time of the migration.
+    """
+
+    Email = apps.get_model('app', 'Email')
+    Sender = apps.get_model('app', 'Sender')
+    Recipient = apps.get_model('app', 'Recipient')
+    db = schema_editor.connection.alias
+
+    sent_at = Subquery(Email.objects.filter(uid=OuterRef('email')).values('sent_at')[:1])
+    Sender.objects.using(db).update(sent_at=sent_at)
+    Recipient.objects.using(db).update(sent_at=sent_at)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0007_note'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='email',
+            name='sent_at',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='recipient',
+            name='sent_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='sender',
+            name='sent_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(backfill_sent_at, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='recipient',
+            index=models.Index(fields=['user', 'is_sent', '-sent_at', '-uid'], name='recipient_folder_page_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='sender',
+            index=models.Index(fields=['user', 'is_draft', '-sent_at', '-uid'], name='sender_folder_page_idx'),
+        ),
+    ]
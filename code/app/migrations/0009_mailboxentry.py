@@ -0,0 +1,82 @@
+# Generated by Django 4.1.8 on 2026-10-17 00:16
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import uuid
+
+
+def populate_mailbox(apps, schema_editor):
+    """
+    Creates mailbox entries for every existing email.
+    Mirrors app.mailbox.build_entries using the historical models.
+    """
+
+    Sender = apps.get_model('app', 'Sender')
+    Recipient = apps.get_model('app', 'Recipient')
+    MailboxEntry = apps.get_model('app', 'MailboxEntry')
+    db = schema_editor.connection.alias
+
+    # collect every email's recipients
+    recipients = {}
+    for recipient in Recipient.objects.using(db).select_related('user').iterator():
+        recipients.setdefault(recipient.email_id, []).append(recipient)
+
+    # write the entries one email at a time
+    for sender in Sender.objects.using(db).select_related('user', 'email').iterator():
+        email = sender.email
+        email_recipients = recipients.get(email.uid, [])
+        shared = {
+            'email': email,
+            'sent_at': email.sent_at,
+            'subject': email.subject,
+            'sender_address': sender.user.email,
+            'recipient_addresses': ', '.join(recipient.user.email for recipient in email_recipients),
+            'is_forward': sender.is_forward,
+        }
+        entries = [MailboxEntry(
+            user=sender.user,
+            folder='DRAFTS' if sender.is_draft else 'OUTBOX',
+            is_read=True,
+            **shared
+        )]
+        entries += [MailboxEntry(
+            user=recipient.user,
+            folder='INBOX',
+            is_read=recipient.is_read,
+            is_archived=recipient.is_archived,
+            **shared
+        ) for recipient in email_recipients if recipient.is_sent]
+        MailboxEntry.objects.using(db).bulk_create(entries)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0008_email_sent_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MailboxEntry',
+            fields=[
+                ('uid', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('folder', models.CharField(choices=[('INBOX', 'Inbox'), ('OUTBOX', 'Outbox'), ('DRAFTS', 'Drafts')], max_length=20)),
+                ('sent_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('subject', models.TextField()),
+                ('sender_address', models.CharField(max_length=254)),
+                ('recipient_addresses', models.TextField()),
+                ('is_read', models.BooleanField(default=False)),
+                ('is_forward', models.BooleanField(default=False)),
+                ('is_archived', models.BooleanField(default=False)),
+                ('email', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='app.email')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='mailboxentry',
+            index=models.Index(fields=['user', 'folder', '-sent_at', '-uid'], name='mailbox_folder_page_idx'),
+        ),
+        migrations.RunPython(populate_mailbox, migrations.RunPython.noop),
+    ]
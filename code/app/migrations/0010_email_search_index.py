@@ -0,0 +1,95 @@
+from django.db import migrations
+from django.utils.html import strip_tags
+
+
+def create_sqlite_table(cursor):
+    cursor.execute("CREATE VIRTUAL TABLE app_email_fts USING fts5(uid UNINDEXED, subject, body, participants)")
+
+
+def index_sqlite(cursor, documents):
+    cursor.executemany(
+        "INSERT INTO app_email_fts (uid, subject, body, participants) VALUES (%s, %s, %s, %s)",
+        [(uid.hex, *rest) for uid, *rest in documents]
+    )
+
+
+def create_postgres_table(cursor):
+    cursor.execute(
+        "CREATE TABLE app_email_fts ("
+        "  uid uuid PRIMARY KEY REFERENCES app_email (uid) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED,"
+        "  subject text NOT NULL,"
+        "  body text NOT NULL,"
+        "  participants text NOT NULL,"
+        "  document tsvector NOT NULL"
+        ")"
+    )
+    cursor.execute("CREATE INDEX app_email_fts_document_idx ON app_email_fts USING gin (document)")
+
+
+def index_postgres(cursor, documents):
+    cursor.executemany(
+        "INSERT INTO app_email_fts (uid, subject, body, participants, document)"
+        " VALUES (%s, %s, %s, %s,"
+        "  setweight(to_tsvector('simple', %s), 'A') ||"
+        "  setweight(to_tsvector('simple', %s), 'B') ||"
+        "  setweight(to_tsvector('simple', %s), 'C'))",
+        [(uid, subject, body, participants, subject, body, participants)
+         for uid, subject, body, participants in documents]
+    )
+
+
+# the search table of each database vendor with full-text support, as it was in this migration
+BACKENDS = {
+    'sqlite': (create_sqlite_table, index_sqlite),
+    'postgresql': (create_postgres_table, index_postgres),
+}
+
+
+def create_search_index(apps, schema_editor):
+    """
+    Creates the full-text search table for this database and indexes every existing email.
+    The table is replaced by 0024_contentless_search_index, so this keeps its own copy of the
+    table's original layout and documents.
+    """
+
+    connection = schema_editor.connection
+    if connection.vendor not in BACKENDS:
+        return    # searched with LIKE queries, without an index
+    create_table, index = BACKENDS[connection.vendor]
+
+    Email = apps.get_model('app', 'Email')
+    MailboxEntry = apps.get_model('app', 'MailboxEntry')
+    db = connection.alias
+
+    # look up each email's participants from its mailbox entries
+    participants = {}
+    for uid, sender, recipients in MailboxEntry.objects.using(db).values_list(
+            'email', 'sender_address', 'recipient_addresses').iterator():
+        participants[uid] = (sender, recipients)
+
+    with connection.cursor() as cursor:
+        create_table(cursor)
+        index(cursor, [
+            (uid, subject, strip_tags(body or ''), '{} {}'.format(*participants.get(uid, ('', ''))))
+            for uid, subject, body in Email.objects.using(db).values_list('uid', 'subject', 'body').iterator()
+        ])
+
+
+def drop_search_index(apps, schema_editor):
+    """
+    Drops the full-text search table.
+    """
+
+    if schema_editor.connection.vendor in BACKENDS:
+        schema_editor.execute("DROP TABLE IF EXISTS app_email_fts")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0009_mailboxentry'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
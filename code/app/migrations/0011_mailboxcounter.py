@@ -0,0 +1,49 @@
+# Generated by Django 4.1.8 on 2026-10-17 00:21
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Count, Q
+
+
+def populate_counters(apps, schema_editor):
+    """
+    Computes the counters of every user with existing mail.
+    Mirrors app.counters.compute_counts using the historical models.
+    """
+
+    MailboxEntry = apps.get_model('app', 'MailboxEntry')
+    MailboxCounter = apps.get_model('app', 'MailboxCounter')
+    db = schema_editor.connection.alias
+
+    inbox = Q(folder='INBOX', is_archived=False)
+    counts = MailboxEntry.objects.using(db).values('user').annotate(
+        unread=Count('uid', filter=inbox & Q(is_read=False)),
+        inbox=Count('uid', filter=inbox),
+        outbox=Count('uid', filter=Q(folder='OUTBOX')),
+        drafts=Count('uid', filter=Q(folder='DRAFTS')),
+    ).order_by('user')
+    MailboxCounter.objects.using(db).bulk_create([
+        MailboxCounter(user_id=row.pop('user'), **row) for row in counts
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0010_email_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MailboxCounter',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('unread', models.IntegerField(default=0)),
+                ('inbox', models.IntegerField(default=0)),
+                ('outbox', models.IntegerField(default=0)),
+                ('drafts', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(populate_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 4.1.8 on 2026-10-17 00:33
+
+import app.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0012_blob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='attachment',
+            name='height',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='attachment',
+            name='image_size',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='attachment',
+            name='size',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='attachment',
+            name='thumbnail',
+            field=models.ImageField(blank=True, storage=app.storage.ContentAddressedStorage(), upload_to='uploads/thumbnails/'),
+        ),
+        migrations.AddField(
+            model_name='attachment',
+            name='thumbnail_size',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='attachment',
+            name='width',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='attachment',
+            name='image',
+            field=models.ImageField(blank=True, storage=app.storage.ContentAddressedStorage(), upload_to='uploads/images/%Y/%m/%d/'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.1.8 on 2026-10-17 00:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0014_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='email',
+            name='version',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='mailboxentry',
+            name='version',
+            field=models.PositiveIntegerField(default=1),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.1.8 on 2026-10-17 00:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0015_email_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mailboxcounter',
+            name='changed_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='mailboxcounter',
+            name='version',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.1.8 on 2026-10-17 01:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0016_mailbox_version'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='mailboxentry',
+            name='mailbox_folder_page_idx',
+        ),
+        migrations.AddIndex(
+            model_name='customuser',
+            index=models.Index(fields=['email'], name='user_email_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mailboxentry',
+            index=models.Index(condition=models.Q(('is_archived', False)), fields=['user', 'folder', '-sent_at', '-uid'], name='mailbox_folder_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mailboxentry',
+            index=models.Index(fields=['user', 'email'], name='mailbox_user_email_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='recipient',
+            index=models.Index(fields=['user', 'email'], name='recipient_user_email_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='customuser',
+            constraint=models.UniqueConstraint(condition=models.Q(('email', ''), _negated=True), fields=('email',), name='unique_user_email'),
+        ),
+    ]
@@ -0,0 +1,65 @@
+# Generated by Django 4.1.8 on 2026-10-17 01:21
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0018_user_shards'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedBody',
+            fields=[
+                ('email', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='archived_body', serialize=False, to='app.email')),
+                ('body', models.BinaryField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ArchivedEntry',
+            fields=[
+                ('uid', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('folder', models.CharField(choices=[('INBOX', 'Inbox'), ('OUTBOX', 'Outbox'), ('DRAFTS', 'Drafts')], max_length=20)),
+                ('sent_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('subject', models.TextField()),
+                ('sender_address', models.CharField(max_length=254)),
+                ('recipient_addresses', models.TextField()),
+                ('is_read', models.BooleanField(default=False)),
+                ('is_forward', models.BooleanField(default=False)),
+                ('version', models.PositiveIntegerField(default=1)),
+                ('archived_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='mailboxentry',
+            index=models.Index(fields=['sent_at'], name='mailbox_age_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mailboxentry',
+            index=models.Index(condition=models.Q(('is_archived', True)), fields=['uid'], name='mailbox_archived_idx'),
+        ),
+        migrations.AddField(
+            model_name='archivedentry',
+            name='email',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='app.email'),
+        ),
+        migrations.AddField(
+            model_name='archivedentry',
+            name='user',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='archivedentry',
+            index=models.Index(fields=['user', '-sent_at', '-uid'], name='archived_folder_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedentry',
+            index=models.Index(fields=['user', 'email'], name='archived_user_email_idx'),
+        ),
+    ]
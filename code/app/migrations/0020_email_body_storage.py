@@ -0,0 +1,24 @@
+# Generated by Django 4.1.8 on 2026-10-17 01:29
+
+import app.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0019_archive_tables'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='email',
+            name='body_data',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='email',
+            name='body_file',
+            field=models.FileField(blank=True, null=True, storage=app.storage.ContentAddressedStorage(), upload_to='bodies/'),
+        ),
+    ]
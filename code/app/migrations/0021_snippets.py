@@ -0,0 +1,84 @@
+# Generated by Django 4.1.8 on 2026-10-17 01:31
+
+import zlib
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+from django.utils.html import strip_tags
+
+SNIPPET_LENGTH = 120
+
+
+def make_snippet(body):
+    text = ' '.join(strip_tags(body or '').split())
+    if len(text) <= SNIPPET_LENGTH:
+        return text
+    return text[:SNIPPET_LENGTH - 3].rstrip() + '...'
+
+
+def populate_snippets(apps, schema_editor):
+    """
+    Computes the snippet of every existing email, a batch at a time, and copies it to its entries.
+    Mirrors app.bodies.make_snippet and get_body using the historical models.
+    """
+
+    Email = apps.get_model('app', 'Email')
+    ArchivedBody = apps.get_model('app', 'ArchivedBody')
+    MailboxEntry = apps.get_model('app', 'MailboxEntry')
+    ArchivedEntry = apps.get_model('app', 'ArchivedEntry')
+    db = schema_editor.connection.alias
+
+    last_uid = None
+    while True:
+        emails = Email.objects.using(db).order_by('uid').only('uid', 'body', 'body_data', 'body_file')
+        if last_uid is not None:
+            emails = emails.filter(uid__gt=last_uid)
+        emails = list(emails[:500])
+        if not emails:
+            break
+        last_uid = emails[-1].uid
+
+        archived = dict(ArchivedBody.objects.using(db).filter(email__in=emails).values_list('email', 'body'))
+        for email in emails:
+            if email.body is not None:
+                body = email.body
+            elif email.body_data is not None:
+                body = zlib.decompress(email.body_data).decode()
+            elif email.body_file:
+                with email.body_file.open('rb') as file:
+                    body = zlib.decompress(file.read()).decode()
+            elif email.uid in archived:
+                body = zlib.decompress(archived[email.uid]).decode()
+            else:
+                body = ''
+            email.snippet = make_snippet(body)
+        Email.objects.using(db).bulk_update(emails, ['snippet'])
+
+    for model in (MailboxEntry, ArchivedEntry):
+        model.objects.using(db).update(snippet=Subquery(Email.objects.filter(uid=OuterRef('email')).values('snippet')))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0020_email_body_storage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archivedentry',
+            name='snippet',
+            field=models.CharField(blank=True, default='', max_length=200),
+        ),
+        migrations.AddField(
+            model_name='email',
+            name='snippet',
+            field=models.CharField(blank=True, default='', max_length=200),
+        ),
+        migrations.AddField(
+            model_name='mailboxentry',
+            name='snippet',
+            field=models.CharField(blank=True, default='', max_length=200),
+        ),
+        migrations.RunPython(populate_snippets, migrations.RunPython.noop),
+    ]
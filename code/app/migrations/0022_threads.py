@@ -0,0 +1,108 @@
+# Generated by Django 4.1.8 on 2026-10-17 01:34
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, F, Max, Q
+import django.db.models.deletion
+import django.utils.timezone
+import uuid
+
+
+def populate_threads(apps, schema_editor):
+    """
+    Starts a thread for every existing email and summarizes each user's threads.
+    Mirrors app.threads.count_threads using the historical models.
+    """
+
+    Email = apps.get_model('app', 'Email')
+    MailboxEntry = apps.get_model('app', 'MailboxEntry')
+    ArchivedEntry = apps.get_model('app', 'ArchivedEntry')
+    MailboxThread = apps.get_model('app', 'MailboxThread')
+    db = schema_editor.connection.alias
+
+    # every existing email starts its own thread
+    Email.objects.using(db).update(thread=F('uid'))
+    threads = {}
+    for model in (MailboxEntry, ArchivedEntry):
+        model.objects.using(db).update(thread=F('email'))
+        summaries = model.objects.using(db).exclude(folder='DRAFTS').values('user', 'thread').annotate(
+            count=Count('uid'),
+            unread=Count('uid', filter=Q(folder='INBOX', is_read=False)),
+            last_activity=Max('sent_at'),
+            subject=Max('subject'),
+        ).order_by()
+        for row in summaries.iterator():
+            key = (row.pop('user'), row.pop('thread'))
+            if key in threads:
+                threads[key]['count'] += row['count']
+                threads[key]['unread'] += row['unread']
+                threads[key]['last_activity'] = max(threads[key]['last_activity'], row['last_activity'])
+            else:
+                threads[key] = row
+
+    MailboxThread.objects.using(db).bulk_create([
+        MailboxThread(user_id=user_id, thread=thread, **row) for (user_id, thread), row in threads.items()
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0021_snippets'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MailboxThread',
+            fields=[
+                ('uid', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('thread', models.UUIDField()),
+                ('subject', models.TextField()),
+                ('count', models.IntegerField(default=0)),
+                ('unread', models.IntegerField(default=0)),
+                ('last_activity', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='archivedentry',
+            name='thread',
+            field=models.UUIDField(default=uuid.uuid4),
+        ),
+        migrations.AddField(
+            model_name='email',
+            name='parent',
+            field=models.UUIDField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='email',
+            name='thread',
+            field=models.UUIDField(default=uuid.uuid4),
+        ),
+        migrations.AddField(
+            model_name='mailboxentry',
+            name='thread',
+            field=models.UUIDField(default=uuid.uuid4),
+        ),
+        migrations.AddIndex(
+            model_name='archivedentry',
+            index=models.Index(fields=['user', 'thread', 'sent_at', 'uid'], name='archived_thread_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mailboxentry',
+            index=models.Index(fields=['user', 'thread', 'sent_at', 'uid'], name='mailbox_thread_idx'),
+        ),
+        migrations.AddField(
+            model_name='mailboxthread',
+            name='user',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='mailboxthread',
+            index=models.Index(fields=['user', '-last_activity', '-uid'], name='thread_activity_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='mailboxthread',
+            constraint=models.UniqueConstraint(fields=('user', 'thread'), name='unique_user_thread'),
+        ),
+        migrations.RunPython(populate_threads, migrations.RunPython.noop),
+    ]
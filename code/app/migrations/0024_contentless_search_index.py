@@ -0,0 +1,139 @@
+import zlib
+
+from django.db import DEFAULT_DB_ALIAS, migrations
+from django.utils.html import strip_tags
+
+BATCH_SIZE = 500
+
+
+def read_body(email, archived):
+    """
+    Returns an email's body, wherever it's stored. Mirrors app.bodies.get_body using the historical models.
+    """
+
+    if email.body is not None:
+        return email.body
+    if email.body_data is not None:
+        return zlib.decompress(email.body_data).decode()
+    if email.body_file:
+        with email.body_file.open('rb') as file:
+            return zlib.decompress(file.read()).decode()
+    if email.uid in archived:
+        return zlib.decompress(archived[email.uid]).decode()
+    return ''
+
+
+def build_documents(apps, db, emails):
+    """
+    Builds the (uid, subject, body, participants) documents of a batch of emails.
+    Mirrors app.search.build_documents using the historical models.
+    """
+
+    ArchivedBody = apps.get_model('app', 'ArchivedBody')
+    CustomUser = apps.get_model('app', 'CustomUser')
+    Recipient = apps.get_model('app', 'Recipient')
+    Sender = apps.get_model('app', 'Sender')
+
+    senders = dict(Sender.objects.using(db).filter(email__in=emails).values_list('email', 'user'))
+    recipients = {}
+    for uid, user_id in Recipient.objects.using(db).filter(email__in=emails).values_list('email', 'user'):
+        recipients.setdefault(uid, []).append(user_id)
+
+    # users are always on 'default', while their mail may be on a shard
+    user_ids = set(senders.values()).union(*recipients.values())
+    addresses = dict(CustomUser.objects.using(DEFAULT_DB_ALIAS).filter(pk__in=user_ids).values_list('pk', 'email'))
+    archived = dict(ArchivedBody.objects.using(db).filter(email__in=emails).values_list('email', 'body'))
+
+    return [(
+        email.uid,
+        email.subject,
+        strip_tags(read_body(email, archived)),
+        ' '.join([
+            addresses.get(senders.get(email.uid), ''),
+            ' '.join(addresses.get(user_id, '') for user_id in recipients.get(email.uid, [])),
+        ])
+    ) for email in emails]
+
+
+def create_sqlite_index(cursor):
+    cursor.execute("DROP TABLE IF EXISTS app_email_fts")
+    cursor.execute("DROP TABLE IF EXISTS app_email_fts_docs")
+    cursor.execute("CREATE TABLE app_email_fts_docs (docid integer PRIMARY KEY, uid char(32) NOT NULL UNIQUE)")
+    cursor.execute("CREATE VIRTUAL TABLE app_email_fts USING fts5(subject, body, participants, content='')")
+
+
+def index_sqlite(cursor, documents):
+    for uid, subject, body, participants in documents:
+        cursor.execute("INSERT INTO app_email_fts_docs (uid) VALUES (%s)", [uid.hex])
+        cursor.execute(
+            "INSERT INTO app_email_fts (rowid, subject, body, participants) VALUES (%s, %s, %s, %s)",
+            [cursor.lastrowid, subject, body, participants]
+        )
+
+
+def create_postgres_index(cursor):
+    cursor.execute("DROP TABLE IF EXISTS app_email_fts")
+    cursor.execute(
+        "CREATE TABLE app_email_fts ("
+        "  uid uuid PRIMARY KEY REFERENCES app_email (uid) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED,"
+        "  document tsvector NOT NULL"
+        ")"
+    )
+    cursor.execute("CREATE INDEX app_email_fts_document_idx ON app_email_fts USING gin (document)")
+
+
+def index_postgres(cursor, documents):
+    cursor.executemany(
+        "INSERT INTO app_email_fts (uid, document)"
+        " VALUES (%s,"
+        "  setweight(to_tsvector('simple', %s), 'A') ||"
+        "  setweight(to_tsvector('simple', %s), 'B') ||"
+        "  setweight(to_tsvector('simple', %s), 'C'))",
+        documents
+    )
+
+
+BACKENDS = {
+    'sqlite': (create_sqlite_index, index_sqlite),
+    'postgresql': (create_postgres_index, index_postgres),
+}
+
+
+def recreate_search_index(apps, schema_editor):
+    """
+    Replaces the full-text search table, which kept a copy of every body, with one that only
+    keeps the index (see app/search.py), and re-indexes every email on this database.
+    """
+
+    connection = schema_editor.connection
+    if connection.vendor not in BACKENDS:
+        return    # searched with LIKE queries, without an index
+    create_index, index = BACKENDS[connection.vendor]
+
+    Email = apps.get_model('app', 'Email')
+    db = connection.alias
+
+    with connection.cursor() as cursor:
+        create_index(cursor)
+
+        last_uid = None
+        while True:
+            emails = Email.objects.using(db).order_by('uid').only('uid', 'subject', 'body', 'body_data', 'body_file')
+            if last_uid is not None:
+                emails = emails.filter(uid__gt=last_uid)
+            emails = list(emails[:BATCH_SIZE])
+            if not emails:
+                break
+            last_uid = emails[-1].uid
+            index(cursor, build_documents(apps, db, emails))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0023_generation'),
+    ]
+
+    operations = [
+        migrations.RunPython(recreate_search_index, migrations.RunPython.noop),
+    ]
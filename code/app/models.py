@@ -2,6 +2,9 @@ from uuid import uuid4
 
 from django.db import models
 from django.contrib.auth.models import AbstractUser
+from django.utils import timezone
+
+from .storage import ContentAddressedStorage
 
 
 class CustomUser(AbstractUser):
@@ -12,6 +15,18 @@ class CustomUser(AbstractUser):
 
     email_password = models.CharField("email_password", max_length=128)
     failed_attempts = models.IntegerField(default=0)
+    # database holding the user's mail, or blank for 'default' (see shards.py)
+    shard = models.CharField(max_length=100, blank=True, default='')
+
+    class Meta(AbstractUser.Meta):
+        indexes = [
+            # address lookups when sending and logging in to email
+            models.Index(fields=['email'], name='user_email_idx'),
+        ]
+        constraints = [
+            # every address belongs to one user, though users may have no address
+            models.UniqueConstraint(fields=['email'], condition=~models.Q(email=''), name='unique_user_email'),
+        ]
 
 
 class Email(models.Model):
@@ -22,11 +37,24 @@ class Email(models.Model):
     default_subject = 'bbc1ca1f-9f31-4c59-9c12-6af7f3c4b2eb'
 
     uid = models.UUIDField(primary_key=True, default=uuid4, editable=False)
+    # the body is stored in one of these, depending on its size (see bodies.py)
     body = models.TextField(blank=True, null=True)
+    body_data = models.BinaryField(blank=True, null=True)
+    body_file = models.FileField(upload_to='bodies/', storage=ContentAddressedStorage(), blank=True, null=True)
+    # start of the body as plain text, shown in listings without loading the body
+    snippet = models.CharField(max_length=200, blank=True, default='')
     subject = models.TextField(blank=False, default=default_subject)
+    sent_at = models.DateTimeField(default=timezone.now, db_index=True)
+    # bumped whenever the email's rows are redisplayed differently, expiring their cached fragments
+    version = models.PositiveIntegerField(default=1)
+    # conversation the email belongs to, and the email it replies to or forwards (see threads.py);
+    # the parent is a plain uid since it may not have been copied to every participant's shard
+    thread = models.UUIDField(default=uuid4)
+    parent = models.UUIDField(blank=True, null=True)
 
     def __str__(self):
-        return f"{self.subject}: {self.body}"
+        # the body may be compressed or in a blob (see bodies.py), but the snippet is always here
+        return f"{self.subject}: {self.snippet}"
 
 
 class Sender(models.Model):
@@ -35,10 +63,18 @@ class Sender(models.Model):
     """
 
     uid = models.UUIDField(primary_key=True, default=uuid4, editable=False)
-    user = models.ForeignKey(to='CustomUser', on_delete=models.CASCADE)
+    # users may be on another database than their mail (see shards.py)
+    user = models.ForeignKey(to='CustomUser', on_delete=models.CASCADE, db_constraint=False)
     email = models.ForeignKey(to='Email', on_delete=models.CASCADE, related_name='sender_email')
     is_draft = models.BooleanField(default=True)
     is_forward = models.BooleanField(default=False)
+    sent_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            # outbox pages: newest sent emails first
+            models.Index(fields=['user', 'is_draft', '-sent_at', '-uid'], name='sender_folder_page_idx'),
+        ]
 
     def __str__(self):
         return f"{self.user}"
@@ -50,17 +86,188 @@ class Recipient(models.Model):
     """
 
     uid = models.UUIDField(primary_key=True, default=uuid4, editable=False)
-    user = models.ForeignKey(to='CustomUser', on_delete=models.CASCADE)
+    user = models.ForeignKey(to='CustomUser', on_delete=models.CASCADE, db_constraint=False)
     email = models.ForeignKey(to='Email', on_delete=models.CASCADE)
     is_sent = models.BooleanField(default=False)
     is_read = models.BooleanField(default=False)
     is_forward = models.BooleanField(default=False)
     is_archived = models.BooleanField(default=False)
+    sent_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            # inbox pages: newest received emails first
+            models.Index(fields=['user', 'is_sent', '-sent_at', '-uid'], name='recipient_folder_page_idx'),
+            # marking an email read or archived
+            models.Index(fields=['user', 'email'], name='recipient_user_email_idx'),
+        ]
 
     def __str__(self):
         return f"{self.user}"
 
 
+
+class MailboxEntry(models.Model):
+    """
+    Denormalized row of a user's mailbox folder, written in the same transaction as the send.
+    Folders are read from this single indexed table without joining Email, Sender, or Recipient.
+    """
+
+    INBOX = "INBOX"
+    OUTBOX = "OUTBOX"
+    DRAFTS = "DRAFTS"
+    FOLDER_CHOICES = [
+        (INBOX, 'Inbox'),
+        (OUTBOX, 'Outbox'),
+        (DRAFTS, 'Drafts'),
+    ]
+
+    uid = models.UUIDField(primary_key=True, default=uuid4, editable=False)
+    user = models.ForeignKey(to='CustomUser', on_delete=models.CASCADE, db_constraint=False)
+    email = models.ForeignKey(to='Email', on_delete=models.CASCADE)
+    folder = models.CharField(max_length=20, choices=FOLDER_CHOICES)
+    sent_at = models.DateTimeField(default=timezone.now)
+    subject = models.TextField()
+    sender_address = models.CharField(max_length=254)
+    recipient_addresses = models.TextField()
+    snippet = models.CharField(max_length=200, blank=True, default='')
+    thread = models.UUIDField(default=uuid4)
+    is_read = models.BooleanField(default=False)
+    is_forward = models.BooleanField(default=False)
+    is_archived = models.BooleanField(default=False)
+    version = models.PositiveIntegerField(default=1)
+
+    class Meta:
+        indexes = [
+            # folder pages: newest emails first, leaving archived emails out of the index
+            models.Index(
+                fields=['user', 'folder', '-sent_at', '-uid'],
+                condition=models.Q(is_archived=False),
+                name='mailbox_folder_idx'
+            ),
+            # marking an email read or archived, search results, and attachment permissions
+            models.Index(fields=['user', 'email'], name='mailbox_user_email_idx'),
+            # finding entries to move into the archive (see archiving.py)
+            models.Index(fields=['sent_at'], name='mailbox_age_idx'),
+            models.Index(fields=['uid'], condition=models.Q(is_archived=True), name='mailbox_archived_idx'),
+            # conversation pages (see threads.py)
+            models.Index(fields=['user', 'thread', 'sent_at', 'uid'], name='mailbox_thread_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user}: {self.folder}"
+
+
+class ArchivedEntry(models.Model):
+    """
+    Mailbox entry moved out of the MailboxEntry table into cold storage, when it was archived
+    or grew old (see archiving.py). The archive folder is read from this table, so the folder
+    pages only ever touch recent mail.
+    """
+
+    uid = models.UUIDField(primary_key=True, default=uuid4, editable=False)
+    user = models.ForeignKey(to='CustomUser', on_delete=models.CASCADE, db_constraint=False)
+    email = models.ForeignKey(to='Email', on_delete=models.CASCADE)
+    # the folder the entry was archived from
+    folder = models.CharField(max_length=20, choices=MailboxEntry.FOLDER_CHOICES)
+    sent_at = models.DateTimeField(default=timezone.now)
+    subject = models.TextField()
+    sender_address = models.CharField(max_length=254)
+    recipient_addresses = models.TextField()
+    snippet = models.CharField(max_length=200, blank=True, default='')
+    thread = models.UUIDField(default=uuid4)
+    is_read = models.BooleanField(default=False)
+    is_forward = models.BooleanField(default=False)
+    version = models.PositiveIntegerField(default=1)
+    archived_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            # archive folder pages: newest emails first
+            models.Index(fields=['user', '-sent_at', '-uid'], name='archived_folder_idx'),
+            # marking an email read, search results, and attachment permissions
+            models.Index(fields=['user', 'email'], name='archived_user_email_idx'),
+            # conversation pages (see threads.py)
+            models.Index(fields=['user', 'thread', 'sent_at', 'uid'], name='archived_thread_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user}: archived from {self.folder}"
+
+
+class ArchivedBody(models.Model):
+    """
+    Compressed body of an email that's only in archives, kept out of the email table until it's viewed.
+    """
+
+    email = models.OneToOneField(to='Email', on_delete=models.CASCADE, primary_key=True, related_name='archived_body')
+    body = models.BinaryField()
+
+    def __str__(self):
+        return f"{self.email_id}: {len(self.body)} bytes"
+
+
+class MailboxCounter(models.Model):
+    """
+    Per-user folder counts shown in the navigation bar.
+    Updated atomically with F() expressions as mail is sent, read, and archived.
+    The version and time of the last change validate conditional GETs of the user's pages.
+    """
+
+    user = models.OneToOneField(to='CustomUser', on_delete=models.CASCADE, primary_key=True, db_constraint=False)
+    unread = models.IntegerField(default=0)
+    inbox = models.IntegerField(default=0)
+    outbox = models.IntegerField(default=0)
+    drafts = models.IntegerField(default=0)
+    version = models.PositiveBigIntegerField(default=0)
+    changed_at = models.DateTimeField(null=True)
+
+    def __str__(self):
+        return f"{self.user}: {self.unread} unread"
+
+class MailboxThread(models.Model):
+    """
+    Per-user summary of a conversation shown in the thread list (see threads.py).
+    Updated atomically with F() expressions as mail is delivered and read, so the list
+    never has to group the user's mailbox entries.
+    """
+
+    uid = models.UUIDField(primary_key=True, default=uuid4, editable=False)
+    user = models.ForeignKey(to='CustomUser', on_delete=models.CASCADE, db_constraint=False)
+    thread = models.UUIDField()
+    # subject of the email that started the conversation for this user
+    subject = models.TextField()
+    count = models.IntegerField(default=0)
+    unread = models.IntegerField(default=0)
+    last_activity = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'thread'], name='unique_user_thread'),
+        ]
+        indexes = [
+            # thread list pages: most recently active first
+            models.Index(fields=['user', '-last_activity', '-uid'], name='thread_activity_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user}: {self.subject} ({self.count})"
+
+
+class Blob(models.Model):
+    """
+    Defines the database object representing one unique attachment file.
+    Attachments with the same content share a blob, which counts how many of them use it.
+    """
+
+    sha256 = models.CharField(max_length=64, primary_key=True)
+    size = models.BigIntegerField(default=0)
+    refcount = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.sha256}: {self.refcount} references"
+
+
 class Attachment(models.Model):
     """
     Defines the database object representing an email attachment.
@@ -77,10 +284,19 @@ class Attachment(models.Model):
 
     uid = models.UUIDField(primary_key=True, default=uuid4, editable=False)
     name = models.CharField(max_length=120, default="")
-    email = models.ForeignKey(to='Email', on_delete=models.CASCADE)
+    # attachments stay on 'default' while their emails are copied to shards, so they outlive any one copy
+    email = models.ForeignKey(to='Email', on_delete=models.DO_NOTHING, db_constraint=False)
     type = models.CharField(max_length=20, choices=ATTACH_CHOICES, default=FILE)
-    file = models.FileField(upload_to='uploads/files/%Y/%m/%d/')
-    image = models.ImageField(upload_to='uploads/images/%Y/%m/%d/')
+    file = models.FileField(upload_to='uploads/files/%Y/%m/%d/', storage=ContentAddressedStorage())
+
+    # smaller variants of image attachments, filled in by the image pipeline (see images.py)
+    image = models.ImageField(upload_to='uploads/images/%Y/%m/%d/', storage=ContentAddressedStorage(), blank=True)
+    thumbnail = models.ImageField(upload_to='uploads/thumbnails/', storage=ContentAddressedStorage(), blank=True)
+    width = models.IntegerField(null=True, blank=True)
+    height = models.IntegerField(null=True, blank=True)
+    size = models.BigIntegerField(null=True, blank=True)
+    image_size = models.BigIntegerField(null=True, blank=True)
+    thumbnail_size = models.BigIntegerField(null=True, blank=True)
 
 
 class Note(models.Model):
@@ -93,3 +309,67 @@ class Note(models.Model):
     def __str__(self):
         return f"{self.title}: {self.body}"
 
+
+class Job(models.Model):
+    """
+    Defines the database object representing a unit of background work, run by `manage.py runworker`.
+    See jobs.py for how jobs are queued and claimed.
+    """
+
+    QUEUED = "QUEUED"
+    RUNNING = "RUNNING"
+    DONE = "DONE"
+    FAILED = "FAILED"
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    id = models.BigAutoField(primary_key=True)
+    name = models.CharField(max_length=100)
+    args = models.JSONField(default=list)
+    kwargs = models.JSONField(default=dict)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=QUEUED)
+    attempts = models.IntegerField(default=0)
+    max_attempts = models.IntegerField(default=3)
+    run_at = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=100, blank=True, default='')
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            # workers claim the oldest due job
+            models.Index(fields=['status', 'run_at'], name='job_queue_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.name} #{self.id}: {self.status}"
+
+
+class Schedule(models.Model):
+    """
+    Defines the database object recording when a periodic job is next due.
+    """
+
+    name = models.CharField(max_length=100, primary_key=True)
+    next_run_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.name}: {self.next_run_at}"
+
+
+class Generation(models.Model):
+    """
+    Defines the database object holding a named counter that every process can see,
+    bumped to tell other processes their in-memory copy of something is stale.
+    """
+
+    name = models.CharField(max_length=100, primary_key=True)
+    value = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.name}: {self.value}"
@@ -0,0 +1,111 @@
+"""
+Keyset (cursor) pagination for the mailbox folders.
+Pages are ordered newest first by ('sent_at', 'uid') and each page starts right
+after the last row of the previous one, so page N costs the same as page 1.
+"""
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+from uuid import UUID
+
+from django.db.models import Q
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+
+
+def encode_cursor(position, uid):
+    """
+    Encodes the position of a row into an opaque, URL-safe cursor.
+    The position is either a timestamp (folders) or a search rank (search results).
+    """
+
+    if isinstance(position, datetime):
+        raw = f"t|{position.isoformat()}|{uid}"
+    else:
+        raw = f"r|{float(position)!r}|{uid}"
+    return urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Decodes a cursor made by encode_cursor into a (position, uid) tuple.
+    Returns None if the cursor is missing or malformed.
+    """
+
+    if not cursor:
+        return None
+
+    try:
+        raw = urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        kind, position, uid = raw.split('|')
+        if kind == 't':
+            return datetime.fromisoformat(position), UUID(uid)
+        if kind == 'r':
+            return float(position), UUID(uid)
+    except ValueError:
+        pass
+
+    return None
+
+
+def get_page_params(request):
+    """
+    Reads the '?before=<cursor>&limit=<n>' page parameters from a request.
+    """
+
+    before = decode_cursor(request.GET.get('before'))
+
+    try:
+        limit = int(request.GET.get('limit', DEFAULT_LIMIT))
+    except ValueError:
+        limit = DEFAULT_LIMIT
+
+    return before, max(1, min(limit, MAX_LIMIT))
+
+
+def keyset_slice(queryset, before=None, limit=DEFAULT_LIMIT):
+    """
+    Returns the slice of a queryset holding the page after the 'before' cursor, plus one extra row.
+    The queryset must be a values() queryset including 'sent_at' and 'uid'.
+    """
+
+    if before is not None and isinstance(before[0], datetime):
+        sent_at, uid = before
+        queryset = queryset.filter(
+            Q(sent_at__lt=sent_at) | Q(sent_at=sent_at, uid__lt=uid),
+            sent_at__lte=sent_at
+        )
+
+    # fetch one extra row to find out if there is another page
+    return queryset.order_by('-sent_at', '-uid')[:limit + 1]
+
+
+def finish_page(rows, limit):
+    """
+    Trims the rows fetched from a keyset_slice() down to a page and returns it with the next cursor.
+    """
+
+    if len(rows) <= limit:
+        return rows, None
+
+    rows = rows[:limit]
+    return rows, encode_cursor(rows[-1]['sent_at'], rows[-1]['uid'])
+
+
+def keyset_page(queryset, before=None, limit=DEFAULT_LIMIT):
+    """
+    Returns one page of a queryset along with the cursor for the next page.
+    The queryset must be a values() queryset including 'sent_at' and 'uid'.
+    The next cursor is None when there are no more rows.
+    """
+
+    return finish_page(list(keyset_slice(queryset, before, limit)), limit)
+
+
+async def akeyset_page(queryset, before=None, limit=DEFAULT_LIMIT):
+    """
+    Async version of keyset_page().
+    """
+
+    return finish_page([row async for row in keyset_slice(queryset, before, limit)], limit)
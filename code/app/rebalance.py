@@ -0,0 +1,178 @@
+"""
+Moves a user's mail to another shard while they keep using the site (see shards.py).
+Their mail is copied to the new shard, and then they're switched over, so their next requests
+and any mail sent to them go to the new shard. Once requests that started on the old shard
+have had GRACE_PERIOD seconds to finish, whatever changed there in the meantime is copied
+again, and the user's mail is removed from the old shard. The second copy doesn't overwrite
+what the user did on the new shard in the meantime: rows are only replaced by newer versions,
+read and archived flags are merged, and the counters are recomputed from the merged mailbox.
+"""
+
+import time
+
+from django.db import connections, transaction
+from django.db.models import F, Value
+from django.db.models.functions import Greatest
+
+from .blobs import retain
+from .counters import recount
+from .models import (
+    ArchivedBody, ArchivedEntry, CustomUser, Email, MailboxCounter, MailboxEntry, MailboxThread, Recipient, Sender
+)
+from .search import build_documents, get_backend, remove_emails
+from .shards import copy_rows, shard_for, using_shard
+from .threads import rebuild_threads
+
+# seconds that requests which started on the old shard are given to finish
+GRACE_PERIOD = 5
+
+# fields of an entry that change with its email's version
+CONTENT_FIELDS = ('subject', 'snippet', 'sender_address', 'recipient_addresses', 'version')
+
+# flags of a user's rows that are only ever set, never cleared
+ENTRY_FLAGS = ('is_read', 'is_archived')
+ARCHIVED_FLAGS = ('is_read',)
+RECIPIENT_FLAGS = ('is_read', 'is_archived')
+
+
+def merge_flags(model, rows, flags, alias):
+    """
+    Sets the given flags on the copies of rows that have them set, leaving flags already set on the copies alone.
+    """
+
+    for flag in flags:
+        pks = [row.pk for row in rows if getattr(row, flag)]
+        if pks:
+            model.objects.using(alias).filter(pk__in=pks, **{flag: False}).update(**{flag: True})
+
+
+def copy_mailbox(user_id, source, target, batch_size=500):
+    """
+    Copies a user's mailbox entries, archived entries, and counters from one shard to another, along
+    with the emails they show, and indexes those emails on the new shard. Rows already on the new shard
+    are only updated to newer versions, and the counters only copied if there are none there yet.
+    Returns the uids of the entries copied.
+    """
+
+    copied = set()
+    for model, flags in ((MailboxEntry, ENTRY_FLAGS), (ArchivedEntry, ARCHIVED_FLAGS)):
+        last_uid = None
+        while True:
+            # fetch the next batch of the user's entries
+            entries = model.objects.using(source).filter(user=user_id).order_by('uid')
+            if last_uid is not None:
+                entries = entries.filter(uid__gt=last_uid)
+            entries = list(entries[:batch_size])
+            if not entries:
+                break
+            last_uid = entries[-1].uid
+
+            email_ids = {entry.email_id for entry in entries}
+            emails = list(Email.objects.using(source).filter(uid__in=email_ids))
+            bodies = ArchivedBody.objects.using(source).filter(email__in=email_ids)
+            senders = Sender.objects.using(source).filter(email__in=email_ids)
+            recipients = Recipient.objects.using(source).filter(email__in=email_ids)
+            with transaction.atomic(using=target), using_shard(target):
+                # new copies of emails refer to their body blobs
+                copied_ids = set(Email.objects.using(target).filter(uid__in=email_ids).values_list('uid', flat=True))
+                copy_rows(Email, emails, target)
+                retain([email.body_file.name for email in emails if email.body_file and email.uid not in copied_ids])
+                copy_rows(ArchivedBody, bodies, target)
+                copy_rows(Sender, senders, target)
+
+                # only the user's own recipient rows are brought up to date, since the others belong to other shards
+                copy_rows(Recipient, recipients, target)
+                merge_flags(Recipient, recipients.filter(user=user_id), RECIPIENT_FLAGS, target)
+
+                uids = [entry.uid for entry in entries]
+                if model is ArchivedEntry:
+                    # entries archived since the first copy keep their uid, and leave the mailbox
+                    MailboxEntry.objects.using(target).filter(uid__in=uids).delete()
+                else:
+                    # and entries archived on the new shard stay in its archive
+                    archived = set(ArchivedEntry.objects.using(target).filter(uid__in=uids).values_list('uid', flat=True))
+                    entries = [entry for entry in entries if entry.uid not in archived]
+
+                versions = dict(model.objects.using(target).filter(uid__in=uids).values_list('uid', 'version'))
+                copy_rows(model, [entry for entry in entries if entry.uid not in versions], target)
+                model.objects.using(target).bulk_update(
+                    [entry for entry in entries if entry.uid in versions and entry.version > versions[entry.uid]],
+                    CONTENT_FIELDS
+                )
+                merge_flags(model, entries, flags, target)
+
+                documents = build_documents(emails)
+                get_backend(connections[target]).index(connections[target], documents)
+            copied.update(uids)
+
+    copy_rows(MailboxCounter, MailboxCounter.objects.using(source).filter(user=user_id), target)
+    return copied
+
+
+def remove_mailbox(user_id, source, batch_size=500):
+    """
+    Removes a user's mailbox entries, archived entries, counters, and threads from a shard, along with
+    the emails no one else there has. Returns the number of entries removed.
+    """
+
+    removed = 0
+    for model in (MailboxEntry, ArchivedEntry):
+        while True:
+            entries = list(model.objects.using(source).filter(user=user_id).values_list('uid', 'email')[:batch_size])
+            if not entries:
+                break
+
+            email_ids = {email_id for _, email_id in entries}
+            with transaction.atomic(using=source):
+                model.objects.using(source).filter(uid__in=[uid for uid, _ in entries]).delete()
+
+                # the emails' Sender, Recipient, and ArchivedBody rows go with them
+                kept = {
+                    email_id for shown in (MailboxEntry, ArchivedEntry)
+                    for email_id in shown.objects.using(source).filter(email__in=email_ids).values_list('email', flat=True)
+                }
+                Email.objects.using(source).filter(uid__in=email_ids - kept).only('uid', 'body_file').delete()
+                remove_emails(email_ids - kept, connections[source])
+            removed += len(entries)
+
+    MailboxCounter.objects.using(source).filter(user=user_id).delete()
+    MailboxThread.objects.using(source).filter(user=user_id).delete()
+    return removed
+
+
+def move_user(user, target, grace_period=GRACE_PERIOD, batch_size=500):
+    """
+    Moves a user's mail to the target shard. Returns the number of mailbox entries moved.
+    """
+
+    source = shard_for(user)
+    if source == target:
+        return 0
+
+    first = copy_mailbox(user.pk, source, target, batch_size)
+
+    # from here on, the user's requests and new mail go to the target shard
+    CustomUser.objects.filter(pk=user.pk).update(shard=target)
+    user.shard = target
+    time.sleep(grace_period)
+
+    # catch up with what changed on the old shard during the copy, including entries deleted there
+    moved = copy_mailbox(user.pk, source, target, batch_size)
+    gone = list(first - moved)
+    for start in range(0, len(gone), batch_size):
+        with transaction.atomic(using=target):
+            for model in (MailboxEntry, ArchivedEntry):
+                model.objects.using(target).filter(uid__in=gone[start:start + batch_size]).delete()
+
+    # the new shard's version must move past any the user's pages were validated with on the old one
+    source_version = MailboxCounter.objects.using(source).filter(user=user.pk).values_list(
+        'version', flat=True).first() or 0
+    remove_mailbox(user.pk, source, batch_size)
+
+    # counters were adjusted on both shards during the move, and threads may have been joined on both,
+    # so both are recomputed from the merged mailbox
+    with using_shard(target):
+        MailboxCounter.objects.filter(user=user.pk).update(version=Greatest(F('version'), Value(source_version)))
+        recount([user.pk])
+        rebuild_threads([user.pk])
+    return len(moved)
@@ -0,0 +1,92 @@
+"""
+Routing of mailbox reads to read replicas, with read-your-writes.
+The mailbox pages in REPLICA_READ_VIEWS read from a random one of the DATABASE_REPLICAS,
+and everything else, every write included, uses the primary. A user whose mailbox changed
+in the last REPLICA_PIN_SECONDS (their counters record when) reads from the primary, since
+the replicas may not have the change yet, and so does a request once it has written anything.
+That covers mail a user just sent, read, or archived, as well as mail they just received.
+"""
+
+import random
+from contextvars import ContextVar
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.utils import timezone
+from django.utils.deprecation import MiddlewareMixin
+
+from .counters import request_counter
+
+# where the current request may read from: {'replica': bool, 'wrote': bool}, or None outside requests
+request_state = ContextVar('replica_request_state', default=None)
+
+
+def choose_replica():
+    """
+    Returns the alias of a random read replica, or None if there are none.
+    """
+
+    replicas = getattr(settings, 'DATABASE_REPLICAS', [])
+    return random.choice(replicas) if replicas else None
+
+
+def recently_changed(request):
+    """
+    Returns whether the logged in user's mailbox changed too recently for the replicas to have caught up.
+    """
+
+    changed_at = request_counter(request)['changed_at']
+    pin = timedelta(seconds=getattr(settings, 'REPLICA_PIN_SECONDS', 5))
+    return changed_at is not None and timezone.now() - changed_at < pin
+
+
+class ReplicaRouter:
+    """
+    Database router sending the reads of replica requests to the replicas, and everything else to the primary.
+    """
+
+    def db_for_read(self, model, **hints):
+        state = request_state.get()
+        if state is None:
+            return None
+        if not state['replica'] or state['wrote']:
+            return DEFAULT_DB_ALIAS
+        return choose_replica() or DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        # the rest of the request must see what it wrote
+        state = request_state.get()
+        if state is not None:
+            state['wrote'] = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replicas hold copies of the primary's rows
+        databases = {DEFAULT_DB_ALIAS, *getattr(settings, 'DATABASE_REPLICAS', [])}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+class ReplicaMiddleware(MiddlewareMixin):
+    """
+    Lets GETs of the REPLICA_READ_VIEWS read from the replicas, unless the user's mailbox just changed.
+    """
+
+    def process_request(self, request):
+        request_state.set({'replica': False, 'wrote': False})
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if (
+            getattr(settings, 'DATABASE_REPLICAS', [])
+            and request.method in ('GET', 'HEAD')
+            and request.resolver_match.url_name in getattr(settings, 'REPLICA_READ_VIEWS', [])
+            and request.user.is_authenticated
+            and not recently_changed(request)
+        ):
+            request_state.get()['replica'] = True
+
+    def process_response(self, request, response):
+        request_state.set(None)
+        return response
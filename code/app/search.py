@@ -0,0 +1,353 @@
+"""
+Full-text search over email subjects, bodies, and participant addresses.
+SQLite deployments use a contentless FTS5 virtual table and PostgreSQL deployments use a
+tsvector column with a GIN index. Both are stored in the 'app_email_fts' table, which is
+updated whenever an email is sent and queried for ranked results. Only the index is stored,
+not a second copy of each body, so the snippets of a page of results are cut from the bodies.
+A user's archived emails (see archiving.py) are searched along with their mailbox.
+"""
+
+import re
+
+from django.db import DEFAULT_DB_ALIAS, connection as default_connection, connections, router
+from django.db.models import Q
+from django.utils.html import escape, strip_tags
+from django.utils.safestring import mark_safe
+
+from .bodies import BODY_FIELDS, get_bodies, get_body
+from .models import ArchivedEntry, CustomUser, Email, Sender, Recipient, MailboxEntry
+from .pagination import DEFAULT_LIMIT, encode_cursor
+from .shards import shard_for, using_shard
+
+# marks the start and end of each matched term in a snippet
+HIGHLIGHT_START = '\x02'
+HIGHLIGHT_END = '\x03'
+
+# number of characters shown on either side of the match in a snippet
+SNIPPET_CONTEXT = 60
+
+
+def build_document(uid, subject, body, sender_address, recipient_addresses):
+    """
+    Builds the (uid, subject, body, participants) document indexed for an email.
+    The body is indexed as plain text, without any of its HTML markup.
+    """
+
+    return uid, subject, strip_tags(body or ''), f"{sender_address} {recipient_addresses}"
+
+
+def highlight(text, query):
+    """
+    Returns the part of a plain text around the first match of a query, with the matched words marked,
+    or None if the query doesn't match. Like the index, the words must appear next to each other,
+    and the last word may match as a prefix.
+    """
+
+    words = re.findall(r'\w+', query)
+    if not words:
+        return None
+    pattern = re.compile(r'(?<!\w)' + r'\W+'.join(map(re.escape, words)) + r'\w*', re.IGNORECASE)
+    match = pattern.search(text)
+    if match is None:
+        return None
+
+    # widen the match to whole words on either side
+    start = max(match.start() - SNIPPET_CONTEXT, 0)
+    end = min(match.end() + SNIPPET_CONTEXT, len(text))
+    if start > 0:
+        start = text.find(' ', start, match.start()) + 1 or match.start()
+    if end < len(text):
+        space = text.rfind(' ', match.end(), end)
+        end = space if space != -1 else match.end()
+
+    snippet = pattern.sub(lambda found: HIGHLIGHT_START + found.group() + HIGHLIGHT_END, text[start:end])
+    return ('...' if start > 0 else '') + snippet + ('...' if end < len(text) else '')
+
+
+def make_snippets(results, entries, query):
+    """
+    Returns the raw snippets of a page of results as {uid: snippet}, showing where each matched its body.
+    The stored snippet is used when the match is in it, and the other bodies are loaded in one go,
+    since the match may be further in than the stored snippet goes. Emails only matched by their
+    subject or participants show their stored snippet.
+    """
+
+    snippets = {uid: highlight(entries[uid]['snippet'], query) for uid in results}
+    missing = [uid for uid, snippet in snippets.items() if snippet is None]
+    if missing:
+        emails = Email.objects.filter(uid__in=missing).only('uid', *BODY_FIELDS)
+        for uid, body in get_bodies(emails).items():
+            snippets[uid] = highlight(' '.join(strip_tags(body or '').split()), query)
+
+    return {uid: snippet or entries[uid]['snippet'] for uid, snippet in snippets.items()}
+
+
+def format_snippet(snippet):
+    """
+    Escapes a raw snippet and wraps its matched terms in <mark> tags.
+    """
+
+    snippet = escape(snippet or '')
+    return mark_safe(snippet.replace(HIGHLIGHT_START, '<mark>').replace(HIGHLIGHT_END, '</mark>'))
+
+
+class SqliteBackend:
+    """
+    Search backend using a contentless SQLite FTS5 virtual table ranked with bm25.
+    The table only keeps the index, under a rowid that app_email_fts_docs maps to each email's uid.
+    Emails are dropped from the index by deleting their row there, and their terms are left behind
+    until the index is rebuilt, since a contentless table needs the original text to delete them.
+    """
+
+    def clear(self, connection):
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM app_email_fts_docs")
+            cursor.execute("INSERT INTO app_email_fts (app_email_fts) VALUES ('delete-all')")
+
+    def index(self, connection, documents):
+        self.remove(connection, [uid for uid, *_ in documents])
+        with connection.cursor() as cursor:
+            for uid, subject, body, participants in documents:
+                cursor.execute("INSERT INTO app_email_fts_docs (uid) VALUES (%s)", [uid.hex])
+                cursor.execute(
+                    "INSERT INTO app_email_fts (rowid, subject, body, participants) VALUES (%s, %s, %s, %s)",
+                    [cursor.lastrowid, subject, body, participants]
+                )
+
+    def remove(self, connection, uids):
+        with connection.cursor() as cursor:
+            cursor.executemany("DELETE FROM app_email_fts_docs WHERE uid = %s", [(uid.hex,) for uid in uids])
+
+    def build_query(self, query):
+        """
+        Turns free text into an FTS5 phrase query, where the last word may match as a prefix.
+        Like the old substring search, the words must appear next to each other.
+        """
+
+        if not re.search(r'\w', query):
+            return ''
+        return '"{}"*'.format(query.replace('"', '""'))
+
+    def search(self, connection, user_id, query, after, limit):
+        match = self.build_query(query)
+        if not match:
+            return []
+
+        rank, uid = after if after is not None else (float('-inf'), None)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT uid, rank FROM ("
+                "  SELECT d.uid, f.rank"
+                "  FROM app_email_fts f JOIN app_email_fts_docs d ON d.docid = f.rowid"
+                "  WHERE app_email_fts MATCH %s"
+                "  AND d.uid IN (SELECT email_id FROM app_mailboxentry WHERE user_id = %s"
+                "   UNION ALL SELECT email_id FROM app_archivedentry WHERE user_id = %s)"
+                ") WHERE rank > %s OR (rank = %s AND uid > %s)"
+                " ORDER BY rank, uid LIMIT %s",
+                [match, user_id, user_id, rank, rank, uid.hex if uid else '', limit]
+            )
+            return cursor.fetchall()
+
+
+class PostgresBackend:
+    """
+    Search backend using a PostgreSQL tsvector column with a GIN index, ranked with ts_rank.
+    Only the tsvector is stored, not the text it was built from.
+    """
+
+    def clear(self, connection):
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM app_email_fts")
+
+    def index(self, connection, documents):
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                "INSERT INTO app_email_fts (uid, document)"
+                " VALUES (%s,"
+                "  setweight(to_tsvector('simple', %s), 'A') ||"
+                "  setweight(to_tsvector('simple', %s), 'B') ||"
+                "  setweight(to_tsvector('simple', %s), 'C'))"
+                " ON CONFLICT (uid) DO UPDATE SET document = EXCLUDED.document",
+                documents
+            )
+
+    def remove(self, connection, uids):
+        with connection.cursor() as cursor:
+            cursor.executemany("DELETE FROM app_email_fts WHERE uid = %s", [(uid,) for uid in uids])
+
+    def search(self, connection, user_id, query, after, limit):
+        rank, uid = after if after is not None else (float('-inf'), None)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT uid, rank FROM ("
+                "  SELECT f.uid, -ts_rank(f.document, q.query)::float8 AS rank"
+                "  FROM app_email_fts f, phraseto_tsquery('simple', %s) AS q (query)"
+                "  WHERE f.document @@ q.query"
+                "  AND f.uid IN (SELECT email_id FROM app_mailboxentry WHERE user_id = %s"
+                "   UNION ALL SELECT email_id FROM app_archivedentry WHERE user_id = %s)"
+                ") ranked WHERE rank > %s OR (rank = %s AND uid > %s)"
+                " ORDER BY rank, uid LIMIT %s",
+                [query, user_id, user_id, rank, rank, uid or '00000000-0000-0000-0000-000000000000', limit]
+            )
+            return cursor.fetchall()
+
+
+class ContainsBackend:
+    """
+    Fallback backend for databases without full-text support.
+    Matches the subject and body with LIKE queries and doesn't rank results.
+    Compressed bodies (see bodies.py) can't be matched, so only the subjects of those emails are.
+    """
+
+    def clear(self, connection):
+        pass
+
+    def index(self, connection, documents):
+        pass
+
+    def remove(self, connection, uids):
+        pass
+
+    def search(self, connection, user_id, query, after, limit):
+        emails = Email.objects.filter(
+            Q(subject__icontains=query) | Q(body__icontains=query),
+            Q(uid__in=MailboxEntry.objects.filter(user_id=user_id).values('email'))
+            | Q(uid__in=ArchivedEntry.objects.filter(user_id=user_id).values('email'))
+        )
+        if after is not None:
+            emails = emails.filter(uid__gt=after[1])
+        return [(uid, 0.0) for uid in emails.order_by('uid').values_list('uid', flat=True)[:limit]]
+
+
+BACKENDS = {
+    'sqlite': SqliteBackend,
+    'postgresql': PostgresBackend,
+}
+
+
+def get_backend(connection=default_connection):
+    """
+    Returns the search backend for a database connection's vendor.
+    """
+
+    return BACKENDS.get(connection.vendor, ContainsBackend)()
+
+
+def index_email(email, sender_address, recipient_addresses, connection=default_connection):
+    """
+    Adds a newly sent email to the search index.
+    """
+
+    document = build_document(email.uid, email.subject, get_body(email), sender_address, recipient_addresses)
+    get_backend(connection).index(connection, [document])
+
+
+def build_documents(emails):
+    """
+    Builds the documents indexed for a batch of emails on the current shard.
+    """
+
+    # look up the users of each email's sender and recipients
+    uids = [email.uid for email in emails]
+    senders = dict(Sender.objects.filter(email__in=uids).values_list('email', 'user'))
+    recipients = {}
+    for uid, user_id in Recipient.objects.filter(email__in=uids).values_list('email', 'user'):
+        recipients.setdefault(uid, []).append(user_id)
+
+    # and then their addresses, since users may be on another database than their mail
+    user_ids = set(senders.values()).union(*recipients.values())
+    addresses = dict(CustomUser.objects.filter(pk__in=user_ids).values_list('pk', 'email'))
+    bodies = get_bodies(emails)
+
+    return [
+        build_document(
+            email.uid, email.subject, bodies[email.uid],
+            addresses.get(senders.get(email.uid), ''),
+            ' '.join(addresses.get(user_id, '') for user_id in recipients.get(email.uid, []))
+        )
+        for email in emails
+    ]
+
+
+def remove_emails(uids, connection=default_connection):
+    """
+    Drops emails from the search index.
+    """
+
+    get_backend(connection).remove(connection, uids)
+
+
+def rebuild_index(batch_size=500, connection=default_connection):
+    """
+    Rebuilds the search index for every email on the current shard, a batch at a time, starting
+    from an empty index so nothing is left of removed emails. Returns the number of emails indexed.
+    """
+
+    backend = get_backend(connection)
+    backend.clear(connection)
+    indexed = 0
+    last_uid = None
+    while True:
+        # fetch the next batch of emails
+        emails = Email.objects.order_by('uid')
+        if last_uid is not None:
+            emails = emails.filter(uid__gt=last_uid)
+        emails = list(emails.only('uid', 'subject', *BODY_FIELDS)[:batch_size])
+        if not emails:
+            return indexed
+        last_uid = emails[-1].uid
+
+        backend.index(connection, build_documents(emails))
+        indexed += len(emails)
+
+
+def search_database(user):
+    """
+    Returns the alias of the database a user's mail is searched on: their shard, or a read replica
+    when the current request may read from one (see replicas.py).
+    """
+
+    with using_shard(shard_for(user)):
+        return router.db_for_read(Email) or DEFAULT_DB_ALIAS
+
+
+def search_mailbox(user, query, after=None, limit=DEFAULT_LIMIT, connection=None):
+    """
+    Returns a page of the user's emails matching a full-text query, best matches first,
+    along with the cursor for the next page. The index on search_database(user) is searched by default.
+    """
+
+    connection = connection or connections[search_database(user)]
+
+    # a folder page's cursor holds a timestamp rather than a rank, so it starts from the first page
+    if after is not None and not isinstance(after[0], float):
+        after = None
+
+    # rank the matching emails, fetching one extra to find out if there is another page
+    results = get_backend(connection).search(connection, user.pk, query, after, limit + 1)
+    results = [(Email._meta.pk.to_python(uid), rank) for uid, rank in results]
+    next_cursor = None
+    if len(results) > limit:
+        results = results[:limit]
+        next_cursor = encode_cursor(results[-1][1], results[-1][0])
+
+    # load the display data for the page from the user's mailbox entries, or their archive
+    entries = {}
+    uids = [uid for uid, *_ in results]
+    for model in (ArchivedEntry, MailboxEntry):
+        for entry in model.objects.filter(user=user, email__in=uids).values(
+                'email', 'subject', 'sender_address', 'recipient_addresses', 'sent_at', 'version', 'snippet'):
+            entries[entry['email']] = entry
+    results = [(uid, rank) for uid, rank in results if uid in entries]
+    snippets = make_snippets([uid for uid, _ in results], entries, query)
+
+    return [{
+        'uid': uid,
+        'subject': entries[uid]['subject'],
+        'from': entries[uid]['sender_address'],
+        'to': entries[uid]['recipient_addresses'],
+        'sent_at': entries[uid]['sent_at'],
+        'version': entries[uid]['version'],
+        'snippet': format_snippet(snippets[uid]),
+        'rank': rank
+    } for uid, rank in results], next_cursor
@@ -0,0 +1,210 @@
+"""
+Session engine keeping hot sessions in a bounded in-process LRU cache in front of the session table.
+Every page checks the master login and then the email login, both kept in the session, so
+reading a cached session saves a query on every request. Changes that don't touch the login
+state are written behind: they're queued and flushed to the database in batches at the end
+of a request, at most every SESSION_WRITE_BEHIND_INTERVAL seconds. New sessions, deletions,
+and logins and logouts are written straight away.
+
+Each session has a login version in the default cache, which is bumped whenever its login
+state changes or it's deleted (logging out, or cycling the key on login), and cached sessions
+are only used while their version is current. So the cache must be shared by every process
+(e.g. Redis) for a logout on one node to be seen by the others right away, as for throttle.py.
+Other changes are trusted for SESSION_LRU_TTL seconds, which bounds how long a node can serve
+a session that another node has changed. Deployments that can't route a user's requests to the
+same node should set SIMPLE_EMAIL_SESSION_ENGINE=signed_cookies, which keeps the whole session
+in a signed cookie so no node needs a session lookup at all.
+"""
+
+import atexit
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.sessions.backends.db import SessionStore as DBStore
+from django.core.cache import cache
+from django.contrib.sessions.models import Session
+from django.utils import timezone
+
+from .directory import LRUCache
+
+# session keys holding the login state, changes to which are never written behind
+AUTH_KEYS = (SESSION_KEY, BACKEND_SESSION_KEY, HASH_SESSION_KEY, 'email_session')
+
+# number of sessions updated per query when flushing
+BATCH_SIZE = 500
+
+
+def auth_state(data):
+    return tuple(data.get(key) for key in AUTH_KEYS)
+
+
+def version_key(session_key):
+    # session keys are secret, so only a hash of them is kept in the cache
+    return f"session_version:{hashlib.sha256(session_key.encode()).hexdigest()[:32]}"
+
+
+def login_version(session_key):
+    """
+    Returns the current login version of a session.
+    """
+
+    return cache.get(version_key(session_key), 0)
+
+
+def bump_login_version(session_key):
+    """
+    Moves a session to a new login version, so no process uses its cached copy any more. Returns the new version.
+    """
+
+    key = version_key(session_key)
+    timeout = settings.SESSION_COOKIE_AGE
+
+    # incr is atomic, so concurrent bumps each get their own version
+    cache.add(key, 0, timeout)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # the key expired between add and incr
+        cache.add(key, 1, timeout)
+        return 1
+
+
+class SessionCache:
+    """
+    Thread-safe LRU cache of encoded session data, with a queue of changes waiting to be written.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = None
+        self.dirty = {}
+        self.last_flush = time.monotonic()
+
+    def get_entries(self):
+        if self.entries is None:
+            self.entries = LRUCache(getattr(settings, 'SESSION_LRU_SIZE', 10000))
+        return self.entries
+
+    def get(self, session_key):
+        """
+        Returns the (session data, auth state, login version) of a cached session that hasn't expired
+        and whose login version is still current, or None.
+        """
+
+        with self.lock:
+            entry = self.get_entries().get(session_key)
+        if entry is None:
+            return None
+
+        session_data, state, version, expire_date, cached_at = entry
+        if time.monotonic() - cached_at > getattr(settings, 'SESSION_LRU_TTL', 30) or expire_date <= timezone.now():
+            return None
+        if version != login_version(session_key):
+            return None    # logged in or out since, maybe on another node
+        return session_data, state, version
+
+    def put(self, session_key, session_data, state, version, expire_date):
+        with self.lock:
+            self.get_entries().set(session_key, (session_data, state, version, expire_date, time.monotonic()))
+
+    def discard(self, session_key):
+        with self.lock:
+            self.get_entries().pop(session_key)
+            self.dirty.pop(session_key, None)
+
+    def write_behind(self, session_key, session_data, expire_date):
+        with self.lock:
+            self.dirty[session_key] = (session_data, expire_date)
+
+    def flush(self, force=True):
+        """
+        Writes queued changes to the database, unless force is False and the last flush was recent.
+        Sessions deleted in the meantime are not brought back. Returns the number of sessions written.
+        """
+
+        with self.lock:
+            interval = getattr(settings, 'SESSION_WRITE_BEHIND_INTERVAL', 1.0)
+            if not self.dirty or (not force and time.monotonic() - self.last_flush < interval):
+                return 0
+            dirty, self.dirty = self.dirty, {}
+            self.last_flush = time.monotonic()
+
+        Session.objects.bulk_update([
+            Session(session_key=session_key, session_data=session_data, expire_date=expire_date)
+            for session_key, (session_data, expire_date) in dirty.items()
+        ], ['session_data', 'expire_date'], batch_size=BATCH_SIZE)
+        return len(dirty)
+
+
+sessions = SessionCache()
+
+
+@atexit.register
+def flush_on_exit():
+    try:
+        sessions.flush()
+    except Exception:
+        pass    # the database may already be gone
+
+
+class SessionStore(DBStore):
+    """
+    Database-backed session store that reads through the process's session cache.
+    """
+
+    def load(self):
+        cached = sessions.get(self.session_key) if self.session_key else None
+        if cached is not None:
+            session_data, self._cached_state, self._cached_version = cached
+            return self.decode(session_data)
+
+        # read the version first, so a logout while the row is read leaves the copy stale
+        version = login_version(self.session_key) if self.session_key else 0
+        session = self._get_session_from_db()
+        if session is None:
+            return {}
+
+        data = self.decode(session.session_data)
+        self._cached_state = auth_state(data)
+        self._cached_version = version
+        sessions.put(self.session_key, session.session_data, self._cached_state, version, session.expire_date)
+        return data
+
+    def exists(self, session_key):
+        return sessions.get(session_key) is not None or super().exists(session_key)
+
+    def save(self, must_create=False):
+        if self.session_key is None:
+            return self.create()
+
+        data = self._get_session(no_load=must_create)
+        session_data = self.encode(data)
+        expire_date = self.get_expiry_date()
+        state = auth_state(data)
+
+        # new sessions and login state changes go to the database right away,
+        # and login state changes make other processes drop their copies
+        if must_create:
+            super().save(must_create)
+            version = login_version(self.session_key)
+        elif state != getattr(self, '_cached_state', None):
+            super().save(must_create)
+            version = bump_login_version(self.session_key)
+        else:
+            sessions.write_behind(self.session_key, session_data, expire_date)
+            version = self._cached_version
+
+        self._cached_state = state
+        self._cached_version = version
+        sessions.put(self.session_key, session_data, state, version, expire_date)
+
+    def delete(self, session_key=None):
+        if session_key is None:
+            session_key = self.session_key
+        if session_key is not None:
+            sessions.discard(session_key)
+            bump_login_version(session_key)
+        super().delete(session_key)
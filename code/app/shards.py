@@ -0,0 +1,205 @@
+"""
+Per-user sharding of the mail tables across several databases.
+Each user's mail lives on their shard: the emails they sent or received, with their Sender
+and Recipient rows, and their mailbox entries and counters. Users, sessions, attachments,
+and everything else stay on the 'default' database. A send is written to the shard of every
+participant, so each shard has its own copy of the email, and a user's pages only ever
+read their own shard.
+
+New users are spread across SHARD_DATABASES by id and users from before sharding stay on
+'default', until rebalance.py moves them. Without SHARD_DATABASES, everything is on 'default'.
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.deprecation import MiddlewareMixin
+
+from .blobs import retain
+from .models import (
+    ArchivedBody, ArchivedEntry, CustomUser, Email, MailboxCounter, MailboxEntry, MailboxThread, Recipient, Sender
+)
+
+# models whose rows live on their user's shard
+SHARDED_MODELS = (Email, Sender, Recipient, MailboxEntry, MailboxCounter, ArchivedEntry, ArchivedBody, MailboxThread)
+
+# number of users looked up per query
+BATCH_SIZE = 500
+
+# the shard that sharded rows are read from and written to, or None for 'default'
+current_shard = ContextVar('current_shard', default=None)
+
+
+def get_shards():
+    return getattr(settings, 'SHARD_DATABASES', [])
+
+
+def is_sharded():
+    return bool(get_shards())
+
+
+def all_databases():
+    """
+    Returns the alias of every database holding mail, 'default' first.
+    """
+
+    return list(dict.fromkeys([DEFAULT_DB_ALIAS, *get_shards()]))
+
+
+def assign_shard(user_id):
+    """
+    Returns the shard a new user's mail goes on.
+    """
+
+    shards = get_shards()
+    return shards[user_id % len(shards)]
+
+
+def shard_for(user):
+    """
+    Returns the alias of the database holding a (fully loaded) user's mail.
+    """
+
+    return (user.shard if is_sharded() else '') or DEFAULT_DB_ALIAS
+
+
+def place(user_ids, home=None):
+    """
+    Groups users by the shard holding their mail, as {alias: set of user ids}.
+    Without sharding, everyone is placed on home (or 'default') as None, meaning every user.
+    """
+
+    if not is_sharded():
+        return {home or DEFAULT_DB_ALIAS: None}
+
+    user_ids = list(dict.fromkeys(user_ids))
+    placement = {}
+    for start in range(0, len(user_ids), BATCH_SIZE):
+        batch = user_ids[start:start + BATCH_SIZE]
+        for user_id, shard in CustomUser.objects.filter(pk__in=batch).values_list('pk', 'shard'):
+            placement.setdefault(shard or DEFAULT_DB_ALIAS, set()).add(user_id)
+    return placement
+
+
+def local_users(user_ids):
+    """
+    Returns the set of the given users whose mail is on the current shard, or None (every user) without sharding.
+    """
+
+    return place(user_ids).get(current_alias(), set()) if is_sharded() else None
+
+
+def current_alias():
+    """
+    Returns the alias of the database sharded rows are currently read from and written to.
+    """
+
+    return current_shard.get() or DEFAULT_DB_ALIAS
+
+
+@contextmanager
+def using_shard(alias):
+    """
+    Reads and writes sharded rows on the given shard within the block.
+    """
+
+    token = current_shard.set(alias)
+    try:
+        yield alias
+    finally:
+        current_shard.reset(token)
+
+
+def each_shard():
+    """
+    Yields the alias of every database holding mail, reading and writing sharded rows on each in turn.
+    """
+
+    for alias in all_databases():
+        with using_shard(alias):
+            yield alias
+
+
+def copy_rows(model, rows, alias, update_fields=None):
+    """
+    Writes copies of rows to another database, keeping their primary keys.
+    Rows already there are left alone, or have update_fields overwritten if given.
+    """
+
+    fields = model._meta.concrete_fields
+    copies = [model(**{field.attname: getattr(row, field.attname) for field in fields}) for row in rows]
+    if update_fields:
+        return model.objects.using(alias).bulk_create(
+            copies, batch_size=BATCH_SIZE, update_conflicts=True,
+            unique_fields=[model._meta.pk.name], update_fields=update_fields
+        )
+    return model.objects.using(alias).bulk_create(copies, batch_size=BATCH_SIZE, ignore_conflicts=True)
+
+
+def copy_email(email, senders, recipients, alias):
+    """
+    Copies an email and its Sender and Recipient rows to another shard. Returns the email's copy.
+    """
+
+    copy, = copy_rows(Email, [email], alias)
+    if copy.body_file:
+        retain([copy.body_file.name])    # each copy refers to the body blob
+    copy_rows(Sender, senders, alias)
+    copy_rows(Recipient, recipients, alias)
+    return copy
+
+
+class ShardRouter:
+    """
+    Database router sending sharded models to the current shard (or the shard of the row they're reached from),
+    and everything reached from a sharded row back to 'default'. Other routing is left to later routers.
+    """
+
+    def route(self, model, **hints):
+        if not is_sharded():
+            return None
+
+        instance = hints.get('instance')
+        if model in SHARDED_MODELS:
+            # e.g. an email's recipients, but not a recipient's user
+            if isinstance(instance, SHARDED_MODELS) and instance._state.db:
+                return instance._state.db
+            return current_alias()
+
+        # e.g. a recipient's user, or an email's attachments
+        if instance is not None and instance._state.db not in (None, DEFAULT_DB_ALIAS):
+            return DEFAULT_DB_ALIAS
+        return None
+
+    db_for_read = route
+    db_for_write = route
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if not is_sharded():
+            return None
+
+        # rows on a shard refer to users and are referred to by attachments on 'default'
+        if not isinstance(obj1, SHARDED_MODELS) or not isinstance(obj2, SHARDED_MODELS):
+            return True
+        return obj1._state.db == obj2._state.db
+
+
+class ShardMiddleware(MiddlewareMixin):
+    """
+    Reads and writes the logged in user's mail on their shard.
+    """
+
+    def process_request(self, request):
+        alias = None
+        if is_sharded() and request.user.is_authenticated:
+            alias = shard_for(request.user)
+
+        # put back whatever shard the caller was using afterwards (e.g. a test)
+        request.previous_shard = current_shard.get()
+        current_shard.set(alias)
+
+    def process_response(self, request, response):
+        current_shard.set(getattr(request, 'previous_shard', None))
+        return response
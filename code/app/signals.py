@@ -0,0 +1,118 @@
+"""
+Signal handlers that keep the in-memory address directory and blob reference counts up to date,
+assign new users to shards, and flush session changes written behind.
+"""
+
+from django.core.signals import request_finished
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from .blobs import blob_names, release, retain
+from .directory import directory
+from .models import Attachment, CustomUser, Email
+from .sessions import sessions
+from .shards import assign_shard, is_sharded
+
+
+@receiver(post_init, sender=CustomUser)
+def remember_address(sender, instance, **kwargs):
+    """
+    Remembers each loaded user's address so that changes to it can be detected on save.
+    """
+
+    instance._directory_address = instance.email
+
+
+@receiver(post_save, sender=CustomUser)
+def address_saved(sender, instance, created, **kwargs):
+    """
+    Adds new users' addresses to the directory and replaces changed ones.
+    """
+
+    old_address = instance._directory_address
+    if created or instance.email != old_address:
+        directory.user_saved(instance, old_address)
+    instance._directory_address = instance.email
+
+
+@receiver(post_save, sender=CustomUser)
+def shard_assigned(sender, instance, created, **kwargs):
+    """
+    Puts new users' mail on a shard, when the mail tables are sharded.
+    """
+
+    if created and is_sharded() and not instance.shard:
+        instance.shard = assign_shard(instance.pk)
+        CustomUser.objects.filter(pk=instance.pk).update(shard=instance.shard)
+
+
+@receiver(post_delete, sender=CustomUser)
+def address_deleted(sender, instance, **kwargs):
+    """
+    Removes deleted users' addresses from the directory.
+    """
+
+    directory.user_deleted(instance)
+
+
+@receiver(post_init, sender=Attachment)
+def remember_files(sender, instance, **kwargs):
+    """
+    Remembers each loaded attachment's files so that changes to them can be detected on save.
+    """
+
+    instance._blob_names = blob_names(instance)
+
+
+@receiver(post_save, sender=Attachment)
+def files_saved(sender, instance, created, **kwargs):
+    """
+    Counts new attachments' references to their blobs, and moves changed files to their new blob.
+    """
+
+    old_names = instance._blob_names
+    new_names = blob_names(instance)
+    if created:
+        retain(new_names)
+    else:
+        retain([new for old, new in zip(old_names, new_names) if new != old])
+        release([old for old, new in zip(old_names, new_names) if new != old])
+    instance._blob_names = new_names
+
+
+@receiver(post_delete, sender=Attachment)
+def files_deleted(sender, instance, **kwargs):
+    """
+    Releases the attachment's references to its blobs.
+    """
+
+    release(instance._blob_names)
+
+
+@receiver(post_save, sender=Email)
+def body_saved(sender, instance, created, **kwargs):
+    """
+    Counts new emails' references to their body blobs (see bodies.py).
+    """
+
+    if created and instance.body_file:
+        retain([instance.body_file.name])
+
+
+@receiver(post_delete, sender=Email)
+def body_deleted(sender, instance, **kwargs):
+    """
+    Releases deleted emails' references to their body blobs.
+    """
+
+    if instance.body_file:
+        release([instance.body_file.name])
+
+
+@receiver(request_finished)
+def flush_sessions(sender, **kwargs):
+    """
+    Writes queued session changes to the database once they've waited long enough.
+    """
+
+    sessions.flush(force=False)
@@ -0,0 +1,83 @@
+"""
+Content-addressed storage for attachments.
+Each upload is hashed with SHA-256 while it's streamed to disk and stored under its
+hash, so identical files are only ever written once no matter how often they're sent.
+"""
+
+import hashlib
+import os
+import re
+import tempfile
+
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+# directory, relative to the storage root, holding every blob
+BLOB_DIR = 'blobs'
+
+# directory uploads are streamed into before they're moved to their blob
+TEMP_DIR = f"{BLOB_DIR}/tmp"
+
+BLOB_HASH = re.compile(r'^[0-9a-f]{64}$')
+
+
+def blob_name(sha256):
+    """
+    Returns the storage name of the blob with the given hash.
+    Blobs are spread over two levels of directories so none grows too large.
+    """
+
+    return f"{BLOB_DIR}/{sha256[:2]}/{sha256[2:4]}/{sha256}"
+
+
+def blob_hash(name):
+    """
+    Returns the hash of a stored blob from its name, or None if the file isn't a blob.
+    """
+
+    if not name or not name.startswith(f"{BLOB_DIR}/"):
+        return None
+
+    sha256 = name.rsplit('/', 1)[-1]
+    return sha256 if BLOB_HASH.match(sha256) else None
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    File system storage that names each file after the SHA-256 of its content.
+    Saving content that is already stored reuses the existing file.
+    """
+
+    def get_available_name(self, name, max_length=None):
+        # the final name comes from the content, so any name is available
+        return name
+
+    def _save(self, name, content):
+        temp_dir = self.path(TEMP_DIR)
+        os.makedirs(temp_dir, exist_ok=True)
+
+        # stream the upload to a temporary file, hashing it on the way
+        digest = hashlib.sha256()
+        fd, temp_path = tempfile.mkstemp(dir=temp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                for chunk in content.chunks():
+                    digest.update(chunk)
+                    temp_file.write(chunk)
+
+            name = blob_name(digest.hexdigest())
+            path = self.path(name)
+            try:
+                # the content is already stored, so mark it as just used for the garbage collector
+                os.utime(path)
+            except FileNotFoundError:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                if self.file_permissions_mode is not None:
+                    os.chmod(temp_path, self.file_permissions_mode)
+                os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+        return name
@@ -0,0 +1,85 @@
+"""
+Tasks run by the job queue workers (see jobs.py).
+This module is imported when the app is ready, so every task is registered in every process.
+"""
+
+from django.db import transaction
+
+from .archiving import archive_old_mail
+from .blobs import collect_garbage
+from .counters import reconcile
+from .images import process_attachment
+from .jobs import purge_finished, requeue_stale, task
+from .mailbox import fan_out
+from .models import CustomUser, Email, Sender
+from .shards import current_alias, each_shard, using_shard
+
+
+@task(max_attempts=5)
+def fan_out_email(email_uid, recipients, shard=None):
+    """
+    Delivers an email sent to a large list of [user id, address] recipients, from its sender's shard.
+    The delivery is a transaction on that shard, and running it again only adds what's missing.
+    """
+
+    with using_shard(shard), transaction.atomic(using=current_alias()):
+        email = Email.objects.get(uid=email_uid)
+        sender = Sender.objects.get(email=email)
+        users = [CustomUser(pk=user_id, email=address) for user_id, address in recipients]
+        fan_out(email, sender, users, is_sent=not sender.is_draft, is_forward=sender.is_forward)
+
+
+@task()
+def process_image_attachment(attachment_uid):
+    """
+    Makes the thumbnail and display variants of an image attachment.
+    """
+
+    process_attachment(attachment_uid)
+
+
+@task(every=5 * 60)
+def requeue_stale_jobs():
+    """
+    Retries jobs whose worker died while running them.
+    """
+
+    requeue_stale()
+
+
+@task(every=60 * 60)
+def purge_finished_jobs():
+    """
+    Deletes old finished jobs.
+    """
+
+    purge_finished()
+
+
+@task(every=6 * 60 * 60)
+def collect_blobs():
+    """
+    Removes attachment blobs that are no longer referenced.
+    """
+
+    collect_garbage()
+
+
+@task(every=24 * 60 * 60)
+def reconcile_counters():
+    """
+    Repairs any mailbox counters that drifted, on every shard.
+    """
+
+    for _ in each_shard():
+        reconcile()
+
+
+@task(every=24 * 60 * 60)
+def archive_mail():
+    """
+    Moves old and archived mail into the archive tables, on every shard.
+    """
+
+    for _ in each_shard():
+        archive_old_mail()
@@ -3,10 +3,72 @@ Main file containing tests for unit testing and continuous integration.
 https://docs.djangoproject.com/en/3.1/topics/testing/tools/
 """
 
-from django.test import TestCase, Client
+import asyncio
+import io
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from datetime import timedelta
+from unittest import skipUnless
+from unittest.mock import patch
+
+from asgiref.sync import sync_to_async
+from asgiref.testing import ApplicationCommunicator
+from django.conf import settings
+from django.contrib.auth.hashers import PBKDF2PasswordHasher, check_password, identify_hasher
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.messages.storage.fallback import FallbackStorage
+from django.contrib.sessions.backends.db import SessionStore
+from django.contrib.sessions.models import Session as DjangoSession
+from django.test import AsyncRequestFactory, TestCase, TransactionTestCase, Client, override_settings
 from django.contrib import auth
-
-from .models import CustomUser, Email, Sender, Recipient, Attachment
+from django.core.cache import cache, caches
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, connection, connections
+from django.db.models import F
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image as PILImage
+
+from . import async_views, events, rebalance, replicas, search, shards, views
+from .archiving import BATCH_SIZE as ARCHIVE_BATCH_SIZE, archive_old_mail, due_entries
+from .blobs import collect_garbage, get_storage
+from .bodies import get_body, pack_bodies
+from .counters import get_counts, reconcile
+from .directory import BloomFilter, bump_generation, directory
+from .folders import archived_entries, folder_entries, load_inbox, load_outbox
+from .forms import ComposeForm
+from .hashing import HashingPool, PoolFull
+from .jobs import PERIODIC, claim, enqueue, queue_periodic, requeue_stale, run_job, task, work
+from .mailbox import archive, deliver, fan_out, rebuild_entries
+from .pagination import encode_cursor, keyset_slice
+from .models import (
+    CustomUser, Email, Sender, Recipient, Attachment, MailboxEntry, MailboxCounter, ArchivedEntry, ArchivedBody, Blob,
+    Job, Schedule, Note, MailboxThread
+)
+from .sessions import SessionStore as CachedSessionStore, bump_login_version, login_version, sessions
+from .threads import conversation, rebuild_threads, thread_list
+from .throttle import LOCKOUT_THRESHOLD, SlidingWindow, record_failure
+
+
+# record of the calls made to the test tasks below
+task_calls = []
+
+
+@task(max_attempts=2)
+def record_call(value):
+    task_calls.append(value)
+
+
+@task(max_attempts=2)
+def always_fail():
+    raise RuntimeError("this task always fails")
 
 
 def create_email(subject, content, sender, recipients, is_draft, is_forward):
@@ -41,10 +103,48 @@ def create_email(subject, content, sender, recipients, is_draft, is_forward):
             )
         )
 
+    # add the email to each user's mailbox and the search index
+    deliver(email, sender_relation, recipient_relations)
+
     return email, sender_relation, recipient_relations
 
 
-class TestAuth(TestCase):
+class MailTestCase(TestCase):
+    """
+    Test case that runs on the first shard when the mail tables are sharded (see SIMPLE_EMAIL_SHARDS).
+    Every new user's mail is put there, and sharded rows are read and written there outside of requests too.
+    Mail spread across several shards is covered by TestShards.
+    Reads aren't sent to any read replicas (see SIMPLE_EMAIL_DB_REPLICAS), which can't see the writes of
+    the test's transaction; TestReplicas covers where reads are routed.
+    Only the databases holding mail are used, since a replica mirrors 'default' during tests.
+    """
+
+    databases = set(shards.all_databases())
+
+    def run(self, result=None):
+        first = settings.SHARD_DATABASES[:1]
+        with override_settings(SHARD_DATABASES=first, DATABASE_REPLICAS=[]), \
+                shards.using_shard(first[0] if first else None):
+            return super().run(result)
+
+    @contextmanager
+    def capture_queries(self):
+        """
+        Captures the queries made on 'default' and the mail shard in the block, into the yielded list.
+        """
+
+        contexts = [CaptureQueriesContext(connections[alias])
+                    for alias in dict.fromkeys([DEFAULT_DB_ALIAS, shards.current_alias()])]
+        queries = []
+        with ExitStack() as stack:
+            for context in contexts:
+                stack.enter_context(context)
+            yield queries
+        for context in contexts:
+            queries.extend(context.captured_queries)
+
+
+class TestAuth(MailTestCase):
     """
     Tests the login/registration pages and forms.
     """
@@ -179,7 +279,7 @@ class TestAuth(TestCase):
         self.assertFalse(response.context['user'].is_authenticated)
 
 
-class TestCompose(TestCase):
+class TestCompose(MailTestCase):
     """
     Tests the compose functionality of the website.
     """
@@ -285,6 +385,14 @@ class TestCompose(TestCase):
             self.assertFalse(recipient.is_forward)
             self.assertFalse(recipient.is_archived)
 
+        # validate MailboxEntries
+        self.assertTrue(MailboxEntry.objects.filter(user=self.sender, email=email, folder=MailboxEntry.OUTBOX).exists())
+        for recipient_user in self.recipients:
+            entry = MailboxEntry.objects.get(user=recipient_user, email=email)
+            self.assertEqual(entry.folder, MailboxEntry.INBOX)
+            self.assertEqual(entry.sender_address, self.sender.email)
+            self.assertEqual(entry.subject, form_data['subject'])
+
     def test_compose_invalid_subject(self):
         """
         Tests submitting a compose form with an invalid subject.
@@ -457,7 +565,556 @@ class TestCompose(TestCase):
             self.assertFalse(recipient.is_archived)
 
 
-class TestInbox(TestCase):
+    def test_compose_bulk_recipients(self):
+        """
+        Tests that sending to many recipients takes the same number of queries as sending to a few.
+        """
+
+        # create a large batch of extra recipients
+        password = self.recipients[0].password
+        many = CustomUser.objects.bulk_create([
+            CustomUser(username=f"bulk_{i}", email=f"bulk_{i}@email.com", password=password, shard=shards.current_alias())
+            for i in range(40)
+        ])
+
+        # bulk creates don't send signals, so place the users above and reload the address directory
+        directory.clear()
+        directory.resolve([])
+
+        def send(users):
+            form = ComposeForm({
+                'subject': 'Bulk subject',
+                'sender': self.sender.email,
+                'recipients': ', '.join(user.email for user in users),
+                'body': 'Bulk body',
+            })
+            with self.capture_queries() as queries:
+                self.assertTrue(form.is_valid())
+                email = form.create_email_and_relations()
+            return email, len(queries)
+
+        # compare the number of queries for a small and a large send
+        _, few_queries = send(self.recipients)
+        email, many_queries = send(many + many[:5])
+        self.assertEqual(few_queries, many_queries)
+        self.assertEqual(Recipient.objects.filter(email=email).count(), 40)
+        self.assertEqual(MailboxEntry.objects.filter(email=email, folder=MailboxEntry.INBOX).count(), 40)
+        self.assertTrue(MailboxEntry.objects.filter(email=email)[0].recipient_addresses.endswith(' and 30 more'))
+
+    def test_compose_is_atomic(self):
+        """
+        Tests that a send which fails partway through leaves nothing behind.
+        """
+
+        form = ComposeForm({
+            'subject': 'Doomed subject',
+            'sender': self.sender.email,
+            'recipients': ', '.join(user.email for user in self.recipients),
+            'body': 'Doomed body',
+        })
+        self.assertTrue(form.is_valid())
+
+        # fail after the email, sender, and recipients have been written
+        with patch('app.mailbox.deliver', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                form.create_email_and_relations()
+
+        self.assertEqual(Email.objects.count(), 0)
+        self.assertEqual(Sender.objects.count(), 0)
+        self.assertEqual(Recipient.objects.count(), 0)
+
+
+class TestDirectory(MailTestCase):
+    """
+    Tests the in-memory address directory used to validate recipients.
+    """
+
+    def setUp(self):
+        """
+        Sets up some prerequisites before each test.
+        """
+
+        directory.clear()
+        self.user = CustomUser.objects.create_user(
+            username='directory_user',
+            password='directory_user',
+            email='directory_user@simpleemail.com'
+        )
+
+    def test_bloom_filter(self):
+        """
+        Tests that the Bloom filter has no false negatives and few false positives.
+        """
+
+        bloom = BloomFilter(1000)
+        for i in range(1000):
+            bloom.add(f"user_{i}@simpleemail.com")
+
+        self.assertTrue(all(f"user_{i}@simpleemail.com" in bloom for i in range(1000)))
+        false_positives = sum(f"other_{i}@simpleemail.com" in bloom for i in range(1000))
+        self.assertLess(false_positives, 50)
+
+    def test_resolve_without_queries(self):
+        """
+        Tests that cached addresses are resolved without touching the DB, and unknown ones with a single query.
+        """
+
+        # the first lookup loads the directory
+        self.assertEqual(directory.resolve([self.user.email]), {self.user.email: self.user.pk})
+
+        with self.assertNumQueries(0):
+            self.assertEqual(directory.resolve([self.user.email]), {self.user.email: self.user.pk})
+
+        # unknown addresses are only rejected once the shared generation shows nobody has added them
+        with self.assertNumQueries(1):
+            self.assertEqual(directory.resolve(['nobody@simpleemail.com', self.user.email]),
+                             {self.user.email: self.user.pk})
+
+        # an invalid recipient is rejected by the form without looking them up
+        form = ComposeForm({
+            'subject': 'Subject',
+            'sender': self.user.email,
+            'recipients': 'nobody@simpleemail.com',
+            'body': 'Body',
+        })
+        with self.assertNumQueries(2):
+            self.assertFalse(form.is_valid())
+
+    def test_user_changes(self):
+        """
+        Tests that the directory follows users being created, changed, and deleted.
+        """
+
+        directory.resolve([self.user.email])
+
+        # new users are found without querying
+        user = CustomUser.objects.create_user(
+            username='new_user',
+            password='new_user',
+            email='new_user@simpleemail.com'
+        )
+        with self.assertNumQueries(0):
+            self.assertEqual(directory.resolve([user.email]), {user.email: user.pk})
+
+        # changed addresses stop resolving
+        user.email = 'renamed_user@simpleemail.com'
+        user.save()
+        self.assertEqual(directory.resolve(['new_user@simpleemail.com', user.email]), {user.email: user.pk})
+
+        # so do deleted users
+        user.delete()
+        self.assertEqual(directory.resolve([user.email]), {})
+
+    def test_stale_directory_is_rebuilt(self):
+        """
+        Tests that a user added by another process is found rather than rejected.
+        """
+
+        directory.resolve([self.user.email])
+        with self.assertNumQueries(0):
+            directory.resolve([self.user.email])
+
+        # another process registers a user, which this process's signals never see
+        CustomUser.objects.bulk_create([CustomUser(username='elsewhere', email='elsewhere@simpleemail.com')])
+        user = CustomUser.objects.get(username='elsewhere')
+        bump_generation()
+        with self.assertNumQueries(3):
+            self.assertEqual(directory.resolve([user.email]), {user.email: user.pk})
+        with self.assertNumQueries(0):
+            self.assertEqual(directory.resolve([user.email]), {user.email: user.pk})
+
+
+class TestAttachmentStorage(MailTestCase):
+    """
+    Tests the deduplicated, content-addressed attachment storage.
+    """
+
+    def setUp(self):
+        """
+        Sets up some prerequisites before each test.
+        """
+
+        # keep this test's files out of the real media directory
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+
+        self.email = Email.objects.create(subject='Attachments', body='Attachments body')
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+
+    def attach(self, content):
+        return Attachment.objects.create(email=self.email, file=ContentFile(content, name='file.txt'), name='file.txt')
+
+    def test_duplicates_share_a_blob(self):
+        """
+        Tests that identical uploads are stored once and counted.
+        """
+
+        first = self.attach(b'same content')
+        second = self.attach(b'same content')
+        other = self.attach(b'other content')
+
+        self.assertEqual(first.file.name, second.file.name)
+        self.assertNotEqual(first.file.name, other.file.name)
+        self.assertEqual(second.file.read(), b'same content')
+
+        blob = Blob.objects.get(sha256=first.file.name.rsplit('/', 1)[-1])
+        self.assertEqual(blob.refcount, 2)
+        self.assertEqual(blob.size, len(b'same content'))
+        self.assertEqual(Blob.objects.count(), 2)
+
+    def test_garbage_collection(self):
+        """
+        Tests that blobs are only removed once nothing refers to them.
+        """
+
+        first = self.attach(b'same content')
+        second = self.attach(b'same content')
+        path = get_storage().path(first.file.name)
+
+        # a blob still in use is kept
+        first.delete()
+        self.assertEqual(collect_garbage(grace_period=0), 0)
+        self.assertTrue(os.path.exists(path))
+
+        # an unused blob is kept during its grace period, then removed
+        second.delete()
+        self.assertEqual(collect_garbage(), 0)
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(collect_garbage(grace_period=0), 1)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(Blob.objects.count(), 0)
+
+    def test_stray_files_are_collected(self):
+        """
+        Tests that files left behind without a blob row are removed, in batches.
+        """
+
+        storage = get_storage()
+        names = [storage.save('stray.txt', ContentFile(f"stray {i}".encode())) for i in range(5)]
+        kept = self.attach(b'kept content')
+
+        self.assertEqual(collect_garbage(batch_size=2, grace_period=0), 5)
+        self.assertFalse(any(storage.exists(name) for name in names))
+        self.assertTrue(storage.exists(kept.file.name))
+
+
+class TestAttachmentDownload(MailTestCase):
+    """
+    Tests the permission-checked attachment download endpoint.
+    """
+
+    def setUp(self):
+        """
+        Sets up some prerequisites before each test.
+        """
+
+        # keep this test's files out of the real media directory
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+
+        # create a sender, a recipient, and an outsider
+        self.users = [
+            CustomUser.objects.create_user(username=name, password=name, email=f"{name}@simpleemail.com")
+            for name in ['download_sender', 'download_recipient', 'download_outsider']
+        ]
+        email, _, _ = create_email('Download', 'Download body', self.users[0], [self.users[1]], False, False)
+        self.content = bytes(range(256)) * 4
+        self.attachment = Attachment.objects.create(
+            email=email,
+            file=ContentFile(self.content, name='data.bin'),
+            name='data.bin'
+        )
+        self.url = f'/attachment/{self.attachment.uid}'
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+
+    def login(self, user):
+        client = Client()
+        client.login(username=user.username, password=user.username)
+        session = client.session
+        session['email_session'] = True
+        session.save()
+        return client
+
+    def test_permissions(self):
+        """
+        Tests that only the email's participants can download its attachments.
+        """
+
+        for user in self.users[:2]:
+            response = self.login(user).get(self.url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(b''.join(response.streaming_content), self.content)
+            self.assertIn('data.bin', response['Content-Disposition'])
+
+        self.assertEqual(self.login(self.users[2]).get(self.url).status_code, 404)
+
+    def test_missing_file(self):
+        """
+        Tests that an attachment whose file is missing from storage isn't found.
+        """
+
+        os.remove(self.attachment.file.path)
+        self.assertEqual(self.login(self.users[1]).get(self.url).status_code, 404)
+
+    def test_ranges_and_etags(self):
+        """
+        Tests partial downloads and conditional requests.
+        """
+
+        client = self.login(self.users[1])
+        etag = client.get(self.url)['ETag']
+        self.assertEqual(etag, f'"{self.attachment.file.name.rsplit("/", 1)[-1]}"')
+
+        response = client.get(self.url, HTTP_RANGE='bytes=100-199')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 100-199/{len(self.content)}')
+        self.assertEqual(b''.join(response.streaming_content), self.content[100:200])
+
+        # resume from a byte offset, and fetch the last few bytes
+        response = client.get(self.url, HTTP_RANGE='bytes=1000-', HTTP_IF_RANGE=etag)
+        self.assertEqual(b''.join(response.streaming_content), self.content[1000:])
+        response = client.get(self.url, HTTP_RANGE='bytes=-10')
+        self.assertEqual(b''.join(response.streaming_content), self.content[-10:])
+
+        # a stale If-Range gets the whole file, and a bad range is refused
+        response = client.get(self.url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(client.get(self.url, HTTP_RANGE='bytes=5000-').status_code, 416)
+
+        self.assertEqual(client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    @override_settings(ATTACHMENT_SENDFILE='x-accel-redirect')
+    def test_accel_redirect(self):
+        """
+        Tests that downloads can be handed off to the front proxy.
+        """
+
+        response = self.login(self.users[1]).get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Accel-Redirect'], f'/protected/{self.attachment.file.name}')
+        self.assertEqual(response.content, b'')
+
+
+@override_settings(JOBS_SYNC=True)
+class TestImagePipeline(MailTestCase):
+    """
+    Tests the processing of image attachments into smaller variants.
+    """
+
+    def setUp(self):
+        """
+        Sets up some prerequisites before each test.
+        """
+
+        # keep this test's files out of the real media directory
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+
+        self.sender = CustomUser.objects.create_user(
+            username='image_sender',
+            password='image_sender',
+            email='image_sender@simpleemail.com'
+        )
+        self.recipient = CustomUser.objects.create_user(
+            username='image_recipient',
+            password='image_recipient',
+            email='image_recipient@simpleemail.com'
+        )
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+
+    def send(self, upload):
+        form = ComposeForm({
+            'subject': 'Photo',
+            'sender': self.sender.email,
+            'recipients': self.recipient.email,
+            'body': 'Photo body',
+        })
+        self.assertTrue(form.is_valid())
+
+        # the image is processed once the send commits
+        with self.captureOnCommitCallbacks(using=shards.current_alias(), execute=True) as callbacks:
+            email = form.create_email_and_relations({'file_field': upload})
+            self.assertIsNone(email.attachment_set.get().thumbnail_size)
+        self.assertTrue(callbacks)
+        return email.attachment_set.get()
+
+    def test_image_variants(self):
+        """
+        Tests that images get a thumbnail and a display variant without their EXIF data.
+        """
+
+        # make a large photo with EXIF data
+        photo = PILImage.new('RGB', (3000, 2000), 'blue')
+        exif = PILImage.Exif()
+        exif[0x010f] = 'Test Camera'
+        buffer = io.BytesIO()
+        photo.save(buffer, format='JPEG', exif=exif)
+        attachment = self.send(SimpleUploadedFile('photo.jpg', buffer.getvalue(), content_type='image/jpeg'))
+
+        self.assertEqual(attachment.type, Attachment.IMAGE)
+        self.assertEqual((attachment.width, attachment.height), (3000, 2000))
+        self.assertEqual(attachment.size, len(buffer.getvalue()))
+
+        with PILImage.open(attachment.image.path) as image:
+            self.assertEqual(image.size, (1600, 1067))
+            self.assertNotIn(0x010f, image.getexif())
+        with PILImage.open(attachment.thumbnail.path) as image:
+            self.assertEqual(max(image.size), 256)
+        self.assertEqual(attachment.image_size, os.path.getsize(attachment.image.path))
+        self.assertEqual(attachment.thumbnail_size, os.path.getsize(attachment.thumbnail.path))
+        self.assertLess(attachment.thumbnail_size, attachment.image_size)
+
+        # the variants are counted as blobs too
+        self.assertEqual(Blob.objects.count(), 3)
+
+        # and the email page shows the thumbnail
+        client = Client()
+        client.login(username='image_recipient', password='image_recipient')
+        session = client.session
+        session['email_session'] = True
+        session.save()
+        response = client.get(f'/view/{attachment.email.uid}')
+        self.assertContains(response, f'/attachment/{attachment.uid}/thumbnail')
+        response = client.get(f'/attachment/{attachment.uid}/thumbnail')
+        self.assertEqual(response['Content-Type'], 'image/webp')
+        self.assertTrue(response['Content-Disposition'].startswith('inline'))
+
+    def test_invalid_image(self):
+        """
+        Tests that uploads claiming to be images but that aren't are served as plain files.
+        """
+
+        attachment = self.send(SimpleUploadedFile('fake.png', b'not an image', content_type='image/png'))
+        attachment.refresh_from_db()
+        self.assertEqual(attachment.type, Attachment.FILE)
+        self.assertFalse(attachment.thumbnail)
+
+
+class TestJobs(MailTestCase):
+    """
+    Tests the database-backed job queue.
+    """
+
+    def setUp(self):
+        """
+        Sets up some prerequisites before each test.
+        """
+
+        task_calls.clear()
+        self.stop = threading.Event()
+
+    def test_run_jobs(self):
+        """
+        Tests that queued jobs are claimed once and run in order.
+        """
+
+        enqueue('record_call', 1)
+        enqueue('record_call', 2)
+        enqueue('record_call', 3, delay=60)
+
+        job = claim('test_worker')
+        self.assertEqual(job.args, [1])
+        self.assertEqual(job.attempts, 1)
+        self.assertEqual(Job.objects.get(pk=job.pk).status, Job.RUNNING)
+        self.assertTrue(run_job(job))
+
+        # the delayed job isn't due yet
+        self.assertEqual(work('test_worker', self.stop, burst=True), 1)
+        self.assertEqual(task_calls, [1, 2])
+        self.assertEqual(Job.objects.filter(status=Job.DONE).count(), 2)
+        self.assertEqual(Job.objects.filter(status=Job.QUEUED).count(), 1)
+
+    def test_retries(self):
+        """
+        Tests that failing jobs are retried with backoff, then marked as failed.
+        """
+
+        job = enqueue('always_fail')
+        self.assertFalse(run_job(claim('test_worker')))
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.QUEUED)
+        self.assertGreater(job.run_at, timezone.now())
+        self.assertIn('this task always fails', job.last_error)
+
+        # run out of attempts
+        Job.objects.filter(pk=job.pk).update(run_at=timezone.now())
+        self.assertFalse(run_job(claim('test_worker')))
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertEqual(job.attempts, 2)
+
+        # jobs whose worker died are run again
+        enqueue('record_call', 1)
+        job = claim('dead_worker')
+        Job.objects.filter(pk=job.pk).update(locked_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(requeue_stale(), 1)
+        self.assertEqual(work('test_worker', self.stop, burst=True), 1)
+        self.assertEqual(task_calls, [1])
+
+    def test_periodic(self):
+        """
+        Tests that periodic tasks are queued once per period.
+        """
+
+        with patch.dict(PERIODIC, {'record_call': 60}, clear=True):
+            self.assertEqual(queue_periodic(), 0)
+            Schedule.objects.filter(name='record_call').update(next_run_at=timezone.now())
+            self.assertEqual(queue_periodic(), 1)
+            self.assertEqual(queue_periodic(), 0)
+
+        self.assertEqual(Job.objects.filter(name='record_call').count(), 1)
+
+    @override_settings(DEFERRED_FANOUT_THRESHOLD=1)
+    def test_deferred_fan_out(self):
+        """
+        Tests that large sends return right away and are delivered by a worker.
+        """
+
+        users = [
+            CustomUser.objects.create_user(username=name, password=name, email=f"{name}@simpleemail.com")
+            for name in ['fan_sender', 'fan_one', 'fan_two']
+        ]
+        form = ComposeForm({
+            'subject': 'Fan out',
+            'sender': users[0].email,
+            'recipients': f"{users[1].email}, {users[2].email}",
+            'body': 'Fan out body',
+        })
+        self.assertTrue(form.is_valid())
+
+        # the job is only queued once the email is committed
+        with self.captureOnCommitCallbacks(using=shards.current_alias(), execute=True):
+            email = form.create_email_and_relations()
+            self.assertFalse(Job.objects.exists())
+        self.assertEqual(Recipient.objects.filter(email=email).count(), 0)
+
+        self.assertEqual(work('test_worker', self.stop, burst=True), 1)
+        self.assertEqual(Recipient.objects.filter(email=email).count(), 2)
+        self.assertEqual(MailboxEntry.objects.filter(email=email, folder=MailboxEntry.INBOX).count(), 2)
+        self.assertEqual(get_counts(users[1])['unread'], 1)
+
+        # running the job again, e.g. after its worker died before marking it done, adds nothing
+        job = Job.objects.get(name='fan_out_email')
+        Job.objects.filter(pk=job.pk).update(status=Job.QUEUED)
+        self.assertEqual(work('test_worker', self.stop, burst=True), 1)
+        self.assertEqual(Recipient.objects.filter(email=email).count(), 2)
+        self.assertEqual(MailboxEntry.objects.filter(email=email).count(), 3)
+        self.assertEqual(get_counts(users[1])['unread'], 1)
+
+
+class TestInbox(MailTestCase):
     """
     Tests the main inbox functionality of the website, along with
     other folders like outbox.
@@ -591,7 +1248,134 @@ class TestInbox(TestCase):
         self.assertEqual(len(response.context['emails']), 2)
 
 
-class TestSearch(TestCase):
+    def test_folder_queries_are_constant(self):
+        """
+        Tests that loading a folder takes the same number of queries regardless of its size.
+        """
+
+        # create a third user so emails have multiple recipients
+        test_user_three = CustomUser.objects.create_user(
+            username="recipient_two",
+            password="recipient_two",
+            email="recipient_two@email.com"
+        )
+
+        # load the folders with a single email in each
+        create_email('First', 'content', self.test_user_two, [self.test_user_one, test_user_three], False, False)
+        create_email('First', 'content', self.test_user_one, [self.test_user_two, test_user_three], False, False)
+        with self.assertNumQueries(1, using=shards.current_alias()):
+            self.assertEqual(len(load_inbox(self.test_user_one)[0]), 1)
+        with self.assertNumQueries(1, using=shards.current_alias()):
+            self.assertEqual(len(load_outbox(self.test_user_one)[0]), 1)
+
+        # load the folders again with many more emails in each
+        for i in range(20):
+            create_email(f'Subject {i}', 'content', self.test_user_two, [self.test_user_one, test_user_three], False, False)
+            create_email(f'Subject {i}', 'content', self.test_user_one, [self.test_user_two, test_user_three], False, False)
+        with self.assertNumQueries(1, using=shards.current_alias()):
+            rows, _ = load_inbox(self.test_user_one)
+        with self.assertNumQueries(1, using=shards.current_alias()):
+            self.assertEqual(len(load_outbox(self.test_user_one)[0]), 21)
+
+        # check that every row was built correctly
+        self.assertEqual(len(rows), 21)
+        for row in rows:
+            self.assertEqual(row['from'], self.test_user_two.email)
+            self.assertEqual(
+                sorted(row['to'].split(', ')),
+                sorted([self.test_user_one.email, test_user_three.email])
+            )
+
+
+    def test_inbox_pagination(self):
+        """
+        Tests walking through the inbox one page at a time with cursors.
+        """
+
+        # create some emails, some of which share the same timestamp
+        now = timezone.now()
+        subjects = []
+        for i in range(7):
+            email, sender, recipients = create_email(f'Subject {i}', 'content', self.test_user_two, [self.test_user_one], False, False)
+            MailboxEntry.objects.filter(email=email).update(sent_at=now - timedelta(minutes=i // 2))
+            subjects.append(email.subject)
+
+        # walk through every page of the inbox
+        seen = []
+        cursor = None
+        for _ in range(4):
+            response = self.client.get('/inbox', {'limit': 2, 'before': cursor or ''})
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(response.context['emails']), 2)
+            seen += [email['subject'] for email in response.context['emails']]
+            cursor = response.context['next_cursor']
+            if cursor is None:
+                break
+
+        # check that every email was shown exactly once, newest first
+        self.assertIsNone(cursor)
+        self.assertEqual(sorted(seen), sorted(subjects))
+        sent_at = [MailboxEntry.objects.get(user=self.test_user_one, subject=subject).sent_at for subject in seen]
+        self.assertEqual(sent_at, sorted(sent_at, reverse=True))
+
+
+    def test_rebuild_mailbox(self):
+        """
+        Tests that the mailbox entries can be rebuilt from the normalized tables.
+        """
+
+        # create a sent email and a draft
+        create_email('Sent', 'content', self.test_user_one, [self.test_user_two], False, False)
+        create_email('Draft', 'content', self.test_user_one, [self.test_user_two], True, False)
+        expected = sorted(MailboxEntry.objects.values_list('user', 'folder', 'subject', 'recipient_addresses'))
+
+        # wipe the mailbox and rebuild it in small batches
+        MailboxEntry.objects.all().delete()
+        self.assertEqual(rebuild_entries(batch_size=1), 3)
+
+        # check that the same entries were rebuilt
+        actual = sorted(MailboxEntry.objects.values_list('user', 'folder', 'subject', 'recipient_addresses'))
+        self.assertEqual(actual, expected)
+        self.assertEqual(
+            set(MailboxEntry.objects.values_list('folder', flat=True)),
+            {MailboxEntry.INBOX, MailboxEntry.OUTBOX, MailboxEntry.DRAFTS}
+        )
+
+
+    def test_counters(self):
+        """
+        Tests that the folder counters follow sends, reads, and archives.
+        """
+
+        cache.clear()
+
+        # receive two emails and send one
+        email, _, _ = create_email('First', 'content', self.test_user_two, [self.test_user_one], False, False)
+        create_email('Second', 'content', self.test_user_two, [self.test_user_one], False, False)
+        create_email('Sent', 'content', self.test_user_one, [self.test_user_two], False, False)
+        self.assertEqual(get_counts(self.test_user_one), {'unread': 2, 'inbox': 2, 'outbox': 1, 'drafts': 0})
+        self.assertContains(self.client.get('/inbox'), 'Inbox (2)')
+
+        # reading an email only counts once
+        self.client.get(f'/view/{email.uid}')
+        self.client.get(f'/view/{email.uid}')
+        self.assertEqual(get_counts(self.test_user_one)['unread'], 1)
+        self.assertTrue(Recipient.objects.get(user=self.test_user_one, email=email).is_read)
+
+        # archiving removes the email from the inbox
+        response = self.client.post(f'/archive/{email.uid}', follow=True)
+        self.assertContains(response, 'Message archived!')
+        self.assertEqual(len(response.context['emails']), 1)
+        self.assertEqual(get_counts(self.test_user_one), {'unread': 1, 'inbox': 1, 'outbox': 1, 'drafts': 0})
+
+        # drifted counters are repaired by reconciling
+        MailboxCounter.objects.filter(user=self.test_user_one).update(unread=42)
+        self.assertEqual(reconcile(), 1)
+        self.assertEqual(get_counts(self.test_user_one)['unread'], 1)
+        self.assertEqual(reconcile(), 0)
+
+
+class TestSearch(MailTestCase):
     """
     Tests the website's search functionality.
     """
@@ -780,3 +1564,1539 @@ class TestSearch(TestCase):
         email_one = response.context['emails'].get(self.email_one.uid)
         self.assertEqual(email_one['from'], self.test_user_one.email)
         self.assertEqual(email_one['to'], self.test_user_two.email)
+
+    def test_search_snippets(self):
+        """
+        Tests that search results come with highlighted snippets of the match.
+        """
+
+        # submit a query matching a word in an email's body
+        response = self.client.get('/search/', {'query': 'ridiculous'})
+
+        # check that the snippet highlights the matched word
+        self.assertEqual(response.status_code, 200)
+        email_three = response.context['emails'].get(self.email_three.uid)
+        self.assertIn('<mark>ridiculous</mark>', email_three['snippet'])
+        self.assertContains(response, '<mark>ridiculous</mark>', html=True)
+
+        # emails the user neither sent nor received are never returned
+        response = self.client.get('/search/', {'query': 'spectacular'})
+        self.assertEqual(len(response.context['emails']), 0)
+
+    def test_contentless_index(self):
+        """
+        Tests that the index keeps no copy of the bodies, and that matches past the stored snippet are still shown.
+        """
+
+        email, *_ = create_email(
+            subject='long email',
+            content='filler words ' * 50 + 'a needle in the haystack',
+            sender=self.test_user_two,
+            recipients=[self.test_user_one],
+            is_draft=False,
+            is_forward=False
+        )
+
+        # the snippet is cut from the body around the match
+        response = self.client.get('/search/', {'query': 'needle'})
+        snippet = response.context['emails'][email.uid]['snippet']
+        self.assertTrue(snippet.startswith('...filler words'))
+        self.assertIn('<mark>needle</mark> in the haystack', snippet)
+
+        # the index only keeps the terms, not the text
+        alias = shards.current_alias()
+        with connections[alias].cursor() as cursor:
+            cursor.execute("SELECT subject, body, participants FROM app_email_fts")
+            self.assertEqual(set(cursor.fetchall()), {(None, None, None)})
+
+        # removed emails are no longer found
+        search.remove_emails([email.uid], connections[alias])
+        response = self.client.get('/search/', {'query': 'needle'})
+        self.assertEqual(len(response.context['emails']), 0)
+
+    def test_search_pagination(self):
+        """
+        Tests walking through ranked search results one page at a time.
+        """
+
+        # walk through every page of results
+        seen = []
+        cursor = ''
+        for _ in range(4):
+            response = self.client.get('/search/', {'query': 'content', 'limit': 1, 'before': cursor})
+            self.assertEqual(response.status_code, 200)
+            seen += list(response.context['emails'].keys())
+            cursor = response.context['next_cursor']
+            if cursor is None:
+                break
+
+        # check that every match was returned exactly once
+        self.assertIsNone(cursor)
+        self.assertEqual(
+            sorted(seen),
+            sorted([self.email_one.uid, self.email_two.uid, self.email_three.uid])
+        )
+
+        # a folder page's cursor starts the results from the beginning
+        folder_cursor = encode_cursor(timezone.now(), self.email_one.uid)
+        response = self.client.get('/search/', {'query': 'content', 'before': folder_cursor})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['emails']), 3)
+
+    def test_search_pagination_ties(self):
+        """
+        Tests walking through search results that all have the same rank.
+        """
+
+        emails = [create_email('Identical', 'identical body', self.test_user_two, [self.test_user_one], False, False)[0]
+                  for _ in range(5)]
+
+        seen = []
+        ranks = set()
+        cursor = ''
+        for _ in range(6):
+            response = self.client.get('/search/', {'query': 'identical', 'limit': 2, 'before': cursor})
+            ranks |= {row['rank'] for row in response.context['emails'].values()}
+            seen += list(response.context['emails'].keys())
+            cursor = response.context['next_cursor']
+            if cursor is None:
+                break
+
+        self.assertEqual(len(ranks), 1)
+        self.assertIsNone(cursor)
+        self.assertEqual(sorted(seen), sorted(email.uid for email in emails))
+
+
+class TestAsyncViews(MailTestCase):
+    """
+    Tests the async versions of the mailbox read views served under ASGI.
+    """
+
+    def setUp(self):
+        """
+        Sets up some prerequisites before each test.
+        """
+
+        self.sender = CustomUser.objects.create_user(
+            username='async_sender',
+            password='async_sender',
+            email='async_sender@simpleemail.com'
+        )
+        self.recipient = CustomUser.objects.create_user(
+            username='async_recipient',
+            password='async_recipient',
+            email='async_recipient@simpleemail.com'
+        )
+        self.email, _, _ = create_email('Async subject', 'Async body', self.sender, [self.recipient], False, False)
+        self.factory = AsyncRequestFactory()
+
+    def request(self, path, user, email_session=True, method='get'):
+        request = getattr(self.factory, method)(path)
+        request.user = user
+        request.session = SessionStore()
+        request.session['email_session'] = email_session
+        request._messages = FallbackStorage(request)
+        return request
+
+    async def test_folders(self):
+        """
+        Tests that the async inbox and outbox list the right emails.
+        """
+
+        response = await async_views.inbox(self.request('/inbox', self.recipient))
+        self.assertContains(response, 'Async subject')
+        response = await async_views.outbox(self.request('/outbox', self.recipient))
+        self.assertNotContains(response, 'Async subject')
+        response = await async_views.outbox(self.request('/outbox', self.sender))
+        self.assertContains(response, 'Async subject')
+
+    async def test_view_email(self):
+        """
+        Tests that viewing an email asynchronously shows it and marks it as read.
+        """
+
+        response = await async_views.view_email(self.request('/view', self.recipient), self.email.uid)
+        self.assertContains(response, 'Async body')
+        self.assertContains(response, self.sender.email)
+        self.assertTrue(await MailboxEntry.objects.filter(user=self.recipient, is_read=True).aexists())
+
+    async def test_search_and_notes(self):
+        """
+        Tests the async search and note views.
+        """
+
+        response = await async_views.search(self.request('/search/?query=Async', self.recipient))
+        self.assertContains(response, 'Async subject')
+        response = await async_views.note_box(self.request('/note_box', self.recipient))
+        self.assertEqual(response.status_code, 200)
+
+    async def test_threads(self):
+        """
+        Tests the async conversation list and conversation views.
+        """
+
+        response = await async_views.threads(self.request('/threads', self.recipient))
+        self.assertContains(response, 'Async subject')
+        response = await async_views.view_thread(self.request('/thread', self.recipient), self.email.thread)
+        self.assertContains(response, f'/view/{self.email.uid}')
+
+    async def test_decorators(self):
+        """
+        Tests that the async decorators turn away users who aren't allowed in.
+        """
+
+        response = await async_views.inbox(self.request('/inbox', AnonymousUser()))
+        self.assertTrue(response['Location'].startswith('/login'))
+
+        response = await async_views.inbox(self.request('/inbox', self.recipient, email_session=False))
+        self.assertEqual(response['Location'], '/email_login')
+
+        response = await async_views.view_email(self.request('/view', self.recipient, method='post'), self.email.uid)
+        self.assertEqual(response.status_code, 405)
+
+
+@override_settings(EVENTS_SOCKET_DIR=None)
+class TestEvents(MailTestCase):
+    """
+    Tests pushing new mail and counter changes over Server-Sent Events.
+    """
+
+    def setUp(self):
+        """
+        Sets up some prerequisites before each test.
+        """
+
+        self.sender = CustomUser.objects.create_user(
+            username='events_sender',
+            password='events_sender',
+            email='events_sender@simpleemail.com'
+        )
+        self.recipient = CustomUser.objects.create_user(
+            username='events_recipient',
+            password='events_recipient',
+            email='events_recipient@simpleemail.com'
+        )
+
+    def test_delivery_publishes(self):
+        """
+        Tests that delivering an email publishes its events once the transaction commits.
+        """
+
+        with patch('app.events.publish') as publish:
+            with self.captureOnCommitCallbacks(using=shards.current_alias(), execute=True):
+                email, _, _ = create_email('Live subject', 'Live body', self.sender, [self.recipient], False, False)
+                publish.assert_not_called()
+
+        messages = [message for call in publish.call_args_list for message in call.args[0]]
+        self.assertIn((self.recipient.pk, 'counters', {'inbox': 1, 'unread': 1}), messages)
+        self.assertIn((self.sender.pk, 'counters', {'outbox': 1}), messages)
+
+        [(user_id, _, data)] = [message for message in messages if message[1] == 'message']
+        self.assertEqual(user_id, self.recipient.pk)
+        self.assertEqual(data['uid'], str(email.uid))
+        self.assertEqual(data['subject'], 'Live subject')
+        self.assertEqual(data['from'], self.sender.email)
+
+    def test_relay(self):
+        """
+        Tests that events published in one process reach streams subscribed in another.
+        """
+
+        async def relayed(directory):
+            with override_settings(EVENTS_SOCKET_DIR=directory):
+                broker = events.Broker()
+                events.Relay().listen(broker)
+                queue = broker.subscribe(self.recipient.pk)
+
+                events.Relay().send([(self.recipient.pk, 'counters', {'unread': 1}), (0, 'counters', {})])
+                return await asyncio.wait_for(queue.get(), 5)
+
+        with tempfile.TemporaryDirectory() as directory:
+            self.assertEqual(asyncio.run(relayed(directory)), ('counters', {'unread': 1}))
+
+            # sockets nobody is listening on any more are cleaned up
+            with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as gone:
+                gone.bind(os.path.join(directory, 'gone.sock'))
+            with override_settings(EVENTS_SOCKET_DIR=directory):
+                events.Relay().send([(self.recipient.pk, 'counters', {'unread': 1})])
+            self.assertNotIn('gone.sock', os.listdir(directory))
+
+    def session_cookie(self, email_session):
+        """
+        Returns a session cookie logging the recipient in.
+        """
+
+        client = Client()
+        client.force_login(self.recipient)
+        session = client.session
+        session['email_session'] = email_session
+        session.save()
+        return f"{settings.SESSION_COOKIE_NAME}={session.session_key}".encode()
+
+    async def stream(self, email_session=True):
+        """
+        Opens the event stream as the recipient, returning its communicator and response status.
+        """
+
+        cookie = await sync_to_async(self.session_cookie)(email_session)
+        communicator = ApplicationCommunicator(events.route_events(None), {
+            'type': 'http',
+            'method': 'GET',
+            'path': events.EVENTS_PATH,
+            'headers': [(b'cookie', cookie)],
+        })
+        await communicator.send_input({'type': 'http.request'})
+        start = await communicator.receive_output(5)
+        return communicator, start['status']
+
+    async def test_stream(self):
+        """
+        Tests that the event stream sends the user's events until they disconnect.
+        """
+
+        communicator, status = await self.stream()
+        self.assertEqual(status, 200)
+        self.assertEqual((await communicator.receive_output(5))['body'], b'retry: 5000\n\n')
+
+        events.broker.dispatch([(self.sender.pk, 'counters', {'outbox': 1})])
+        events.broker.dispatch([(self.recipient.pk, 'counters', {'unread': 1})])
+        body = (await communicator.receive_output(5))['body'].decode()
+        self.assertEqual(body, 'event: counters\ndata: {"unread": 1}\n\n')
+
+        # the stream ends and unsubscribes when the client goes away
+        await communicator.send_input({'type': 'http.disconnect'})
+        await communicator.wait(5)
+        self.assertNotIn(self.recipient.pk, events.broker.subscribers)
+
+    async def test_stream_requires_login(self):
+        """
+        Tests that the event stream turns away users who aren't logged in to the email client.
+        """
+
+        communicator, status = await self.stream(email_session=False)
+        self.assertEqual(status, 403)
+        await communicator.wait(5)
+
+
+@override_settings(FRAGMENT_CACHE_STATS=True)
+class TestFragmentCache(MailTestCase):
+    """
+    Tests caching the rendered rows of the mailbox pages.
+    """
+
+    def setUp(self):
+        """
+        Sets up some prerequisites before each test.
+        """
+
+        self.sender = CustomUser.objects.create_user(
+            username='fragment_sender',
+            password='fragment_sender',
+            email='fragment_sender@simpleemail.com'
+        )
+        self.recipient = CustomUser.objects.create_user(
+            username='fragment_recipient',
+            password='fragment_recipient',
+            email='fragment_recipient@simpleemail.com'
+        )
+        for subject in ['Cached one', 'Cached two']:
+            create_email(subject, 'Cached body', self.sender, [self.recipient], False, False)
+
+        self.client = Client()
+        self.client.force_login(self.recipient)
+        session = self.client.session
+        session['email_session'] = True
+        session.save()
+
+        self.fragments = caches['fragments']
+        self.fragments.clear()
+        self.fragments.reset_stats()
+
+    def test_rows_are_cached(self):
+        """
+        Tests that rows rendered once are served from the cache, across pages.
+        """
+
+        response = self.client.get('/inbox')
+        self.assertEqual(response['X-Fragment-Cache'], 'hits=0, misses=2')
+        self.assertContains(response, 'Cached one')
+
+        response = self.client.get('/inbox')
+        self.assertEqual(response['X-Fragment-Cache'], 'hits=2, misses=0')
+        self.assertContains(response, 'Cached one')
+
+        # search results render their rows differently, so they're cached under their own name
+        response = self.client.get('/search/', {'query': 'Cached'})
+        self.assertEqual(response['X-Fragment-Cache'], 'hits=0, misses=2')
+        self.assertNotContains(response, 'text-muted')
+        response = self.client.get('/search/', {'query': 'Cached'})
+        self.assertEqual(response['X-Fragment-Cache'], 'hits=2, misses=0')
+
+        self.assertEqual(self.fragments.stats(), {'hits': 4, 'misses': 4, 'hit_rate': 0.5})
+
+    def test_new_version_is_rendered(self):
+        """
+        Tests that bumping an email's version renders its row again.
+        """
+
+        self.client.get('/inbox')
+        Email.objects.filter(subject='Cached one').update(subject='Recached one')
+        rebuild_entries()
+
+        response = self.client.get('/inbox')
+        self.assertEqual(response['X-Fragment-Cache'], 'hits=0, misses=2')
+        self.assertContains(response, 'Recached one')
+        self.assertNotContains(response, 'Cached one')
+
+    def test_stats(self):
+        """
+        Tests that the wrapping cache counts hits and misses and passes everything through.
+        """
+
+        self.fragments.set('present', None)
+        self.assertIsNone(self.fragments.get('present', 'default'))
+        self.assertEqual(self.fragments.get('absent', 'default'), 'default')
+        self.assertEqual(self.fragments.get_many(['present', 'absent']), {'present': None})
+        self.assertEqual(self.fragments.stats(), {'hits': 2, 'misses': 2, 'hit_rate': 0.5})
+
+        # requests not being counted still count for the process
+        self.assertEqual(self.client.get('/inbox').status_code, 200)
+        with override_settings(FRAGMENT_CACHE_STATS=False):
+            self.assertNotIn('X-Fragment-Cache', self.client.get('/inbox'))
+        self.assertEqual(self.fragments.stats()['hits'], 4)
+
+
+class TestConditionalGet(MailTestCase):
+    """
+    Tests answering repeat views of unchanged pages with 304 Not Modified.
+    """
+
+    def setUp(self):
+        """
+        Sets up some prerequisites before each test.
+        """
+
+        self.sender = CustomUser.objects.create_user(
+            username='conditional_sender',
+            password='conditional_sender',
+            email='conditional_sender@simpleemail.com'
+        )
+        self.recipient = CustomUser.objects.create_user(
+            username='conditional_recipient',
+            password='conditional_recipient',
+            email='conditional_recipient@simpleemail.com'
+        )
+        self.email, _, _ = create_email('Conditional', 'Conditional body', self.sender, [self.recipient], False, False)
+
+        self.client = Client()
+        self.client.force_login(self.recipient)
+        session = self.client.session
+        session['email_session'] = True
+        session.save()
+
+    def revalidate(self, path, response):
+        return self.client.get(path, HTTP_IF_NONE_MATCH=response['ETag'])
+
+    def test_folders(self):
+        """
+        Tests that an unchanged folder is answered without reading the mailbox, until new mail arrives.
+        """
+
+        response = self.client.get('/inbox')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('no-cache', response['Cache-Control'])
+
+        with self.capture_queries() as queries:
+            self.assertEqual(self.revalidate('/inbox', response).status_code, 304)
+        self.assertFalse([query for query in queries if 'app_mailboxentry' in query['sql'] or 'app_email' in query['sql']])
+
+        # other pages of the folder have their own validators
+        self.assertEqual(self.revalidate('/inbox?limit=5', response).status_code, 200)
+
+        # a change from another worker is seen right away, even within the same second
+        self.assertNotIn('Last-Modified', response)
+        MailboxCounter.objects.filter(user=self.recipient).update(version=F('version') + 1)
+        self.assertEqual(self.revalidate('/inbox', response).status_code, 200)
+        response = self.client.get('/inbox')
+
+        create_email('Newer', 'Newer body', self.sender, [self.recipient], False, False)
+        response = self.revalidate('/inbox', response)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Newer')
+
+    def test_view_email(self):
+        """
+        Tests that viewing an email validates the page as it is once the email has been read.
+        """
+
+        path = f'/view/{self.email.uid}'
+        response = self.client.get(path)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.revalidate(path, response).status_code, 304)
+        self.assertEqual(get_counts(self.recipient)['unread'], 0)
+
+        # pages with messages waiting to be shown are always rendered
+        self.client.post('/archive/' + str(self.email.uid))
+        response = self.client.get(path)
+        self.assertEqual(self.revalidate(path, response).status_code, 304)
+        self.client.post('/archive/' + str(self.email.uid))
+        self.assertContains(self.revalidate(path, response), 'Message is not in your inbox!')
+
+    def test_counter_per_request(self):
+        """
+        Tests that a page reads the user's counters once, though its validators and nav bar both use them.
+        """
+
+        with self.capture_queries() as queries:
+            response = self.client.get('/inbox')
+        self.assertContains(response, '<span id="unread-count" data-count="1">')
+        self.assertEqual(len([query for query in queries if 'app_mailboxcounter' in query['sql']]), 1)
+
+        # counters changed by the view are reloaded for the rest of the page
+        response = self.client.get(f'/view/{self.email.uid}')
+        self.assertContains(response, '<span id="unread-count" data-count="0">')
+        self.assertEqual(self.revalidate(f'/view/{self.email.uid}', response).status_code, 304)
+
+    def test_counter_cache(self):
+        """
+        Tests that counters are read from the shared cache when it's configured, until they change.
+        """
+
+        counters_cache = {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'test-counters'}
+        with override_settings(CACHES={**settings.CACHES, 'counters': counters_cache}):
+            self.assertEqual(get_counts(self.recipient)['unread'], 1)
+            with self.assertNumQueries(0, using=shards.current_alias()):
+                self.assertEqual(get_counts(self.recipient)['unread'], 1)
+
+            create_email('Cached', 'Cached body', self.sender, [self.recipient], False, False)
+            self.assertEqual(get_counts(self.recipient)['unread'], 2)
+            caches['counters'].clear()
+
+    def test_notes(self):
+        """
+        Tests conditional GETs of notes, which never change, and the note box.
+        """
+
+        note = Note.objects.create(title='Conditional note', body='Note body', user=self.recipient)
+        path = f'/view_note/{note.uid}'
+        response = self.client.get(path)
+        self.assertEqual(self.revalidate(path, response).status_code, 304)
+
+        response = self.client.get('/note_box')
+        self.assertEqual(self.revalidate('/note_box', response).status_code, 304)
+        self.client.post('/note_compose', {'title': 'Another', 'body': 'Another body', 'user': self.recipient.username})
+        self.assertEqual(self.revalidate('/note_box', response).status_code, 200)
+
+    async def test_async_views(self):
+        """
+        Tests that the async views answer conditional GETs too.
+        """
+
+        factory = AsyncRequestFactory()
+
+        def request(etag=None):
+            request = factory.get('/inbox')
+            if etag:
+                request.META['HTTP_IF_NONE_MATCH'] = etag
+            request.user = self.recipient
+            request.session = SessionStore()
+            request.session['email_session'] = True
+            request._messages = FallbackStorage(request)
+            return request
+
+        response = await async_views.inbox(request())
+        self.assertEqual(response.status_code, 200)
+        response = await async_views.inbox(request(response['ETag']))
+        self.assertEqual(response.status_code, 304)
+
+
+class TestSessions(MailTestCase):
+    """
+    Tests the session engine that caches sessions in memory and writes changes behind.
+    """
+
+    def setUp(self):
+        """
+        Sets up some prerequisites before each test.
+        """
+
+        self.user = CustomUser.objects.create_user(
+            username='session_user',
+            password='session_user',
+            email='session_user@simpleemail.com'
+        )
+        self.client = Client()
+        self.client.force_login(self.user)
+        self.session_key = self.client.cookies[settings.SESSION_COOKIE_NAME].value
+
+        # start without changes queued by other tests
+        sessions.flush()
+
+    def stored(self):
+        return DjangoSession.objects.get(session_key=self.session_key).get_decoded()
+
+    def test_cached_reads(self):
+        """
+        Tests that requests with a cached session don't query the session table.
+        """
+
+        session = self.client.session
+        session['email_session'] = True
+        session.save()
+
+        with self.capture_queries() as queries:
+            self.assertEqual(self.client.get('/inbox').status_code, 200)
+        self.assertFalse([query for query in queries if 'django_session' in query['sql']])
+
+    def test_write_behind(self):
+        """
+        Tests that changes to the login state are written right away, and others are written behind.
+        """
+
+        session = CachedSessionStore(self.session_key)
+        session['email_session'] = True
+        session.save()
+        self.assertTrue(self.stored()['email_session'])
+
+        session = CachedSessionStore(self.session_key)
+        session['theme'] = 'dark'
+        session.save()
+        self.assertNotIn('theme', self.stored())
+        self.assertEqual(CachedSessionStore(self.session_key)['theme'], 'dark')
+
+        self.assertEqual(sessions.flush(), 1)
+        self.assertEqual(self.stored()['theme'], 'dark')
+
+    def test_delete(self):
+        """
+        Tests that deleted sessions are dropped from the cache and not written back.
+        """
+
+        session = CachedSessionStore(self.session_key)
+        session['theme'] = 'dark'
+        session.save()
+        session.delete()
+
+        self.assertEqual(sessions.flush(), 0)
+        self.assertFalse(DjangoSession.objects.filter(session_key=self.session_key).exists())
+        self.assertEqual(CachedSessionStore(self.session_key).load(), {})
+
+    def test_logout_elsewhere(self):
+        """
+        Tests that a session logged out by another process isn't served from this process's cache.
+        """
+
+        self.assertIn(auth.SESSION_KEY, CachedSessionStore(self.session_key).load())
+
+        # another process deletes the session, which this process still has cached
+        DjangoSession.objects.filter(session_key=self.session_key).delete()
+        self.assertIn(auth.SESSION_KEY, CachedSessionStore(self.session_key).load())
+        bump_login_version(self.session_key)
+        self.assertEqual(CachedSessionStore(self.session_key).load(), {})
+
+        # logging out moves the session to a new version
+        self.client.force_login(self.user)
+        session_key = self.client.cookies[settings.SESSION_COOKIE_NAME].value
+        version = login_version(session_key)
+        self.client.logout()
+        self.assertGreater(login_version(session_key), version)
+
+
+class TestLoginThrottle(MailTestCase):
+    """
+    Tests rate limiting and locking out email logins.
+    """
+
+    def setUp(self):
+        """
+        Sets up some prerequisites before each test.
+        """
+
+        cache.clear()
+        self.user = CustomUser.objects.create_user(
+            username='throttle_user',
+            password='throttle_user',
+            email='throttle_user@simpleemail.com'
+        )
+        self.user.email_password = self.user.password
+        self.user.save()
+
+        self.client = Client()
+        self.client.force_login(self.user)
+
+    def attempt(self, password, email='throttle_user@simpleemail.com'):
+        return self.client.post('/email_login', {'email': email, 'password': password})
+
+    def test_lockout(self):
+        """
+        Tests that failed attempts lock the account with atomic updates, even against the right password.
+        """
+
+        for _ in range(LOCKOUT_THRESHOLD):
+            with self.capture_queries() as queries:
+                self.assertContains(self.attempt('wrong'), 'Invalid email or password.')
+
+            # the user is only touched by a single narrow update
+            updates = [query['sql'] for query in queries if query['sql'].startswith('UPDATE "app_customuser"')]
+            self.assertEqual(len(updates), 1)
+            self.assertNotIn('"username"', updates[0])
+
+        self.assertContains(self.attempt('throttle_user'), 'User account is locked')
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.failed_attempts, LOCKOUT_THRESHOLD)
+
+    def test_success_resets_failures(self):
+        """
+        Tests that logging in resets the account's failed attempts.
+        """
+
+        self.attempt('wrong')
+        self.assertRedirects(self.attempt('throttle_user'), '/inbox', fetch_redirect_response=False)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.failed_attempts, 0)
+
+    @override_settings(LOGIN_RATE_LIMITS={'account': (2, 60), 'ip': (3, 60)})
+    def test_rate_limits(self):
+        """
+        Tests that bursts of failed attempts are turned away without querying the user table.
+        """
+
+        self.attempt('wrong', email='nobody@simpleemail.com')
+        self.attempt('wrong', email='nobody@simpleemail.com')
+        with self.capture_queries() as queries:
+            response = self.attempt('wrong', email='nobody@simpleemail.com')
+        self.assertEqual(response.status_code, 429)
+        self.assertFalse([query for query in queries if 'WHERE "app_customuser"."email"' in query['sql']])
+
+        # other accounts are still limited by the IP address
+        self.assertContains(self.attempt('wrong'), 'Invalid email or password.')
+        self.assertEqual(self.attempt('throttle_user').status_code, 429)
+
+    def test_sliding_window(self):
+        """
+        Tests that the previous window's hits count for as much of it as the sliding window still covers.
+        """
+
+        window = SlidingWindow('test', limit=8, window=60)
+        for _ in range(8):
+            window.hit('ident', now=600)
+        self.assertFalse(window.allows('ident', now=600))
+        self.assertEqual(window.hit('ident', now=660 + 15), 8 * 0.75 + 1)
+        self.assertTrue(window.allows('ident', now=660 + 15))
+        self.assertEqual(window.count('ident', now=720 + 30), 0.5)
+
+
+class TestLoginThrottleConcurrency(TransactionTestCase):
+    """
+    Tests that failed attempts are counted exactly when they happen in parallel.
+    """
+
+    ATTEMPTS = 40
+
+    def test_parallel_attempts(self):
+        cache.clear()
+        users = [
+            CustomUser.objects.create_user(username=f'parallel_{i}', email=f'parallel_{i}@simpleemail.com')
+            for i in range(2)
+        ]
+        window = SlidingWindow('parallel', limit=self.ATTEMPTS, window=3600)
+        barrier = threading.Barrier(8)
+
+        def attempt(i):
+            try:
+                if i < 8:
+                    barrier.wait()
+                record_failure(users[i % 2].pk)
+                return window.hit('ident', now=0)
+            finally:
+                connection.close()
+
+        threads = []
+        counts = []
+        for i in range(self.ATTEMPTS):
+            thread = threading.Thread(target=lambda i=i: counts.append(attempt(i)))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        # every hit got its own count, and no account went past the lockout threshold
+        self.assertEqual(sorted(counts), list(range(1, self.ATTEMPTS + 1)))
+        for user in users:
+            user.refresh_from_db()
+            self.assertEqual(user.failed_attempts, LOCKOUT_THRESHOLD)
+
+
+class TestHashingPool(MailTestCase):
+    """
+    Tests hashing passwords on the bounded hashing pool.
+    """
+
+    def setUp(self):
+        """
+        Sets up some prerequisites before each test.
+        """
+
+        cache.clear()
+
+        # a password hashed with fewer iterations than the current default
+        self.old_hash = PBKDF2PasswordHasher().encode('hashing_user', 'oldsalt', iterations=1000)
+        self.user = CustomUser.objects.create_user(username='hashing_user', email='hashing_user@simpleemail.com')
+        CustomUser.objects.filter(pk=self.user.pk).update(password=self.old_hash, email_password=self.old_hash)
+
+    def test_pool_full(self):
+        """
+        Tests that work past the pool's workers and queue is turned away.
+        """
+
+        pool = HashingPool(workers=1, queue=1)
+        started = threading.Event()
+        release = threading.Event()
+
+        def block():
+            started.set()
+            release.wait(5)
+            return 'done'
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(pool.run(block))) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        started.wait(5)
+        while pool.capacity._value:
+            time.sleep(0.01)
+
+        with self.assertRaises(PoolFull):
+            pool.run(block)
+
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ['done', 'done'])
+        pool.shutdown()
+
+    def test_overloaded_logins(self):
+        """
+        Tests that logins turned away by a full pool get a fast 503.
+        """
+
+        with patch('app.hashing.HashingPool.run', side_effect=PoolFull):
+            response = self.client.post('/login', {'username': 'hashing_user', 'password': 'hashing_user'})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+
+    def test_rehash_on_login(self):
+        """
+        Tests that logging in moves both passwords to the current hashing parameters.
+        """
+
+        response = self.client.post('/login', {'username': 'hashing_user', 'password': 'hashing_user'})
+        self.assertRedirects(response, '/', fetch_redirect_response=False)
+        response = self.client.post('/email_login', {'email': self.user.email, 'password': 'hashing_user'})
+        self.assertRedirects(response, '/inbox', fetch_redirect_response=False)
+
+        self.user.refresh_from_db()
+        for encoded in [self.user.password, self.user.email_password]:
+            self.assertNotEqual(encoded, self.old_hash)
+            self.assertFalse(identify_hasher(encoded).must_update(encoded))
+            self.assertTrue(check_password('hashing_user', encoded))
+
+
+class TestQueryPlans(MailTestCase):
+    """
+    Tests that the hot access paths are served by indexes rather than full table scans.
+    """
+
+    def setUp(self):
+        """
+        Sets up some prerequisites before each test.
+        """
+
+        self.sender = CustomUser.objects.create_user(username='plan_sender', email='plan_sender@simpleemail.com')
+        self.user = CustomUser.objects.create_user(username='plan_user', email='plan_user@simpleemail.com')
+        self.email, *_ = create_email('Plans', 'Query plans', self.sender, [self.user], False, False)
+
+    def assertUsesIndexes(self, queryset, ordered=False):
+        """
+        Asserts that the plan for a queryset doesn't scan a whole table or, if ordered, sort its rows.
+        """
+
+        if connection.vendor == 'postgresql':
+            # tiny test tables are cheapest to scan, so make the planner show the index it would use
+            with connection.cursor() as cursor:
+                cursor.execute("SET enable_seqscan = off")
+            plan = queryset.explain()
+            self.assertNotIn("Seq Scan on", plan)
+            if ordered:
+                self.assertNotIn("Sort Key", plan)
+        else:
+            plan = queryset.explain()
+            self.assertNotRegex(plan, r"\bSCAN app_\w+")
+            if ordered:
+                self.assertNotIn("TEMP B-TREE FOR ORDER BY", plan)
+        return plan
+
+    def test_folder_pages(self):
+        """
+        Tests that folder pages are read in order from the folder index, with and without a cursor.
+        """
+
+        for folder in (MailboxEntry.INBOX, MailboxEntry.OUTBOX):
+            self.assertUsesIndexes(keyset_slice(folder_entries(self.user, folder)), ordered=True)
+            before = (self.email.sent_at, self.email.uid)
+            self.assertUsesIndexes(keyset_slice(folder_entries(self.user, folder), before), ordered=True)
+
+    def test_email_lookups(self):
+        """
+        Tests that marking an email read or archived, showing search results, and checking who may
+        download an attachment use indexes.
+        """
+
+        self.assertUsesIndexes(MailboxEntry.objects.filter(
+            user=self.user, email=self.email, folder=MailboxEntry.INBOX, is_read=False
+        ))
+        self.assertUsesIndexes(Recipient.objects.filter(user=self.user, email=self.email))
+        self.assertUsesIndexes(MailboxEntry.objects.filter(user=self.user, email__in=[self.email.uid]))
+        self.assertUsesIndexes(self.email.recipient_set.all())
+        self.assertUsesIndexes(self.email.sender_email.all())
+        self.assertUsesIndexes(Attachment.objects.filter(uid=self.email.uid))
+        for entries in views.participant_entries(self.user, self.email.uid):
+            self.assertUsesIndexes(entries)
+
+    def test_user_lookups(self):
+        """
+        Tests that users and their counters are found by address and id using indexes.
+        """
+
+        self.assertUsesIndexes(CustomUser.objects.filter(email=self.user.email))
+        self.assertUsesIndexes(CustomUser.objects.filter(email__in=[self.user.email, self.sender.email]))
+        self.assertUsesIndexes(MailboxCounter.objects.filter(user=self.user))
+
+    def test_archive_paths(self):
+        """
+        Tests that archive pages and the search for mail due to be archived use indexes.
+        """
+
+        self.assertUsesIndexes(keyset_slice(archived_entries(self.user)), ordered=True)
+        self.assertUsesIndexes(ArchivedEntry.objects.filter(user=self.user, email=self.email, is_read=False))
+        # the partial index only holds archived entries, so reading all of it is fine
+        archived, aging = due_entries(timezone.now())
+        self.assertIn('mailbox_archived_idx', archived.select_for_update()[:ARCHIVE_BATCH_SIZE].explain())
+        self.assertUsesIndexes(aging.select_for_update()[:ARCHIVE_BATCH_SIZE], ordered=True)
+
+    def test_thread_paths(self):
+        """
+        Tests that the thread list and whole conversations are read in order from the thread indexes.
+        """
+
+        self.assertUsesIndexes(keyset_slice(thread_list(self.user)), ordered=True)
+        plan = self.assertUsesIndexes(conversation(self.user, self.email.thread), ordered=True)
+        self.assertIn('mailbox_thread_idx', plan)
+        self.assertIn('archived_thread_idx', plan)
+
+    def test_unique_addresses(self):
+        """
+        Tests that an address can't belong to two users, while any number of users may have none.
+        """
+
+        CustomUser.objects.create_user(username='no_address_1')
+        CustomUser.objects.create_user(username='no_address_2')
+        with self.assertRaises(IntegrityError):
+            CustomUser.objects.create_user(username='plan_copy', email=self.user.email)
+
+
+@override_settings(DATABASE_REPLICAS=['default'], SHARD_DATABASES=[])
+class TestReplicas(TestCase):
+    """
+    Tests routing mailbox reads to the read replicas, with users seeing their own changes.
+    The primary stands in for the replica, so the tests check where reads are routed.
+    Sharded mail is always read from its shard, so these tests run without shards.
+    """
+
+    databases = set(shards.all_databases())
+
+    def setUp(self):
+        """
+        Sets up some prerequisites before each test.
+        """
+
+        self.sender = CustomUser.objects.create_user(username='replica_sender', email='replica_sender@simpleemail.com')
+        self.user = CustomUser.objects.create_user(username='replica_user', email='replica_user@simpleemail.com')
+        self.email, _, _ = create_email('Replicas', 'Replica body', self.sender, [self.user], False, False)
+
+        self.client = Client()
+        self.client.force_login(self.user)
+        session = self.client.session
+        session['email_session'] = True
+        session.save()
+
+    def settle(self, *users):
+        # the replicas have caught up with every earlier change
+        MailboxCounter.objects.filter(user__in=users).update(changed_at=timezone.now() - timedelta(minutes=1))
+        cache.clear()
+
+    def test_router(self):
+        """
+        Tests that replica requests read from a replica until they write, and that writes use the primary.
+        """
+
+        router = replicas.ReplicaRouter()
+        with override_settings(DATABASE_REPLICAS=['replica1']):
+            self.assertIsNone(router.db_for_read(Email))
+
+            token = replicas.request_state.set({'replica': True, 'wrote': False})
+            try:
+                self.assertEqual(router.db_for_read(Email), 'replica1')
+                self.assertEqual(search.search_database(self.user), 'replica1')
+                self.assertEqual(router.db_for_write(Email), 'default')
+                self.assertEqual(router.db_for_read(Email), 'default')
+            finally:
+                replicas.request_state.reset(token)
+
+    def test_mailbox_reads(self):
+        """
+        Tests that only GETs of the mailbox pages read from the replicas.
+        """
+
+        self.settle(self.user)
+        with patch('app.replicas.choose_replica', return_value='default') as choose_replica:
+            for path in ['/inbox', '/outbox', '/note_box', '/search/?query=replica']:
+                self.assertEqual(self.client.get(path).status_code, 200)
+                self.assertTrue(choose_replica.called, path)
+                choose_replica.reset_mock()
+
+            self.assertEqual(self.client.get('/compose').status_code, 200)
+            self.assertFalse(choose_replica.called)
+
+    def test_read_your_writes(self):
+        """
+        Tests that users whose mailbox just changed read from the primary until the replicas catch up.
+        """
+
+        self.settle(self.user, self.sender)
+        with patch('app.replicas.choose_replica', return_value='default') as choose_replica:
+            # viewing the email reads it from a replica and marks it read on the primary
+            self.assertEqual(self.client.get(f'/view/{self.email.uid}').status_code, 200)
+            self.assertTrue(choose_replica.called)
+            self.assertTrue(MailboxEntry.objects.get(user=self.user, email=self.email).is_read)
+            choose_replica.reset_mock()
+
+            # new mail is read from the primary, by both the recipient and the sender
+            create_email('Fresh', 'Fresh body', self.sender, [self.user], False, False)
+            self.assertContains(self.client.get('/inbox'), 'Fresh')
+            self.client.force_login(self.sender)
+            session = self.client.session
+            session['email_session'] = True
+            session.save()
+            self.assertContains(self.client.get('/outbox'), 'Fresh')
+            self.assertFalse(choose_replica.called)
+
+            self.settle(self.user, self.sender)
+            self.client.get('/outbox')
+            self.assertTrue(choose_replica.called)
+
+
+class TestShards(TransactionTestCase):
+    """
+    Tests sharding each user's mail across databases.
+    Sends and moves between shards need SIMPLE_EMAIL_SHARDS to name at least two SQLite files.
+    """
+
+    databases = '__all__'
+    sharded = len(settings.SHARD_DATABASES) >= 2
+
+    def login(self, user):
+        client = Client()
+        client.force_login(user)
+        session = client.session
+        session['email_session'] = True
+        session.save()
+        return client
+
+    def create_user(self, username, shard):
+        user = CustomUser.objects.create_user(username=username, email=f'{username}@simpleemail.com')
+        CustomUser.objects.filter(pk=user.pk).update(shard=shard)
+        user.shard = shard
+        return user
+
+    def send(self, sender, recipients, subject):
+        response = self.login(sender).post('/compose', {
+            'subject': subject,
+            'sender': sender.email,
+            'recipients': ','.join(user.email for user in recipients),
+            'body': f'{subject} body',
+            'is_draft': 'false',
+            'is_forward': 'false'
+        })
+        self.assertRedirects(response, '/', fetch_redirect_response=False)
+        return Email.objects.using(shards.shard_for(sender)).get(subject=subject)
+
+    def test_router(self):
+        """
+        Tests that mail tables follow the current shard, and that users and attachments stay on 'default'.
+        """
+
+        router = shards.ShardRouter()
+        with override_settings(SHARD_DATABASES=['shard1', 'shard2']):
+            self.assertEqual(router.db_for_read(Email), 'default')
+            with shards.using_shard('shard2'):
+                self.assertEqual(router.db_for_write(MailboxEntry), 'shard2')
+                self.assertIsNone(router.db_for_read(CustomUser))
+
+            email = Email()
+            email._state.db = 'shard1'
+            self.assertEqual(router.db_for_read(Recipient, instance=email), 'shard1')
+            self.assertEqual(router.db_for_read(Attachment, instance=email), 'default')
+            self.assertEqual(router.db_for_write(Sender, instance=CustomUser(pk=1)), 'default')
+            self.assertTrue(router.allow_relation(email, CustomUser()))
+
+        with override_settings(SHARD_DATABASES=[]):
+            self.assertIsNone(router.db_for_read(Email))
+
+    @contextmanager
+    def new_shard(self):
+        """
+        Adds a new SQLite database as the only shard for the block, yielding its alias once it's migrated.
+        """
+
+        alias = 'new_shard'
+        directory = tempfile.mkdtemp()
+        connections.settings[alias] = {
+            **connections[DEFAULT_DB_ALIAS].settings_dict, 'NAME': os.path.join(directory, 'shard.sqlite3')
+        }
+        try:
+            with override_settings(SHARD_DATABASES=[alias]):
+                call_command('migrate', database=alias, verbosity=0)
+                yield alias
+        finally:
+            connections[alias].close()
+            del connections[alias]
+            del connections.settings[alias]
+            shutil.rmtree(directory)
+
+    def test_migrate_new_shard(self):
+        """
+        Tests that migrating a new shard only writes to that shard, while 'default' already holds mail.
+        """
+
+        with override_settings(SHARD_DATABASES=[]):
+            sender = CustomUser.objects.create_user(username='old_sender', email='old_sender@simpleemail.com')
+            recipient = CustomUser.objects.create_user(username='old_recipient', email='old_recipient@simpleemail.com')
+            create_email('Before shards', 'Old mail', sender, [recipient], False, False)
+        before = [model.objects.using('default').count() for model in (MailboxEntry, MailboxCounter)]
+
+        with self.new_shard() as alias:
+            # the data migrations ran on the new shard's empty tables, and left 'default' alone
+            self.assertEqual([model.objects.using('default').count() for model in (MailboxEntry, MailboxCounter)], before)
+            for model in (Email, Recipient, MailboxEntry, MailboxCounter):
+                self.assertFalse(model.objects.using(alias).exists())
+
+    def test_search_index_migration(self):
+        """
+        Tests that the migration to the contentless search index re-indexes the mail on a shard.
+        """
+
+        with self.new_shard() as alias:
+            sender = self.create_user('reindex_sender', alias)
+            recipient = self.create_user('reindex_recipient', alias)
+            email = self.send(sender, [recipient], 'Reindexed mail')
+
+            # run the migration again, over the mail that's there now
+            call_command('migrate', 'app', '0023', database=alias, verbosity=0)
+            call_command('migrate', 'app', database=alias, verbosity=0)
+
+            connection = connections[alias]
+            backend = search.get_backend(connection)
+            for query in ('reindexed mail body', sender.email):
+                results = backend.search(connection, recipient.pk, query, None, 10)
+                self.assertEqual([uid for uid, _ in results], [email.uid.hex])
+
+    @skipUnless(sharded, "set SIMPLE_EMAIL_SHARDS to at least two SQLite files")
+    def test_cross_shard_send(self):
+        """
+        Tests that a send is written to the shard of each participant, who only see it on their own shard.
+        """
+
+        first, second = settings.SHARD_DATABASES[:2]
+        sender = self.create_user('shard_sender', first)
+        recipient = self.create_user('shard_recipient', second)
+        email = self.send(sender, [recipient], 'Across shards')
+
+        for alias in (first, second):
+            self.assertTrue(Email.objects.using(alias).filter(uid=email.uid).exists())
+            self.assertEqual(Recipient.objects.using(alias).filter(email=email.uid).count(), 1)
+        self.assertEqual(MailboxEntry.objects.using(first).get(email=email.uid).user_id, sender.pk)
+        self.assertEqual(MailboxEntry.objects.using(second).get(email=email.uid).user_id, recipient.pk)
+        self.assertFalse(Email.objects.using('default').exists())
+
+        client = self.login(recipient)
+        self.assertContains(client.get('/inbox'), 'Across shards')
+        self.assertContains(client.get('/search/?query=across'), 'Across shards')
+        self.assertContains(client.get(f'/view/{email.uid}'), sender.email)
+        self.assertTrue(MailboxEntry.objects.using(second).get(email=email.uid).is_read)
+        self.assertEqual(MailboxCounter.objects.using(second).get(user=recipient).unread, 0)
+        self.assertContains(self.login(sender).get('/outbox'), 'Across shards')
+
+        # delivering the email again, like a retried fan out job, doesn't copy it twice
+        with shards.using_shard(first):
+            fan_out(Email.objects.get(uid=email.uid), Sender.objects.get(email=email.uid), [recipient],
+                    is_sent=True, is_forward=False)
+        for alias in (first, second):
+            self.assertEqual(Recipient.objects.using(alias).filter(email=email.uid).count(), 1)
+            self.assertEqual(MailboxEntry.objects.using(alias).filter(email=email.uid).count(), 1)
+
+    @skipUnless(sharded, "set SIMPLE_EMAIL_SHARDS to at least two SQLite files")
+    def test_move_user(self):
+        """
+        Tests moving a user's mail to another shard, leaving other users' copies where they are.
+        """
+
+        first, second = settings.SHARD_DATABASES[:2]
+        sender = self.create_user('moving_sender', first)
+        mover = self.create_user('mover', second)
+        stayer = self.create_user('stayer', second)
+        shared = self.send(sender, [mover, stayer], 'Shared mail')
+        private = self.send(sender, [mover], 'Private mail')
+        with shards.using_shard(second):
+            archive(mover, private.uid)
+
+        self.assertEqual(rebalance.move_user(mover, first, grace_period=0), 2)
+        self.assertEqual(CustomUser.objects.get(pk=mover.pk).shard, first)
+
+        # the mover's mail is only on the new shard, where the sender already had a copy of each email
+        self.assertEqual(MailboxEntry.objects.using(first).filter(user=mover).count(), 1)
+        self.assertEqual(ArchivedEntry.objects.using(first).get(user=mover).email_id, private.uid)
+        self.assertFalse(MailboxEntry.objects.using(second).filter(user=mover).exists())
+        self.assertFalse(ArchivedEntry.objects.using(second).filter(user=mover).exists())
+        self.assertFalse(MailboxCounter.objects.using(second).filter(user=mover).exists())
+        self.assertEqual(MailboxCounter.objects.using(first).get(user=mover).unread, 1)
+
+        # emails are only removed from the old shard once no one there has them
+        self.assertTrue(Email.objects.using(second).filter(uid=shared.uid).exists())
+        self.assertFalse(Email.objects.using(second).filter(uid=private.uid).exists())
+
+        client = self.login(CustomUser.objects.get(pk=mover.pk))
+        response = client.get('/inbox')
+        self.assertContains(response, 'Shared mail')
+        self.assertContains(client.get('/archive'), 'Private mail')
+        self.assertContains(client.get(f'/view/{private.uid}'), 'Private mail body')
+        self.assertContains(client.get('/search/?query=private'), 'Private mail')
+        self.assertContains(self.login(stayer).get('/inbox'), 'Shared mail')
+
+    @skipUnless(sharded, "set SIMPLE_EMAIL_SHARDS to at least two SQLite files")
+    def test_move_keeps_new_changes(self):
+        """
+        Tests that catching up with the old shard doesn't undo what the user did on the new one during the move.
+        """
+
+        first, second = settings.SHARD_DATABASES[:2]
+        sender = self.create_user('grace_sender', first)
+        mover = self.create_user('grace_mover', second)
+        read, archived, deleted = [self.send(sender, [mover], subject) for subject in ('Read', 'Archived', 'Deleted')]
+
+        def during_grace_period(seconds):
+            # the user's requests and new mail already go to the new shard
+            moved = CustomUser.objects.get(pk=mover.pk)
+            self.assertContains(self.login(moved).get(f'/view/{read.uid}'), 'Read body')
+            with shards.using_shard(first):
+                archive(moved, archived.uid)
+            self.send(sender, [moved], 'Arrived')
+
+            # while a request that started earlier deletes an entry on the old shard
+            MailboxEntry.objects.using(second).filter(user=mover, email=deleted.uid).delete()
+
+        with patch('app.rebalance.time.sleep', side_effect=during_grace_period):
+            rebalance.move_user(mover, first)
+
+        entries = MailboxEntry.objects.using(first).filter(user=mover)
+        self.assertEqual(set(entries.values_list('subject', 'is_read')), {('Read', True), ('Arrived', False)})
+        self.assertEqual(ArchivedEntry.objects.using(first).get(user=mover).email_id, archived.uid)
+        counter = MailboxCounter.objects.using(first).get(user=mover)
+        self.assertEqual((counter.inbox, counter.unread), (2, 1))
+        self.assertEqual(MailboxThread.objects.using(first).filter(user=mover).count(), 3)
+
+
+class TestArchive(MailTestCase):
+    """
+    Tests moving archived and old mail into the archive tables.
+    """
+
+    def setUp(self):
+        """
+        Sets up some prerequisites before each test.
+        """
+
+        cache.clear()
+        self.user = CustomUser.objects.create_user(username='archiver', email='archiver@simpleemail.com')
+        self.other = CustomUser.objects.create_user(username='correspondent', email='correspondent@simpleemail.com')
+        self.client.force_login(self.user)
+        session = self.client.session
+        session['email_session'] = True
+        session.save()
+
+    def test_archive_folder(self):
+        """
+        Tests that archiving moves an email from the inbox to the archive folder, where it can still be read and searched.
+        """
+
+        email, _, _ = create_email('Old news', 'archived content', self.other, [self.user], False, False)
+        response = self.client.post(f'/archive/{email.uid}', follow=True)
+        self.assertContains(response, 'Message archived!')
+        self.assertNotContains(response, 'Old news')
+
+        self.assertFalse(MailboxEntry.objects.filter(user=self.user).exists())
+        self.assertEqual(ArchivedEntry.objects.get(user=self.user).email_id, email.uid)
+        self.assertEqual(get_counts(self.user), {'unread': 0, 'inbox': 0, 'outbox': 0, 'drafts': 0})
+
+        # the sender still has it in their outbox, so its body stays in place
+        self.assertEqual(Email.objects.get(uid=email.uid).body, 'archived content')
+
+        self.assertContains(self.client.get('/archive'), 'Old news')
+        self.assertContains(self.client.get(f'/view/{email.uid}'), 'archived content')
+        self.assertTrue(ArchivedEntry.objects.get(user=self.user).is_read)
+        self.assertContains(self.client.get('/search/?query=archived'), 'Old news')
+        self.assertEqual(self.client.post(f'/archive/{email.uid}', follow=True).status_code, 200)
+        self.assertEqual(ArchivedEntry.objects.count(), 1)
+
+    def test_old_mail(self):
+        """
+        Tests that old mail is archived with its body compressed, and isn't brought back by rebuilds.
+        """
+
+        old, _, _ = create_email('Ancient', 'compressed content', self.other, [self.user], False, False)
+        create_email('Recent', 'recent content', self.other, [self.user], False, False)
+        MailboxEntry.objects.filter(email=old).update(sent_at=timezone.now() - timedelta(days=400))
+
+        self.assertEqual(archive_old_mail(days=365), 2)
+        self.assertEqual(archive_old_mail(days=365), 0)
+        self.assertEqual(get_counts(self.user), {'unread': 1, 'inbox': 1, 'outbox': 0, 'drafts': 0})
+        self.assertEqual(get_counts(self.other)['outbox'], 1)
+
+        # no mailbox shows the email anymore, so its body was compressed into the archive
+        self.assertIsNone(Email.objects.get(uid=old.uid).body)
+        self.assertTrue(ArchivedBody.objects.filter(email=old).exists())
+        self.assertContains(self.client.get(f'/view/{old.uid}'), 'compressed content')
+        self.assertContains(self.client.get('/search/?query=compressed'), 'Ancient')
+
+        # rebuilding the mailbox leaves archived entries in the archive
+        rebuild_entries()
+        self.assertEqual(set(MailboxEntry.objects.values_list('subject', flat=True)), {'Recent'})
+        self.assertEqual(reconcile(), 0)
+
+
+@override_settings(EMAIL_BODY_COMPRESS_THRESHOLD=100, EMAIL_BODY_BLOB_THRESHOLD=1000)
+class TestBodies(MailTestCase):
+    """
+    Tests storing large email bodies compressed, and the largest ones in blob files.
+    """
+
+    def setUp(self):
+        """
+        Sets up some prerequisites before each test.
+        """
+
+        # keep this test's files out of the real media directory
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+
+        self.sender = CustomUser.objects.create_user(username='body_sender', email='body_sender@simpleemail.com')
+        self.recipient = CustomUser.objects.create_user(username='body_reader', email='body_reader@simpleemail.com')
+        self.client.force_login(self.recipient)
+        session = self.client.session
+        session['email_session'] = True
+        session.save()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+
+    def send(self, subject, body):
+        form = ComposeForm({
+            'subject': subject,
+            'sender': self.sender.email,
+            'recipients': self.recipient.email,
+            'body': body,
+        })
+        self.assertTrue(form.is_valid())
+        return Email.objects.get(uid=form.create_email_and_relations().uid)
+
+    def test_tiers(self):
+        """
+        Tests that bodies are stored in the form their size calls for, and read back when shown.
+        """
+
+        short = self.send('Short', 'short body')
+        medium = self.send('Medium', 'medium newsletter ' * 20)
+        large = self.send('Large', 'large newsletter ' * 200)
+
+        self.assertEqual(short.body, 'short body')
+        self.assertIsNone(medium.body)
+        self.assertLess(len(medium.body_data), 100)
+        self.assertIsNone(large.body)
+        self.assertIsNone(large.body_data)
+        self.assertTrue(large.body_file.name.startswith('blobs/'))
+
+        for email in (short, medium, large):
+            self.assertContains(self.client.get(f'/view/{email.uid}'), email.subject)
+        self.assertContains(self.client.get(f'/view/{large.uid}'), 'large newsletter large newsletter')
+        self.assertContains(self.client.get('/search/?query=newsletter'), 'Medium')
+
+        # forwarding a large body reuses its blob
+        forward = self.send('Forwarded', get_body(large))
+        self.assertEqual(forward.body_file.name, large.body_file.name)
+        self.assertEqual(Blob.objects.get().refcount, 2)
+        forward.delete()
+        self.assertEqual(Blob.objects.get().refcount, 1)
+
+    def test_pack_bodies(self):
+        """
+        Tests that bodies stored as text are converted in batches, and read back the same.
+        """
+
+        bodies = {
+            'Short': 'short body',
+            'Medium': 'medium newsletter ' * 20,
+            'Large': 'large newsletter ' * 200,
+        }
+        emails = {subject: Email.objects.create(subject=subject, body=body) for subject, body in bodies.items()}
+
+        self.assertEqual(pack_bodies(batch_size=2), 2)
+        self.assertEqual(pack_bodies(batch_size=2), 0)
+        self.assertEqual(Email.objects.filter(body__isnull=False).count(), 1)
+        self.assertEqual(Blob.objects.get().refcount, 1)
+        for subject, body in bodies.items():
+            self.assertEqual(get_body(Email.objects.get(uid=emails[subject].uid)), body)
+
+    def test_snippets(self):
+        """
+        Tests that listings show the snippet written at send time, without loading any bodies.
+        """
+
+        email = self.send('Newsletter', '<p>Dear   reader,</p> ' + 'news ' * 100)
+        self.assertEqual(email.snippet[:18], 'Dear reader, news ')
+        self.assertTrue(email.snippet.endswith('...'))
+        self.assertLessEqual(len(email.snippet), 120)
+        self.assertIsNone(email.body)
+        self.assertEqual(str(email), f'Newsletter: {email.snippet}')
+
+        with self.capture_queries() as queries:
+            response = self.client.get('/inbox')
+        self.assertContains(response, 'Dear reader, news')
+        self.assertFalse([query for query in queries if '"body' in query['sql']])
+
+        # the snippet survives rebuilds and archiving
+        rebuild_entries()
+        self.assertEqual(MailboxEntry.objects.get(user=self.recipient).snippet, email.snippet)
+        archive(self.recipient, email.uid)
+        self.assertContains(self.client.get('/archive'), 'Dear reader, news')
+
+
+class TestThreads(MailTestCase):
+    """
+    Tests threading replies and forwards into conversations as they're sent.
+    """
+
+    def setUp(self):
+        """
+        Sets up some prerequisites before each test.
+        """
+
+        cache.clear()
+        self.alice = CustomUser.objects.create_user(username='thread_alice', email='thread_alice@simpleemail.com')
+        self.bob = CustomUser.objects.create_user(username='thread_bob', email='thread_bob@simpleemail.com')
+        self.client.force_login(self.bob)
+        session = self.client.session
+        session['email_session'] = True
+        session.save()
+
+    def send(self, sender, recipients, subject, parent=None):
+        form = ComposeForm({
+            'subject': subject,
+            'sender': sender.email,
+            'recipients': ','.join(user.email for user in recipients),
+            'body': f'{subject} body',
+            'parent': parent or '',
+        })
+        self.assertTrue(form.is_valid(), form.errors)
+        return Email.objects.get(uid=form.create_email_and_relations().uid)
+
+    def test_replies(self):
+        """
+        Tests that replies and forwards join their parent's thread, which keeps its counts up to date.
+        """
+
+        first = self.send(self.alice, [self.bob], 'Lunch?')
+        other = self.send(self.alice, [self.bob], 'Unrelated')
+        self.assertNotEqual(first.thread, other.thread)
+
+        # bob replies from the reply page, which is sent through compose
+        response = self.client.get(f'/reply/{first.uid}')
+        self.assertContains(response, 'RE: Lunch?')
+        self.assertContains(response, str(first.uid))
+        response = self.client.post('/compose', {
+            'subject': 'RE: Lunch?', 'sender': self.bob.email, 'recipients': self.alice.email,
+            'body': 'Sure', 'parent': str(first.uid),
+        }, follow=True)
+        self.assertContains(response, 'Message sent!')
+        reply = Email.objects.get(subject='RE: Lunch?')
+        self.assertEqual((reply.thread, reply.parent), (first.thread, first.uid))
+
+        # alice forwards the reply on to bob again
+        forward = self.send(self.alice, [self.bob], 'FWD: Lunch?', parent=reply.uid)
+        self.assertEqual(forward.thread, first.thread)
+
+        bob = MailboxThread.objects.get(user=self.bob, thread=first.thread)
+        self.assertEqual((bob.subject, bob.count, bob.unread), ('Lunch?', 3, 2))
+        self.assertEqual(bob.last_activity, forward.sent_at)
+        alice = MailboxThread.objects.get(user=self.alice, thread=first.thread)
+        self.assertEqual((alice.count, alice.unread), (3, 1))
+
+        # reading a message takes it off the unread count
+        self.client.get(f'/view/{first.uid}')
+        self.assertEqual(MailboxThread.objects.get(user=self.bob, thread=first.thread).unread, 1)
+
+        # the most recently active thread is listed first
+        response = self.client.get('/threads')
+        self.assertContains(response, 'Unrelated')
+        self.assertLess(response.content.index(b'Lunch?'), response.content.index(b'Unrelated'))
+
+        # rebuilding the summaries gives the same counts
+        rebuild_threads([self.bob.pk])
+        bob = MailboxThread.objects.get(user=self.bob, thread=first.thread)
+        self.assertEqual((bob.subject, bob.count, bob.unread), ('Lunch?', 3, 1))
+
+    def test_conversation(self):
+        """
+        Tests that a conversation, archived messages included, is loaded in a single query.
+        """
+
+        first = self.send(self.alice, [self.bob], 'Plans')
+        reply = self.send(self.bob, [self.alice], 'RE: Plans', parent=first.uid)
+        archive(self.bob, first.uid)
+
+        url = f'/thread/{first.thread}'
+        with self.capture_queries() as queries:
+            response = self.client.get(url)
+        self.assertContains(response, 'Plans body')
+        self.assertContains(response, 'RE: Plans')
+        self.assertLess(response.content.index(b'Plans body'), response.content.index(b'RE: Plans body'))
+        self.assertEqual(len([query for query in queries if 'app_archivedentry' in query['sql']]), 1)
+        self.assertEqual(self.client.get(f'/thread/{reply.uid}').status_code, 404)
+
+    def test_invalid_parent(self):
+        """
+        Tests that emails can't join the thread of an email the sender doesn't have.
+        """
+
+        private = self.send(self.alice, [self.alice], 'Private')
+        form = ComposeForm({
+            'subject': 'Snooping',
+            'sender': self.bob.email,
+            'recipients': self.alice.email,
+            'body': 'body',
+            'parent': str(private.uid),
+        })
+        self.assertFalse(form.is_valid())
+        self.assertIn('Invalid parent email', str(form.errors))
+        self.assertFalse(MailboxThread.objects.filter(user=self.bob).exists())
@@ -0,0 +1,172 @@
+"""
+Conversation threads, worked out when mail is written rather than when it's read.
+Every email belongs to a thread: replies and forwards join the thread of the email they
+answer (see ComposeForm), and other emails start their own. Mailbox and archived entries
+carry their email's thread, so a whole conversation is loaded with a single query on the
+thread indexes. Each user's MailboxThread rows keep the message count, unread count, and
+last activity of their threads, updated as mail is delivered and read, so the thread list
+is read without grouping the user's entries.
+"""
+
+from django.db import transaction
+from django.db.models import Count, F, Max, Q, Value
+from django.db.models.functions import Greatest
+
+from .folders import ROW_FIELDS, format_rows
+from .models import ArchivedEntry, Email, MailboxEntry, MailboxThread
+from .pagination import DEFAULT_LIMIT, akeyset_page, keyset_page
+from .shards import current_alias
+
+# number of users whose threads are updated per query
+BATCH_SIZE = 500
+
+
+def count_threads(entries):
+    """
+    Adds a batch of newly delivered mailbox entries to their users' threads.
+    Users whose threads change in the same way are updated together in a single query.
+    """
+
+    # total up the changes to each user's threads (drafts aren't part of the conversation yet)
+    changes = {}
+    for entry in entries:
+        if entry.folder == MailboxEntry.DRAFTS:
+            continue
+        change = changes.setdefault((entry.user_id, entry.thread), {
+            'subject': entry.subject, 'sent_at': entry.sent_at, 'count': 0, 'unread': 0
+        })
+        change['sent_at'] = max(change['sent_at'], entry.sent_at)
+        change['count'] += 1
+        change['unread'] += entry.folder == MailboxEntry.INBOX and not entry.is_read
+
+    # group users whose threads change in the same way
+    groups = {}
+    for (user_id, thread), change in changes.items():
+        groups.setdefault((thread, *change.values()), []).append(user_id)
+
+    for (thread, subject, sent_at, count, unread), user_ids in groups.items():
+        for start in range(0, len(user_ids), BATCH_SIZE):
+            batch = user_ids[start:start + BATCH_SIZE]
+
+            # make sure every user has a row for the thread, named after the email that started it for them
+            MailboxThread.objects.bulk_create([
+                MailboxThread(user_id=user_id, thread=thread, subject=subject, last_activity=sent_at)
+                for user_id in batch
+            ], ignore_conflicts=True)
+
+            MailboxThread.objects.filter(user__in=batch, thread=thread).update(
+                count=F('count') + count,
+                unread=F('unread') + unread,
+                last_activity=Greatest('last_activity', Value(sent_at))
+            )
+
+
+def rebuild_threads(user_ids):
+    """
+    Recomputes the thread summaries of the given users on the current shard from their mailbox and archived entries.
+    """
+
+    summaries = {}
+    for model in (MailboxEntry, ArchivedEntry):
+        rows = model.objects.filter(user__in=user_ids).exclude(folder=MailboxEntry.DRAFTS).values(
+            'user', 'thread'
+        ).annotate(
+            count=Count('uid'),
+            unread=Count('uid', filter=Q(folder=MailboxEntry.INBOX, is_read=False)),
+            last_activity=Max('sent_at'),
+            subject=Max('subject'),
+        ).order_by()
+        for row in rows:
+            summary = summaries.setdefault((row.pop('user'), row.pop('thread')), row)
+            if summary is not row:
+                summary['count'] += row['count']
+                summary['unread'] += row['unread']
+                summary['last_activity'] = max(summary['last_activity'], row['last_activity'])
+
+    with transaction.atomic(using=current_alias()):
+        # threads keep the subject they were started with
+        threads = MailboxThread.objects.filter(user__in=user_ids)
+        subjects = {(user_id, thread): subject for user_id, thread, subject in threads.values_list(
+            'user', 'thread', 'subject')}
+        threads.delete()
+        for key, row in summaries.items():
+            row['subject'] = subjects.get(key, row['subject'])
+        MailboxThread.objects.bulk_create([
+            MailboxThread(user_id=user_id, thread=thread, **row) for (user_id, thread), row in summaries.items()
+        ], batch_size=BATCH_SIZE)
+
+
+def find_thread(user, email):
+    """
+    Returns the thread of an email in the user's mailbox or archive, or None if they don't have it.
+    """
+
+    for model in (MailboxEntry, ArchivedEntry):
+        thread = model.objects.filter(user=user, email=email).values_list('thread', flat=True).first()
+        if thread is not None:
+            return thread
+    return None
+
+
+def read_thread(user, email, count):
+    """
+    Takes a number of newly read messages of an email, or its uid, off the unread count of its thread.
+    """
+
+    thread = Email.objects.filter(uid=getattr(email, 'pk', email)).values('thread')
+    MailboxThread.objects.filter(user=user, thread__in=thread).update(
+        unread=F('unread') - count
+    )
+
+
+def thread_list(user):
+    """
+    Returns a values() queryset of the user's threads, with their last activity as 'sent_at' for keyset pagination.
+    """
+
+    return MailboxThread.objects.filter(user=user).values(
+        'uid', 'thread', 'subject', 'count', 'unread', sent_at=F('last_activity')
+    )
+
+
+def load_threads(user, before=None, limit=DEFAULT_LIMIT):
+    """
+    Returns a page of the user's threads, most recently active first, along with the cursor for the next page.
+    """
+
+    return keyset_page(thread_list(user), before, limit)
+
+
+async def aload_threads(user, before=None, limit=DEFAULT_LIMIT):
+    """
+    Async version of load_threads(), for the async views.
+    """
+
+    return await akeyset_page(thread_list(user), before, limit)
+
+
+def conversation(user, thread):
+    """
+    Returns a values() queryset of every message of a thread in the user's mailbox and archive, oldest first.
+    Both halves of the query are served by the thread indexes.
+    """
+
+    entries = MailboxEntry.objects.filter(user=user, thread=thread).exclude(folder=MailboxEntry.DRAFTS)
+    archived = ArchivedEntry.objects.filter(user=user, thread=thread)
+    return entries.values(*ROW_FIELDS).union(archived.values(*ROW_FIELDS), all=True).order_by('sent_at', 'uid')
+
+
+def load_conversation(user, thread):
+    """
+    Returns the rows of a whole conversation in the user's mailbox, loaded in a single query.
+    """
+
+    return format_rows(conversation(user, thread))
+
+
+async def aload_conversation(user, thread):
+    """
+    Async version of load_conversation(), for the async views.
+    """
+
+    return format_rows([row async for row in conversation(user, thread)])
@@ -0,0 +1,125 @@
+"""
+Throttling and lockout for the email login.
+Failed attempts are rate limited per account and per IP address by sliding window counters
+kept in the cache, so once a burst of bad attempts hits the limit, the rest are turned away
+before they reach the database. Failed attempts on an account are also counted in the user
+table with single atomic F() updates, and the account locks once LOCKOUT_THRESHOLD of them
+are counted.
+"""
+
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F
+
+from .models import CustomUser
+
+# failed attempts after which an account is locked
+LOCKOUT_THRESHOLD = 3
+
+# default (failed attempts, seconds) allowed per account and per IP address
+DEFAULT_RATE_LIMITS = {
+    'account': (10, 5 * 60),
+    'ip': (30, 60),
+}
+
+
+class SlidingWindow:
+    """
+    Rate limiter allowing limit hits per window seconds for each identifier.
+    Hits are counted in fixed windows in the cache, and the previous window's count is
+    weighted by how much of it still overlaps the sliding window ending now.
+    """
+
+    def __init__(self, scope, limit, window):
+        self.scope = scope
+        self.limit = limit
+        self.window = window
+
+    def key(self, ident, index):
+        ident = hashlib.sha256(str(ident).encode()).hexdigest()[:32]
+        return f"throttle:{self.scope}:{ident}:{index}"
+
+    def count(self, ident, now=None, current=None):
+        """
+        Returns the estimated number of hits in the sliding window ending now.
+        """
+
+        now = time.time() if now is None else now
+        index, offset = divmod(now, self.window)
+        keys = [self.key(ident, int(index) - 1), self.key(ident, int(index))]
+        counts = cache.get_many(keys)
+        if current is None:
+            current = counts.get(keys[1], 0)
+        return counts.get(keys[0], 0) * (1 - offset / self.window) + current
+
+    def allows(self, ident, now=None):
+        """
+        Returns whether another hit is within the limit.
+        """
+
+        return self.count(ident, now) < self.limit
+
+    def hit(self, ident, now=None):
+        """
+        Records a hit. Returns the estimated number of hits in the window, including this one.
+        """
+
+        now = time.time() if now is None else now
+        key = self.key(ident, int(now // self.window))
+
+        # incr is atomic, so concurrent hits each get their own count
+        cache.add(key, 0, self.window * 2)
+        try:
+            current = cache.incr(key)
+        except ValueError:
+            # the key expired between add and incr
+            cache.add(key, 1, self.window * 2)
+            current = 1
+
+        return self.count(ident, now, current)
+
+
+def get_limiters():
+    limits = {**DEFAULT_RATE_LIMITS, **getattr(settings, 'LOGIN_RATE_LIMITS', {})}
+    return {scope: SlidingWindow(f"login:{scope}", *limit) for scope, limit in limits.items()}
+
+
+def login_allowed(email, ip):
+    """
+    Returns whether the account and the IP address are both within their limits of failed attempts.
+    """
+
+    limiters = get_limiters()
+    return limiters['account'].allows(email.lower()) and limiters['ip'].allows(ip)
+
+
+def record_failed_login(email, ip):
+    """
+    Counts a failed attempt against the account's and the IP address's limits.
+    """
+
+    limiters = get_limiters()
+    limiters['account'].hit(email.lower())
+    limiters['ip'].hit(ip)
+
+
+def record_failure(user_id):
+    """
+    Counts a failed attempt on an account in a single atomic update, unless it's already locked.
+    """
+
+    CustomUser.objects.filter(pk=user_id, failed_attempts__lt=LOCKOUT_THRESHOLD).update(
+        failed_attempts=F('failed_attempts') + 1
+    )
+
+
+def clear_failures(user_id):
+    """
+    Resets an account's failed attempts after a successful one.
+    Returns False if the account was locked in the meantime, in which case the login must be refused.
+    """
+
+    return bool(CustomUser.objects.filter(pk=user_id, failed_attempts__lt=LOCKOUT_THRESHOLD).update(failed_attempts=0))
@@ -1,27 +1,42 @@
-from django.urls import path
 from django.conf import settings
-from django.conf.urls.static import static
+from django.urls import path
 
-from . import views
+from . import async_views, views
+
+# mailbox reads are served by async views when running under ASGI (see project/asgi.py)
+mailbox_views = async_views if settings.ASYNC_VIEWS else views
 
 urlpatterns = [
     # splash page
     path('', views.splash, name='splash'),
 
     # folder views (inbox, outbox, etc.)
-    path('inbox', views.inbox, name='inbox'),
-    path('outbox', views.outbox, name='outbox'),
+    path('inbox', mailbox_views.inbox, name='inbox'),
+    path('outbox', mailbox_views.outbox, name='outbox'),
+    path('archive', mailbox_views.archive_folder, name='archive_folder'),
+
+    # conversations
+    path('threads', mailbox_views.threads, name='threads'),
+    path('thread/<uuid:thread>', mailbox_views.view_thread, name='view_thread'),
 
     # view email
-    path('view/<str:email_uid>', views.view_email, name='view_email'),
+    path('view/<str:email_uid>', mailbox_views.view_email, name='view_email'),
 
-    # compose and forward
+    # archive email
+    path('archive/<str:email_uid>', views.archive_email, name='archive_email'),
+
+    # download attachment
+    path('attachment/<uuid:attachment_uid>', views.download_attachment, name='download_attachment'),
+    path('attachment/<uuid:attachment_uid>/<str:variant>', views.download_attachment, name='download_attachment'),
+
+    # compose, reply, and forward
     path('compose', views.compose, name='compose'),
+    path('reply/<str:email_uid>', views.reply, name='reply'),
     path('forward', views.forward, name='forward'),
     path('forward/<str:email_uid>', views.forward, name='forward'),
 
     # search
-    path('search/', views.search, name='search'),
+    path('search/', mailbox_views.search, name='search'),
 
     # master auth
     path('login', views.master_login, name='login'),
@@ -34,14 +49,9 @@ urlpatterns = [
     path('email_logout', views.email_logout, name='email_logout'),
 
     # Note inbox
-    path('note_box', views.note_box, name='note_box'),
+    path('note_box', mailbox_views.note_box, name='note_box'),
     # View Note
     path('view_note/<str:note_uid>', views.view_note, name='view_note'),
     # Note compose
     path('note_compose', views.note_compose, name='note_compose')
-]
-
-# media files
-if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL,
-                          document_root=settings.MEDIA_ROOT)
\ No newline at end of file
+]
\ No newline at end of file
@@ -3,13 +3,25 @@ from django.contrib import messages
 from django.contrib.auth import authenticate
 from django.contrib.auth import login as auth_login
 from django.contrib.auth import logout as auth_logout
-from django.contrib.auth.hashers import get_hasher
 from django.contrib.auth.decorators import login_required
+from django.http import Http404
 from django.views.decorators.http import require_http_methods
 
 
+from .blobs import get_storage
+from .bodies import get_body
+from .conditional import conditional_page, immutable_validators, mailbox_validators
+from .downloads import serve_file
+from .hashing import rehash_email_password, verify_password
+from .folders import load_archive, load_inbox, load_outbox
 from .forms import UserRegistrationForm, ComposeForm, UserResetForm, NoteForm
-from .models import Recipient, Sender, Email, CustomUser, Note
+from .images import variant_filename
+from .mailbox import archive, mark_read
+from .models import Email, CustomUser, Note, Attachment, ArchivedEntry, MailboxEntry, MailboxThread
+from .pagination import get_page_params
+from .search import search_mailbox
+from .threads import find_thread, load_conversation, load_threads
+from .throttle import LOCKOUT_THRESHOLD, clear_failures, login_allowed, record_failed_login, record_failure
 
 
 def verify_email_auth(func, *args, **kwargs):
@@ -36,6 +48,7 @@ def verify_email_auth(func, *args, **kwargs):
 @login_required
 @verify_email_auth
 @require_http_methods(['GET'])
+@conditional_page(mailbox_validators)
 def view_email(request, email_uid):
     """
     Handles serving individual email pages.
@@ -52,74 +65,177 @@ def view_email(request, email_uid):
     # get respective recipients
     recipients = ', '.join([recipient.user.email for recipient in email.recipient_set.all()])
 
+    # the user has now read this email
+    mark_read(request.user, email)
+
     return render(request, 'view_email.html', {
         'user': request.user,
         'email': email,
+        'body': get_body(email),
         'sender': sender,
         'to': recipients,
         'attachments': [attach for attach in email.attachment_set.all()]
     })
 
 
+def participant_entries(user, email_id):
+    """
+    Returns the querysets of a user's mailbox and archive entries for an email, which show they sent or received it.
+    """
+
+    return [model.objects.filter(user=user, email=email_id) for model in (MailboxEntry, ArchivedEntry)]
+
+
+@login_required
+@verify_email_auth
+@require_http_methods(['GET', 'HEAD'])
+def download_attachment(request, attachment_uid, variant='file'):
+    """
+    Serves an attachment, or the display or thumbnail variant of an image, to a user who sent
+    or received its email.
+    """
+
+    if variant not in ('file', 'image', 'thumbnail'):
+        raise Http404("Attachment not found")
+
+    # only the email's participants may download its attachments, which may be on another database than the email
+    attachment = Attachment.objects.filter(uid=attachment_uid).first()
+    if attachment is not None and not any(
+        entries.exists() for entries in participant_entries(request.user, attachment.email_id)
+    ):
+        attachment = None
+    file = getattr(attachment, variant, None)
+    if not file:
+        raise Http404("Attachment not found")
+
+    # the original is downloaded, and image variants are shown in the page
+    if variant == 'file':
+        return serve_file(request, get_storage(), file.name, attachment.name)
+    return serve_file(request, get_storage(), file.name, variant_filename(attachment, variant), as_attachment=False)
+
+
+@login_required
+@verify_email_auth
+@require_http_methods(['POST'])
+def archive_email(request, email_uid):
+    """
+    Moves an email out of the user's inbox and into their archive.
+    """
+
+    if archive(request.user, email_uid):
+        messages.success(request, "Message archived!")
+    else:
+        messages.error(request, "Message is not in your inbox!")
+
+    return redirect('/inbox')
+
+
 @login_required
 @verify_email_auth
 @require_http_methods(['GET', 'POST'])
+@conditional_page(mailbox_validators)
 def outbox(request):
     """
     Serves the user's outbox, or sent messages.
     """
 
-    # get all of the emails that the user has sent
-    emails = []
-    senders = Sender.objects.filter(user=request.user)
-    for sender in senders:
-        if sender.is_draft:
-            continue    # skip this email since it hasn't been sent yet (still a draft)
-
-        email = sender.email
-        emails.append({
-            'uid': email.uid,
-            'subject': email.subject,
-            'from': email.sender_email.all()[0].user.email,
-            'to': ', '.join([recipient.user.email for recipient in email.recipient_set.all()]),
-            'body': email.body
-        })
+    # load the requested page of the folder
+    before, limit = get_page_params(request)
+    emails, next_cursor = load_outbox(request.user, before, limit)
 
     return render(request, 'inbox.html', {
         'user': request.user,
         'folder': 'outbox',
-        'emails': emails
+        'emails': emails,
+        'next_cursor': next_cursor,
+        'limit': limit
     })
 
 
 @login_required
 @verify_email_auth
 @require_http_methods(['GET', 'POST'])
+@conditional_page(mailbox_validators)
 def inbox(request):
     """
     Home page of Simple Email. Serves the user's inbox.
     """
 
-    # get all emails received by the user that have been sent
-    emails = []
-    recipients = Recipient.objects.filter(user=request.user)
-    for recipient in recipients:
-        if not recipient.is_sent:
-            continue    # skip this email since it hasn't been sent yet (still a draft)
-
-        email = recipient.email
-        emails.append({
-            'uid': email.uid,
-            'subject': email.subject,
-            'from': email.sender_email.all()[0].user.email,
-            'to': ', '.join([recipient.user.email for recipient in email.recipient_set.all()]),
-            'body': email.body
-        })
+    # load the requested page of the folder
+    before, limit = get_page_params(request)
+    emails, next_cursor = load_inbox(request.user, before, limit)
 
     return render(request, 'inbox.html', {
         'user': request.user,
         'folder': 'inbox',
-        'emails': emails
+        'emails': emails,
+        'next_cursor': next_cursor,
+        'limit': limit
+    })
+
+
+@login_required
+@verify_email_auth
+@require_http_methods(['GET', 'POST'])
+@conditional_page(mailbox_validators)
+def archive_folder(request):
+    """
+    Serves the user's archive, of emails they archived or that were archived for being old.
+    """
+
+    # load the requested page of the folder
+    before, limit = get_page_params(request)
+    emails, next_cursor = load_archive(request.user, before, limit)
+
+    return render(request, 'inbox.html', {
+        'user': request.user,
+        'folder': 'archive',
+        'emails': emails,
+        'next_cursor': next_cursor,
+        'limit': limit
+    })
+
+
+@login_required
+@verify_email_auth
+@require_http_methods(['GET'])
+@conditional_page(mailbox_validators)
+def threads(request):
+    """
+    Serves the user's conversations, most recently active first.
+    """
+
+    # load the requested page of the user's thread summaries
+    before, limit = get_page_params(request)
+    rows, next_cursor = load_threads(request.user, before, limit)
+
+    return render(request, 'threads.html', {
+        'user': request.user,
+        'folder': 'threads',
+        'threads': rows,
+        'next_cursor': next_cursor,
+        'limit': limit
+    })
+
+
+@login_required
+@verify_email_auth
+@require_http_methods(['GET'])
+@conditional_page(mailbox_validators)
+def view_thread(request, thread):
+    """
+    Serves every message of one of the user's conversations, oldest first.
+    """
+
+    summary = MailboxThread.objects.filter(user=request.user, thread=thread).values('subject').first()
+    if summary is None:
+        raise Http404("Conversation not found")
+
+    return render(request, 'inbox.html', {
+        'user': request.user,
+        'folder': 'thread',
+        'subject': summary['subject'],
+        'emails': load_conversation(request.user, thread)
     })
 
 
@@ -139,61 +255,17 @@ def search(request):
         messages.error(request, "Invalid search query!")
         return redirect('/')
 
-    # setup
-    emails = {}
-    sender_results = Sender.objects.none()
-    recipient_results = Recipient.objects.none()
-
-    # query DB for matching sent emails
-    senders = Sender.objects.filter(user=request.user)
-    if query in request.user.email:
-        # if the user's query is for their own email, add sent emails
-        sender_results = sender_results | senders
-    sender_results = sender_results | senders.filter(email__body__contains=query)
-    sender_results = sender_results | senders.filter(email__subject__contains=query)
-
-    # find any sent emails whose recipients match the query
-    for sender in senders:
-        recipient_results = recipient_results | sender.email.recipient_set.filter(user__email__contains=query)
-
-    # query DB for matching recipients
-    recipients = Recipient.objects.filter(user=request.user)
-    if query in request.user.email:
-        # if the user's query is for their own email, add sent emails
-        recipient_results = recipient_results | recipients
-    recipient_results = recipient_results | Recipient.objects.filter(user=request.user, email__body__contains=query)
-    recipient_results = recipient_results | Recipient.objects.filter(user=request.user, email__subject__contains=query)
-
-    # find any sent emails whose recipients match the query
-    for recipient in recipients:
-        sender_results = sender_results | recipient.email.sender_email.all().filter(user__email__contains=query)
-
-    # add together matching sender results
-    for sender in sender_results:
-        emails[sender.email.uid] = {
-            'subject': sender.email.subject,
-            'body': sender.email.body,
-            'from': sender.user.email,
-            'to': ', '.join([recipient.user.email for recipient in sender.email.recipient_set.all()]),
-        }
-
-    # add together matching recipient results
-    for recipient in recipient_results:
-        if emails.get(recipient.email.uid):
-            # this email has already been added, skip it
-            continue
-        emails[recipient.email.uid] = {
-            'uid': recipient.email.uid,
-            'subject': recipient.email.subject,
-            'body': recipient.email.body,
-            'from': recipient.email.sender_email.get().user.email,
-            'to': recipient.user.email
-        }
+    # load the requested page of the user's best matching emails
+    before, limit = get_page_params(request)
+    rows, next_cursor = search_mailbox(request.user, query, before, limit)
 
     # render and return any results
     return render(request, 'search.html', {
         'user': request.user,
-        'emails': emails
+        'query': query,
+        'emails': {row['uid']: row for row in rows},
+        'next_cursor': next_cursor,
+        'limit': limit
     })
 
 
@@ -242,6 +314,38 @@ def compose(request):
     })
 
 
+@login_required
+@verify_email_auth
+@require_http_methods(['GET'])
+def reply(request, email_uid):
+    """
+    Serves the compose page for a reply to an email, which is sent through the compose view.
+    """
+
+    # only emails in the user's mailbox or archive can be replied to
+    entry = None
+    for model in (MailboxEntry, ArchivedEntry):
+        entry = entry or model.objects.filter(user=request.user, email=email_uid).values(
+            'subject', 'sender_address').first()
+    if entry is None:
+        messages.error(request, f"Email for UID {email_uid} not found!")
+        return redirect('/')
+
+    # reply to the email's sender, in the same conversation
+    subject = entry['subject']
+    form = ComposeForm(initial={
+        'sender': request.user.email,
+        'recipients': entry['sender_address'],
+        'subject': subject if subject.startswith('RE: ') else f"RE: {subject}",
+        'parent': email_uid,
+    })
+
+    return render(request, 'compose.html', {
+        'user': request.user,
+        'form': form
+    })
+
+
 @login_required
 @verify_email_auth
 @require_http_methods(['GET', 'POST'])
@@ -282,8 +386,10 @@ def forward(request, email_uid=None):
         if email is not None:
             form = ComposeForm(initial={
                 'sender': request.user.email,
-                'body': email.body,
+                'body': get_body(email),
                 'is_forward': True,
+                # forwards join the email's conversation when it's in the user's mailbox
+                'parent': email.uid if find_thread(request.user, email.uid) is not None else None,
             })
         else:
             messages.error(request, f"Email for UID {email_uid} not found!")
@@ -416,37 +522,46 @@ def email_login(request):
         email = request.POST['email']
         password = request.POST['password']
 
-        try:
-            # try retrieving user object from db
-            user = CustomUser.objects.get(email=email)
+        # turn away bursts of bad attempts before they reach the DB
+        ip = request.META.get('REMOTE_ADDR', '')
+        if not login_allowed(email, ip):
+            messages.warning(request, "Too many login attempts. Please try again later.")
+            return render(request, 'email_login.html', {}, status=429)
 
-            # check that the user isn't locked out
-            if user.failed_attempts >= 3:
-                messages.warning(request, "User account is locked")
+        # retrieve only the columns needed to check the attempt
+        user = CustomUser.objects.filter(email=email).values('pk', 'email_password', 'failed_attempts').first()
 
-            else:
-                # verify that the user gave the correct password
-                hasher = get_hasher('default')
-                is_correct = hasher.verify(password, user.email_password)
-
-                if is_correct:
-                    # reset lockout attempts
-                    user.failed_attempts = 0
-                    user.save()
-
-                    # log the user in and redirect to inbox
-                    request.session["email_session"] = True
-                    return redirect('/inbox')
-
-                else:
-                    # increment the lockout attempts
-                    user.failed_attempts += 1
-                    user.save()
-                    messages.warning(request, "Invalid email or password.")
-
-        except CustomUser.DoesNotExist:
+        if user is None:
+            record_failed_login(email, ip)
             messages.warning(request, "Invalid email or password.")
 
+        # check that the user isn't locked out
+        elif user['failed_attempts'] >= LOCKOUT_THRESHOLD:
+            messages.warning(request, "User account is locked")
+
+        else:
+            # verify that the user gave the correct password, on the hashing pool
+            is_correct, needs_update = verify_password(password, user['email_password'])
+
+            if not is_correct:
+                # increment the lockout attempts
+                record_failed_login(email, ip)
+                record_failure(user['pk'])
+                messages.warning(request, "Invalid email or password.")
+
+            # reset lockout attempts, unless other attempts locked the account meanwhile
+            elif clear_failures(user['pk']):
+                # move the password to the current hashing parameters
+                if needs_update:
+                    rehash_email_password(user['pk'], password)
+
+                # log the user in and redirect to inbox
+                request.session["email_session"] = True
+                return redirect('/inbox')
+
+            else:
+                messages.warning(request, "User account is locked")
+
     else:
         if request.session.get("email_session", None):
             # redirect user to inbox if user is already signed into Email
@@ -531,6 +646,7 @@ def note_compose(request):
 
 
 @login_required
+@conditional_page(mailbox_validators)
 def note_box(request):
     """
     Home page of Simple Note. Serves the user's Notes.
@@ -546,6 +662,7 @@ def note_box(request):
 
 
 @login_required
+@conditional_page(immutable_validators)
 def view_note(request, note_uid):
     """
     Handles serving individual note pages.
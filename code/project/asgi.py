@@ -13,4 +13,12 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'project.settings')
 
-application = get_asgi_application()
+# serve the mailbox read views with their async versions (see app/async_views.py)
+os.environ.setdefault('SIMPLE_EMAIL_ASYNC_VIEWS', '1')
+
+django_application = get_asgi_application()
+
+# serve the Server-Sent Events stream alongside Django (see app/events.py)
+from app.events import route_events  # noqa: E402
+
+application = route_events(django_application)
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/3.1/ref/settings/
 """
 
 import os
+import tempfile
 
 from pathlib import Path
 
@@ -39,7 +40,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
-    'app',
+    'app.apps.AppConfig',
 ]
 
 MIDDLEWARE = [
@@ -48,8 +49,12 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'app.shards.ShardMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'app.caching.cache_stats_middleware',
+    'app.hashing.HashingPoolMiddleware',
+    'app.replicas.ReplicaMiddleware',
 ]
 
 ROOT_URLCONF = 'project.urls'
@@ -65,6 +70,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'app.context_processors.mailbox_counters',
             ],
         },
     },
@@ -83,6 +89,146 @@ DATABASES = {
     }
 }
 
+# Mailbox pages read from the DATABASE_REPLICAS (see app/replicas.py), and everything else,
+# writes included, uses the primary ('default'). Users whose mailbox changed in the last
+# REPLICA_PIN_SECONDS read from the primary, so that should exceed the replication lag.
+# SIMPLE_EMAIL_DB_REPLICAS lists SQLite files (comma-separated) to stand in for replicas locally.
+
+DATABASE_REPLICAS = []
+
+for index, name in enumerate(filter(None, os.environ.get('SIMPLE_EMAIL_DB_REPLICAS', '').split(','))):
+    DATABASES[f'replica{index + 1}'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': name,
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_REPLICAS.append(f'replica{index + 1}')
+
+REPLICA_READ_VIEWS = [
+    'inbox', 'outbox', 'archive_folder', 'threads', 'view_thread', 'search', 'note_box', 'view_email', 'view_note'
+]
+
+REPLICA_PIN_SECONDS = 5
+
+# Each user's mail lives on their shard (see app/shards.py): new users are spread across
+# SHARD_DATABASES, users from before sharding stay on 'default', and `manage.py move_user`
+# moves a user to another shard while they keep using the site. Sharded mail is always read
+# from its shard rather than a replica. SIMPLE_EMAIL_SHARDS lists SQLite files (comma-separated)
+# to use as shards locally; each needs `manage.py migrate --database=<alias>`.
+
+SHARD_DATABASES = []
+
+for index, name in enumerate(filter(None, os.environ.get('SIMPLE_EMAIL_SHARDS', '').split(','))):
+    DATABASES[f'shard{index + 1}'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': name,
+    }
+    SHARD_DATABASES.append(f'shard{index + 1}')
+
+DATABASE_ROUTERS = ['app.shards.ShardRouter', 'app.replicas.ReplicaRouter']
+
+# Archived mail, and inbox and outbox mail older than ARCHIVE_AFTER_DAYS, is moved out of the
+# mailbox tables into the archive tables daily (see app/archiving.py), and the bodies of emails
+# left only in archives are compressed. `manage.py archive_mail` runs it by hand.
+
+ARCHIVE_AFTER_DAYS = 365
+
+# Email bodies over EMAIL_BODY_COMPRESS_THRESHOLD bytes are stored compressed, and those over
+# EMAIL_BODY_BLOB_THRESHOLD bytes in compressed blob files under MEDIA_ROOT (see app/bodies.py).
+# `manage.py pack_bodies` converts bodies stored before a threshold was lowered.
+
+EMAIL_BODY_COMPRESS_THRESHOLD = 4 * 1024
+
+EMAIL_BODY_BLOB_THRESHOLD = 256 * 1024
+
+
+# Sessions
+# Sessions are kept in an in-process LRU cache in front of the session table (see app/sessions.py),
+# checked against a login version in the default cache, which must be shared for logouts to
+# reach every process right away.
+# SIMPLE_EMAIL_SESSION_ENGINE=signed_cookies keeps them in signed cookies instead, for nodes that
+# can't share a user's requests.
+
+SESSION_ENGINES = {
+    'lru': 'app.sessions',
+    'db': 'django.contrib.sessions.backends.db',
+    'signed_cookies': 'django.contrib.sessions.backends.signed_cookies',
+}
+
+SESSION_ENGINE = SESSION_ENGINES[os.environ.get('SIMPLE_EMAIL_SESSION_ENGINE', 'lru')]
+
+SESSION_LRU_SIZE = 10000
+
+SESSION_LRU_TTL = 30
+
+SESSION_WRITE_BEHIND_INTERVAL = 1.0
+
+
+# Failed email logins allowed per account and per IP address, as (attempts, seconds).
+# They're counted in the default cache, so it must be shared by every process (e.g. Redis)
+# for the limits to hold across them. See app/throttle.py.
+
+LOGIN_RATE_LIMITS = {
+    'account': (10, 5 * 60),
+    'ip': (30, 60),
+}
+
+
+# Caches
+# Rendered mail rows are cached in the 'fragments' cache, keyed by email uid and version.
+# SIMPLE_EMAIL_FRAGMENT_CACHE picks its backend: 'locmem' (per process), 'file' (shared by the
+# processes on this machine), or 'redis' (shared by every machine, needs the redis package).
+# With FRAGMENT_CACHE_STATS, each response reports its hits and misses in X-Fragment-Cache.
+
+FRAGMENT_CACHE_BACKENDS = {
+    'locmem': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'fragments',
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+    'file': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(tempfile.gettempdir(), 'simple-email-fragments'),
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+    'redis': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ.get('SIMPLE_EMAIL_REDIS_URL', 'redis://127.0.0.1:6379'),
+    },
+}
+
+# Each user's counter row is read at most once per request, and from the 'counters' cache when
+# SIMPLE_EMAIL_COUNTER_CACHE is 'file' or 'redis'. Mail delivered by any worker invalidates it,
+# so it has to be shared by them all. By default ('none') the row is read from the database.
+
+COUNTER_CACHE_BACKENDS = {
+    'none': {
+        'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+    },
+    'file': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(tempfile.gettempdir(), 'simple-email-counters'),
+    },
+    'redis': FRAGMENT_CACHE_BACKENDS['redis'],
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'counters': {
+        **COUNTER_CACHE_BACKENDS[os.environ.get('SIMPLE_EMAIL_COUNTER_CACHE', 'none')],
+        'TIMEOUT': 60 * 60,
+    },
+    'fragments': {
+        'BACKEND': 'app.caching.StatsCache',
+        'TIMEOUT': 24 * 60 * 60,
+        'OPTIONS': {'CACHE': FRAGMENT_CACHE_BACKENDS[os.environ.get('SIMPLE_EMAIL_FRAGMENT_CACHE', 'locmem')]},
+    },
+}
+
+FRAGMENT_CACHE_STATS = DEBUG
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
@@ -93,6 +239,16 @@ LOGIN_URL = '/login'
 LOGIN_REDIRECT_URL = '/'
 LOGOUT_REDIRECT_URL = '/'
 
+# Passwords are checked with the hashing pool (see app/hashing.py), which runs at most
+# PASSWORD_HASHING_WORKERS hashes at once with PASSWORD_HASHING_QUEUE more waiting,
+# and answers any more with 503 Service Unavailable.
+
+AUTHENTICATION_BACKENDS = ['app.hashing.PooledModelBackend']
+
+PASSWORD_HASHING_WORKERS = os.cpu_count() or 4
+
+PASSWORD_HASHING_QUEUE = 16
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -138,3 +294,30 @@ STATICFILES_DIRS = (
 MEDIA_ROOT = os.path.join(BASE_DIR, 'app', 'media/')
 
 MEDIA_URL = '/media/'
+
+# Attachment downloads are streamed by Django unless this is set to 'x-accel-redirect' (nginx)
+# or 'x-sendfile' (Apache, lighttpd), which hand the file off to the front proxy instead.
+# nginx must serve ATTACHMENT_ACCEL_PREFIX as an internal location aliased to MEDIA_ROOT.
+
+ATTACHMENT_SENDFILE = None
+
+ATTACHMENT_ACCEL_PREFIX = '/protected/'
+
+# Background jobs (image processing, large sends, cleanup) are run by `manage.py runworker`.
+# JOBS_SYNC runs them during the request instead, which is useful for tests.
+# Sends to more recipients than DEFERRED_FANOUT_THRESHOLD are delivered by a job.
+
+JOBS_SYNC = False
+
+DEFERRED_FANOUT_THRESHOLD = 1000
+
+# Serve the mailbox read views (inbox, outbox, view, search, notes) with async views.
+# project/asgi.py turns this on, so WSGI deployments keep the sync views.
+
+ASYNC_VIEWS = os.environ.get('SIMPLE_EMAIL_ASYNC_VIEWS') == '1'
+
+# Mail and counter changes are pushed to open pages over Server-Sent Events by ASGI workers.
+# Each worker listens on a socket in EVENTS_SOCKET_DIR so events reach every worker on the machine.
+# Set it to None to only push events within a single process.
+
+EVENTS_SOCKET_DIR = os.path.join(tempfile.gettempdir(), 'simple-email-events')